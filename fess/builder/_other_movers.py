@@ -6,6 +6,7 @@ import copy
 import logging
 
 from .move import Mover
+from . import topology as fbtopo
 
 log=logging.getLogger(__name__)
 
@@ -25,8 +26,8 @@ class MSTchangingMover(Mover):
         # Get an element. If it is a ml-segment, break it.
         elem = self._get_elem(sm)
         if elem[0]=="m":
-            loop = sm.bg.shortest_mlonly_multiloop(elem)
-            if "open" in sm.bg.describe_multiloop(loop):
+            loop = fbtopo.shortest_mlonly_multiloop(sm.bg, elem)
+            if "open" in fbtopo.describe_multiloop(sm.bg, loop):
                 return super(MSTchangingMover, self).move(sm)
             else:
                 defined_loop = set(loop)&sm.bg.mst
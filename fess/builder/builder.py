@@ -14,22 +14,26 @@ __email__ = "thiel@tbi.univie.ac.at"
 
 import itertools
 import random
-import copy
+import multiprocessing
 import os
 import sys
-from collections import Counter
+from collections import Counter, deque
 #profile decorator from line_profiler (kernprof) or memory_profiler
 try:
     profile
 except:
     profile = lambda x: x
 
+import numpy as np
+
 import forgi.threedee.utilities.graph_pdb as ftug
 import forgi.threedee.utilities.vector as ftuv
 
 import logging
 
+import fess.builder.energy as fbe
 import fess.builder.move as fbm
+import fess.builder.topology as fbtopo
 import fess.builder.relaxation_builder as fbrel
 
 log = logging.getLogger(__name__)
@@ -57,7 +61,11 @@ def _determined_broken_ml_segments(built_nodes, bg):
     in built_nodes.
     """
     ml_nodes=set(x for x in bg.defines.keys() if x[0]=="m")
-    broken_multiloops = ml_nodes-set(itertools.chain(*[bo for bo in bg.traverse_graph()]))
+    if bg.build_order is None:
+        bg.traverse_graph()
+    # Do not traverse the graph again, because this would replace the build order
+    # and invalidate everything that is cached for it.
+    broken_multiloops = ml_nodes-set(itertools.chain(*bg.build_order))
     log.debug("MST = %s, build_order= %s", bg.mst, bg.build_order)
     log.debug("Broken multiloops are %s. Now finding out if they are determined...", broken_multiloops)
     broken_determined_nodes=set()
@@ -89,7 +97,7 @@ class Builder(object):
         models = []
         for i in range(n):
             self.build(sm)
-            models.append(copy.deepcopy(sm))
+            models.append(sm.clone())
         return models
 
     def accept_or_build(self, sm):
@@ -121,11 +129,14 @@ class Builder(object):
 
         newbuilt_nodes = sm.new_traverse_and_build(start = 'start', max_steps = 1)
         built_nodes = []
+        clash_stack = self._clash_stack(sm)
         iterations = 0
         try:
             while newbuilt_nodes:
                 iterations +=1
                 built_nodes += newbuilt_nodes
+                if clash_stack is not None:
+                    clash_stack.push(newbuilt_nodes)
                 log.debug("built nodes are {}".format(built_nodes))
                 bad_segments = self._get_bad_ml_segments(sm, built_nodes)
                 if warn and bad_segments:
@@ -141,19 +152,20 @@ class Builder(object):
                 if not bad_segments:
                     log.debug("Evaluate clash energy:")
                     #The junction-energy is ok. Now we look at the clash energy
-                    bad_segments = self._get_bad_clash_segments(sm, built_nodes)
+                    bad_segments = self._get_bad_clash_segments(sm, built_nodes, clash_stack)
                     if warn and bad_segments:
                         log.warning("Original structure does not fulfill "
                                     "clash energy. Bad loops: %s", bad_segments)
                         warn = False
-                    if not bad_segments or self._rebuild_clash_only(sm, built_nodes, [x for x in bad_segments if x[0] == "i"]):
+                    if not bad_segments or self._rebuild_clash_only(sm, built_nodes, [x for x in bad_segments if x[0] == "i"],
+                                                                    clash_stack):
                         log.debug("clashfree.")
                         #All clashes were removed
-                        assert self._get_bad_clash_segments(sm, built_nodes) == []
+                        assert self._get_bad_clash_segments(sm, built_nodes, clash_stack) == []
                         bad_segments = []
                     else:
                         #The structure has changed, so we need to get the bad segments again.
-                        bad_segments = self._get_bad_clash_segments(sm, built_nodes)
+                        bad_segments = self._get_bad_clash_segments(sm, built_nodes, clash_stack)
                 # If we need to resample, go back somewhere into the past
                 if bad_segments:
                     try:
@@ -165,6 +177,8 @@ class Builder(object):
                     log.info("Resampling elem_def for %s", start_node)
                     sm.elem_defs[start_node] = self.stat_source.sample_for(sm.bg, start_node)
                     built_nodes = built_nodes[:built_nodes.index(start_node)]
+                    if clash_stack is not None:
+                        clash_stack.truncate(len(built_nodes))
                     log.debug("Going back to node {}".format(start_node))
                 else:
                     start_node = built_nodes[-1]
@@ -225,22 +239,36 @@ class Builder(object):
                     return bad_loop_nodes
         return []
 
-    def _get_bad_clash_segments(self, sm, nodes):
+    def _clash_stack(self, sm):
+        """
+        A ClashStack for the constraint energy of the spatial model, or None,
+        if the constraint energy is not a single StemVirtualResClashEnergy.
+        """
+        return fbe.ClashStack.for_energy(sm.constraint_energy, sm.bg)
+
+    def _get_bad_clash_segments(self, sm, nodes, clash_stack=None):
         """
         Return a list of interior loops and multiloop segments between the
         first stem in nodes that has a clash and the end of the structure.
 
         :param sm: The spatial model
         :param nodes: Only take these nodes into account
+        :param clash_stack: None or a ClashStack holding exactly the nodes.
+                            If it is given, the clash energy is not evaluated again.
         :returns: A list of i and m element that were built after the first stem
                   with clashes, or an empty list is no clashes are detected.
         """
         if sm.constraint_energy is None:
             return []
-        ec = sm.constraint_energy.eval_energy(sm.bg, nodes=nodes)
+        if clash_stack is not None:
+            ec = clash_stack.clashes
+            bad_bulges = clash_stack.bad_bulges
+        else:
+            ec = sm.constraint_energy.eval_energy(sm.bg, nodes=nodes)
+            bad_bulges = sm.constraint_energy.bad_bulges
         log.debug("Clash Energy for nodes {} is {}".format(nodes, ec))
         if ec>0:
-            bad_stems=set(x for clash_pair in sm.constraint_energy.bad_bulges for x in clash_pair)
+            bad_stems=set(x for clash_pair in bad_bulges for x in clash_pair)
             first = min(nodes.index(st) for st in bad_stems)
             assert first>=0
             clash_nodes = [ x for x in nodes[first:] if x[0] in ["m", "i"]]
@@ -248,7 +276,7 @@ class Builder(object):
             return clash_nodes
         return []
 
-    def _rebuild_clash_only(self, sm, nodes, changable):
+    def _rebuild_clash_only(self, sm, nodes, changable, clash_stack=None):
         """
         Tries to rebuild part of the structure to remove clashes.
 
@@ -261,6 +289,8 @@ class Builder(object):
         :param nodes: Take only these nodes into account for energy calculation
         :param changable: Only try to change on of these nodes. A list!
         :param tries: maximal tries before giving up and returning False
+        :param clash_stack: None or a ClashStack holding exactly the nodes.
+                            It is updated with the rebuilt nodes.
 
         :returns: True, if a clash_free structure was built.
         """
@@ -272,7 +302,12 @@ class Builder(object):
             node = random.choice(changable)
             sm.elem_defs[node] = self.stat_source.sample_for(sm.bg, node)
             sm.new_traverse_and_build(start=node, end=nodes[-1])
-            ec = sm.constraint_energy.eval_energy(sm.bg, nodes=nodes)
+            if clash_stack is not None:
+                clash_stack.truncate(nodes.index(node))
+                clash_stack.push(nodes[nodes.index(node):])
+                ec = clash_stack.clashes
+            else:
+                ec = sm.constraint_energy.eval_energy(sm.bg, nodes=nodes)
             if ec == 0:
                 log.debug("_rebuild_clash_only for {} was successful after {} tries".format(nodes, i))
                 return True
@@ -332,18 +367,21 @@ class FairBuilder(Builder):
         while True:
             self._attempt_to_build(sm)
             if self._fulfills_junction_energy(sm) and self._fulfills_clash_energy(sm):
-                # TODO: Code copy-pasted from builder class
-                # TODO: Restructure to avoid duplication.
-                for elem in _determined_broken_ml_segments(sm.bg.defines.keys(), sm.bg):
-                    if elem in sm.junction_constraint_energy and hasattr(sm.junction_constraint_energy[elem], "used_stat"):
-                        used_stat = sm.junction_constraint_energy[elem].used_stat
-                        log.debug("Assigning stat %s to broken ml segment %s",
-                                  used_stat, elem)
-                        sm.elem_defs[elem] = used_stat
+                self._assign_broken_ml_stats(sm)
                 sm.save_sampled_elems()
                 log.debug("++++++++++++++++++++++++++++++++++++++")
                 return
 
+    def _assign_broken_ml_stats(self, sm):
+        # TODO: Code copy-pasted from builder class
+        # TODO: Restructure to avoid duplication.
+        for elem in _determined_broken_ml_segments(sm.bg.defines.keys(), sm.bg):
+            if elem in sm.junction_constraint_energy and hasattr(sm.junction_constraint_energy[elem], "used_stat"):
+                used_stat = sm.junction_constraint_energy[elem].used_stat
+                log.debug("Assigning stat %s to broken ml segment %s",
+                          used_stat, elem)
+                sm.elem_defs[elem] = used_stat
+
     def _attempt_to_build(self, sm):
         sm.sample_stats(self.stat_source)
         sm.new_traverse_and_build()
@@ -357,15 +395,11 @@ class FairBuilder(Builder):
             if self.store_failed is True or self.store_failed == "junction":
                 self._store_failed(sm)
             elif self.store_failed=="list":
-                with open(os.path.join(self.output_dir, "clashlist.txt"), "a") as f:
-                    self._failed_save_counter += 1
-                    bad_junctions = []
-                    add = True
-                    for broken_elem, energy in sm.junction_constraint_energy.items():
-                        if energy.bad_bulges:
-                            bad_junctions.append(broken_elem)
-                    f.write("{}: junction {}\n".format(self._failed_save_counter,
-                                                     list(set(bad_junctions))))
+                bad_junctions = []
+                for broken_elem, energy in sm.junction_constraint_energy.items():
+                    if energy.bad_bulges:
+                        bad_junctions.append(broken_elem)
+                self._record_failure("junction {}".format(list(set(bad_junctions))))
             return False
 
     def _fulfills_clash_energy(self, sm):
@@ -376,23 +410,34 @@ class FairBuilder(Builder):
             if self.store_failed is True or self.store_failed == "clash":
                 self._store_failed(sm)
             elif self.store_failed=="list":
-                with open(os.path.join(self.output_dir, "clashlist.txt"), "a") as f:
-                    self._failed_save_counter += 1
-                    clash_pairs = set()
-                    f.write("{}: clash {}\n".format(self._failed_save_counter, sm.constraint_energy.bad_bulges))
+                self._record_failure("clash {}".format(sm.constraint_energy.bad_bulges))
             return False
 
+    def _record_failure(self, reason):
+        """
+        Append the reason of a failure to the file clashlist.txt
+        """
+        with open(os.path.join(self.output_dir, "clashlist.txt"), "a") as f:
+            self._failed_save_counter += 1
+            f.write("{}: {}\n".format(self._failed_save_counter, reason))
+
     def _store_failed(self, sm):
+        self._write_failed(sm.bg.to_cg_string())
+
+    def _write_failed(self, cg_string):
         self._failed_save_counter += 1
         with open(os.path.join(self.output_dir,
                               'failed{:06d}.coord'.format(self._failed_save_counter)), "w") as f:
-            f.write(sm.bg.to_cg_string())
+            f.write(cg_string)
 
     def _store_success(self, sm):
+        self._write_success(sm.bg.to_cg_string())
+
+    def _write_success(self, cg_string):
         self._success_save_counter += 1
         with open(os.path.join(self.output_dir,
                               'build{:06d}.coord'.format(self._success_save_counter)), "w") as f:
-            f.write(sm.bg.to_cg_string())
+            f.write(cg_string)
 
     @profile
     def success_probability(self, sm, target_attempts=None, target_structures=None, store_success = True):
@@ -429,6 +474,418 @@ class FairBuilder(Builder):
                  " are ok.".format(clashes/good_j, success/good_j))
         return success, attempts, junction_failures, clashes
 
+class BatchedFairBuilder(FairBuilder):
+    def __init__(self, stat_source, output_dir = None, store_failed=False, batch_size=100):
+        """
+        A FairBuilder that samples the stats for batch_size structures at once.
+
+        The stems of all structures in the batch are placed simultaneously
+        (see `SpatialModel.batched_stem_frames`) and multiloops with a JDIST
+        constraint energy are screened for the whole batch with array operations.
+        Only structures that pass this screen are built and checked
+        with the constraint energies, in the order in which they were sampled.
+        Thus the distribution of the built structures is the same as for the FairBuilder.
+
+        :param batch_size: The number of structures sampled at once.
+        """
+        super(BatchedFairBuilder, self).__init__(stat_source, output_dir, store_failed)
+        self.batch_size = batch_size
+        #: A deque of (elem_defs, open_junction) for the sampled, but not yet used structures.
+        self._batch = deque()
+        #: The spatial model and build order the batch was sampled for
+        self._batch_for = None
+        #: The broken ml-segment, whose junction was rejected by the
+        #: screen in the last attempt, or None
+        self._open_junction = None
+        #: The stats of the last attempt, if it was rejected by the screen.
+        self._open_defs = None
+
+    def _attempt_to_build(self, sm):
+        if self._batch_for is None or self._batch_for[0] is not sm or self._batch_for[1] is not sm.bg.build_order:
+            self._batch.clear()
+        if not self._batch:
+            self._sample_batch(sm)
+        elem_defs, self._open_junction = self._batch.popleft()
+        if self._open_junction is None:
+            sm.elem_defs = elem_defs
+            sm.new_traverse_and_build()
+        else:
+            # The structure is only built if it needs to be stored.
+            self._open_defs = elem_defs
+
+    def _sample_batch(self, sm):
+        original_defs = sm.elem_defs
+        batch = []
+        for i in range(self.batch_size):
+            sm.elem_defs = dict(original_defs)
+            sm.sample_stats(self.stat_source)
+            batch.append(sm.elem_defs)
+        sm.elem_defs = original_defs
+        open_junctions = self._junction_screen(sm, batch)
+        log.debug("%d of %d structures in the batch pass the junction screen",
+                  sum(1 for j in open_junctions if j is None), len(batch))
+        self._batch.extend(zip(batch, open_junctions))
+        self._batch_for = (sm, sm.bg.build_order)
+
+    def _jdist_checks(self, sm):
+        """
+        A list of tuples (broken ml-segment, ml-segment, energy) for all
+        ml-segments, that sm.fulfills_junction_energy checks with a
+        RoughJunctionClosureEnergy, in the order in which they are checked.
+        """
+        checks = []
+        mst = sm.bg.get_mst()
+        for mloop in fbtopo.mlonly_multiloops(sm.bg):
+            for loop in mloop:
+                if loop not in mst and loop in sm.junction_constraint_energy:
+                    energy = sm.junction_constraint_energy[loop]
+                    if hasattr(energy, "iterate_energies"):
+                        energies = energy.iterate_energies()
+                    else:
+                        energies = [energy]
+                    for e in energies:
+                        if isinstance(e, fbe.RoughJunctionClosureEnergy):
+                            checks += [(loop, m, e) for m in mloop if m[0] == "m"]
+        return checks
+
+    def _junction_screen(self, sm, batch):
+        """
+        Screen the RoughJunctionClosureEnergies for every set of stats in the batch.
+
+        See `SpatialModel.batched_junction_distances`.
+
+        :returns: A list with one entry per set of stats: None, if the structure
+                  may fulfill the junction energies, else the broken ml-segment
+                  with the first violated energy.
+        """
+        open_junctions = [None]*len(batch)
+        checks = self._jdist_checks(sm)
+        if not checks:
+            return open_junctions
+        frames = sm.batched_stem_frames(batch)
+        distances = {}
+        for loop, bulge, energy in checks:
+            if bulge not in distances:
+                distances[bulge] = sm.batched_junction_distances(bulge, frames, batch)
+            cutoff = energy.cutoff_distance(sm.bg, bulge)
+            # The tolerance makes sure that rounding errors never reject a valid structure.
+            for k in np.nonzero(distances[bulge] > cutoff + 1e-6)[0]:
+                if open_junctions[k] is None:
+                    open_junctions[k] = loop
+        return open_junctions
+
+    def _fulfills_junction_energy(self, sm):
+        if self._open_junction is None:
+            return super(BatchedFairBuilder, self)._fulfills_junction_energy(sm)
+        log.debug("junction_energy not fulfilled (junction screen).")
+        if self.store_failed is True or self.store_failed == "junction":
+            sm.elem_defs = self._open_defs
+            sm.new_traverse_and_build()
+            self._store_failed(sm)
+        elif self.store_failed=="list":
+            self._record_failure("junction {}".format([self._open_junction]))
+        return False
+
+class EarlyRejectionFairBuilder(FairBuilder):
+    """
+    A FairBuilder that builds the structure stem by stem (like
+    `Builder._build_with_energies`) and abandons an attempt as soon as a
+    junction, that is fully determined by the built stems, is not closed.
+    After every closed junction, the built part of the structure is checked for clashes.
+
+    Every violation in a part of the structure is also a violation in the
+    whole structure, so the distribution of the built structures is the
+    same as for the FairBuilder.
+    """
+    def __init__(self, stat_source, output_dir = None, store_failed=False):
+        super(EarlyRejectionFairBuilder, self).__init__(stat_source, output_dir, store_failed)
+        #: None or a tuple ("junction"/"clash", list of bad elements)
+        #: if the last attempt was abandoned early.
+        self._early_failure = None
+        #: The nodes built during the last attempt
+        self._built_nodes = []
+        #: The cached result of _check_schedule and what it was computed for.
+        self._schedule = None
+        self._schedule_for = None
+
+    def _junction_checks(self, sm):
+        """
+        A list of tuples (broken ml-segment, multiloop) in the order in which
+        they are checked by sm.fulfills_junction_energy
+        """
+        mst = sm.bg.get_mst()
+        return [ (loop, mloop) for mloop in fbtopo.mlonly_multiloops(sm.bg) for loop in mloop
+                 if loop not in mst and loop in sm.junction_constraint_energy ]
+
+    def _check_schedule(self, sm):
+        """
+        A list of tuples (stem, checks), in build order. Once the stem is built,
+        the junctions of the broken ml-segments in checks
+        (see `_junction_checks`) are fully determined.
+        """
+        plan = sm.build_plan()
+        energies = sorted(sm.junction_constraint_energy.keys())
+        if (self._schedule_for is None or self._schedule_for[0] is not sm
+                or self._schedule_for[1] is not plan.build_order or self._schedule_for[2] != energies):
+            unchecked = self._junction_checks(sm)
+            built = [ plan.steps[0][0] ] if plan.steps else []
+            self._schedule = []
+            for s1, loop, stem, s1b_s1e, reverse in plan.steps:
+                built += [ loop, stem ]
+                if not unchecked:
+                    break
+                determined = _determined_broken_ml_segments(built, sm.bg)
+                checks = [ check for check in unchecked if check[0] in determined ]
+                if checks:
+                    unchecked = [ check for check in unchecked if check[0] not in determined ]
+                    self._schedule.append((stem, checks))
+            self._schedule_for = (sm, plan.build_order, energies)
+        return self._schedule
+
+    def _attempt_to_build(self, sm):
+        sm.sample_stats(self.stat_source)
+        self._early_failure = None
+        if not all(stem in sm.stems for stem in sm.bg.stem_iterator()):
+            # Building part of the structure requires a structure that was fully built once.
+            sm.new_traverse_and_build()
+            self._built_nodes = list(sm.bg.defines)
+            return
+        schedule = self._check_schedule(sm)
+        plan = sm.build_plan()
+        if not plan.steps:
+            sm.new_traverse_and_build()
+            self._built_nodes = list(sm.bg.defines)
+            return
+        built_nodes = []
+        self._built_nodes = built_nodes
+        for end, checks in schedule + [(plan.steps[-1][2], [])]:
+            if not built_nodes:
+                new_nodes = sm.new_traverse_and_build(start = 'start', end = end)
+            elif built_nodes[-1] != end:
+                new_nodes = sm.new_traverse_and_build(start = built_nodes[-1], end = end)
+            else:
+                new_nodes = []
+            built_nodes += new_nodes
+            for loop, mloop in checks:
+                if sm.junction_constraint_energy[loop].has_violation(sm.bg, nodes=mloop, recent=new_nodes,
+                                                                     sampled_stats=sm.elem_defs):
+                    log.debug("Junction %s is not closed after building %s", mloop, built_nodes)
+                    self._early_failure = ("junction", [loop])
+                    return
+            if (checks and sm.constraint_energy is not None and
+                    sm.constraint_energy.has_violation(sm.bg, nodes=built_nodes, recent=new_nodes)):
+                log.debug("Clash after building %s", built_nodes)
+                self._early_failure = ("clash", sm.constraint_energy.bad_bulges)
+                return
+
+    def _handle_early_failure(self, sm, kind):
+        if self.store_failed is True or self.store_failed == kind:
+            # The structure is needed for storing it.
+            sm.new_traverse_and_build()
+            self._store_failed(sm)
+        elif self.store_failed=="list":
+            self._record_failure("{} {}".format(kind, self._early_failure[1]))
+
+    def _fulfills_junction_energy(self, sm):
+        if self._early_failure is None:
+            return super(EarlyRejectionFairBuilder, self)._fulfills_junction_energy(sm)
+        if self._early_failure[0] == "junction":
+            self._handle_early_failure(sm, "junction")
+            return False
+        return True
+
+    def _fulfills_clash_energy(self, sm):
+        if self._early_failure is None:
+            return super(EarlyRejectionFairBuilder, self)._fulfills_clash_energy(sm)
+        self._handle_early_failure(sm, "clash")
+        return False
+
+class _FailureRecorder(object):
+    """
+    Mixin for FairBuilders in worker processes of the ParallelFairBuilder.
+    Failures are collected in self.failures instead of being written to files.
+    """
+    def _record_failure(self, reason):
+        self.failures.append(("reason", reason))
+
+    def _write_failed(self, cg_string):
+        self.failures.append(("coord", cg_string))
+
+#: The state of a worker process of the ParallelFairBuilder
+_worker = {}
+
+def _init_fair_building_worker(builder_class, builder_kwargs, sm):
+    _worker["builder_class"] = type(str("_Recording{}".format(builder_class.__name__)),
+                                    (_FailureRecorder, builder_class), {})
+    _worker["builder_kwargs"] = builder_kwargs
+    _worker["sm"] = sm
+
+def _fair_building_task(seed, attempts, store_success):
+    """
+    Perform some attempts of fair building in a worker process.
+
+    :returns: A list with one tuple (outcome, data) per attempt. The outcome
+              is "junction", "clash" or "success". For failures, data is a list of
+              failures recorded by the _FailureRecorder, for successes a tuple
+              (elem_defs, cg_string). cg_string is None, unless store_success is True.
+    """
+    random.seed(seed)
+    np.random.seed(seed)
+    # Every task starts from the same state, so the result only depends on the seed.
+    # Samplers for continuouse stats have their own random state, which would
+    # otherwise depend on the tasks this worker performed before.
+    _worker["builder_kwargs"]["stat_source"].reset_statsamplers()
+    builder = _worker["builder_class"](**_worker["builder_kwargs"])
+    sm = _worker["sm"].clone()
+    results = []
+    for i in range(attempts):
+        builder.failures = []
+        builder._attempt_to_build(sm)
+        if not builder._fulfills_junction_energy(sm):
+            results.append(("junction", builder.failures))
+        elif not builder._fulfills_clash_energy(sm):
+            results.append(("clash", builder.failures))
+        else:
+            builder._assign_broken_ml_stats(sm)
+            cg_string = sm.bg.to_cg_string() if store_success else None
+            results.append(("success", (dict(sm.elem_defs), cg_string)))
+    return results
+
+class ParallelFairBuilder(FairBuilder):
+    def __init__(self, stat_source, output_dir = None, store_failed=False, num_workers=None,
+                 attempts_per_task=None, builder_class=FairBuilder, builder_kwargs=None):
+        """
+        A FairBuilder that distributes the attempts to build a structure over
+        a pool of worker processes.
+
+        The attempts are split into tasks of attempts_per_task attempts.
+        Every task gets its own seed, drawn from the random number generator of
+        this process, and the results are used in the order of the tasks.
+        Thus, for a given seed, the same structures are built independent of
+        the number of workers.
+        Failed structures and failure reasons (see store_failed) are recorded
+        by the workers and written by this process.
+
+        :param num_workers: The number of worker processes. Defaults to the number of CPUs.
+        :param attempts_per_task: Defaults to 20. For a BatchedFairBuilder, it defaults
+                                  to its batch_size, because every task uses a new
+                                  builder and the rest of the sampled batch is discarded.
+        :param builder_class: The FairBuilder subclass used in the workers.
+        :param builder_kwargs: Additional keyword arguments for the builder_class.
+        """
+        super(ParallelFairBuilder, self).__init__(stat_source, output_dir, store_failed)
+        if num_workers is None:
+            num_workers = multiprocessing.cpu_count()
+        self.num_workers = num_workers
+        self.builder_class = builder_class
+        self.builder_kwargs = dict(builder_kwargs or {})
+        if attempts_per_task is None:
+            if issubclass(builder_class, BatchedFairBuilder):
+                attempts_per_task = self.builder_kwargs.setdefault("batch_size", 100)
+            else:
+                attempts_per_task = 20
+        self.attempts_per_task = attempts_per_task
+        self.builder_kwargs["stat_source"] = stat_source
+        self.builder_kwargs["store_failed"] = store_failed
+
+    def _attempts(self, sm, max_attempts=None, store_success=False):
+        """
+        A generator over the outcomes of attempts to build sm (see `_fair_building_task`).
+
+        Failures are recorded while iterating.
+        Close the generator when done, to stop the worker processes.
+        """
+        # Only one number is drawn from the global RNG, independent of the number of attempts.
+        seeds = random.Random(random.randint(0, 2**31-1))
+        pool = multiprocessing.Pool(self.num_workers, _init_fair_building_worker,
+                                    (self.builder_class, self.builder_kwargs, sm))
+        remaining = max_attempts
+        try:
+            while remaining is None or remaining > 0:
+                tasks = []
+                for i in range(self.num_workers):
+                    attempts = self.attempts_per_task
+                    if remaining is not None:
+                        attempts = min(attempts, remaining)
+                        remaining -= attempts
+                    if attempts <= 0:
+                        break
+                    tasks.append(pool.apply_async(_fair_building_task,
+                                                  (seeds.randint(0, 2**31-1), attempts, store_success)))
+                for task in tasks:
+                    for outcome, data in task.get():
+                        if outcome != "success":
+                            for kind, failure in data:
+                                if kind == "reason":
+                                    self._record_failure(failure)
+                                else:
+                                    self._write_failed(failure)
+                        yield outcome, data
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def _successful_elem_defs(self, sm, n):
+        successes = []
+        attempts = self._attempts(sm)
+        try:
+            for outcome, data in attempts:
+                if outcome == "success":
+                    successes.append(data[0])
+                    if len(successes) >= n:
+                        break
+        finally:
+            attempts.close()
+        return successes
+
+    def _build_from(self, sm, elem_defs):
+        sm.elem_defs = elem_defs
+        sm.new_traverse_and_build()
+        sm.save_sampled_elems()
+
+    def build(self, sm):
+        elem_defs, = self._successful_elem_defs(sm, 1)
+        self._build_from(sm, elem_defs)
+
+    def build_n(self, sm, n):
+        """
+        Return a list of n initialized copies of the spatial model,
+        which are built in parallel.
+        """
+        models = []
+        for elem_defs in self._successful_elem_defs(sm, n):
+            self._build_from(sm, elem_defs)
+            models.append(sm.clone())
+        return models
+
+    def success_probability(self, sm, target_attempts=None, target_structures=None, store_success = True):
+        if target_attempts is None and target_structures is None:
+            raise ValueError("Need target_structures or target_attempts")
+        attempts = 0
+        junction_failures = 0
+        clashes = 0
+        success = 0
+        outcomes = self._attempts(sm, target_attempts, store_success)
+        try:
+            for outcome, data in outcomes:
+                attempts += 1
+                if outcome == "junction":
+                    junction_failures += 1
+                elif outcome == "clash":
+                    clashes += 1
+                else:
+                    if store_success:
+                        self._write_success(data[1])
+                    success += 1
+                    if target_structures is not None and success>target_structures:
+                        break
+        finally:
+            outcomes.close()
+        log.info("Success_probability for parallel fair building: {} attempts, thereof {} with "
+                 "failed junctions, {} of the remaining structures have clashes, "
+                 "{} were successful.".format(attempts, junction_failures, clashes, success))
+        return success, attempts, junction_failures, clashes
+
 class ChangingMSTBuilder(FairBuilder):
     def _attempt_to_build(self, sm):
         if sm.bg.mst is None:
@@ -463,8 +920,8 @@ class DimerizationBuilder(FairBuilder):
         sm.sample_stats(self.stat_source)
         sm.new_traverse_and_build()
         # We sample each multi-loop independently until it is valid.
-        for multi_loop in sm.bg.find_mlonly_multiloops():
-            if "regular_multiloop" not in sm.bg.describe_multiloop(multi_loop):
+        for multi_loop in fbtopo.mlonly_multiloops(sm.bg):
+            if "regular_multiloop" not in fbtopo.describe_multiloop(sm.bg, multi_loop):
                 log.debug("Loop %s is not included in 'dimerization' procedure, "
                           "because it is not a regular ML", multi_loop)
                 continue
@@ -493,6 +950,22 @@ def update_parser(parser):
                                  help = "Try to build the structure using a fair \n"
                                         "but slow algorithm.\n "
                                         "This flag implies --start-from-scratch")
+    builder_options.add_argument('--fair-batch-size', type=int, default=None,
+                                 help = "Used with --fair-building. Sample stats for \n"
+                                        "this many structures at once and reject \n"
+                                        "open junctions for all of them together.\n"
+                                        "Faster for RNAs with many multiloops.\n"
+                                        "Cannot be combined with --fair-early-rejection.")
+    builder_options.add_argument('--fair-building-workers', type=int, default=None,
+                                 help = "Used with --fair-building. Distribute the \n"
+                                        "attempts to build a structure over this \n"
+                                        "many processes. The result only depends on --seed.")
+    builder_options.add_argument('--fair-early-rejection', action="store_true",
+                                 help = "Used with --fair-building. Build the structure \n"
+                                        "stem by stem and reject it as soon as a \n"
+                                        "built junction is open. Yields the same \n"
+                                        "distribution as --fair-building.\n"
+                                        "Cannot be combined with --fair-batch-size.")
     builder_options.add_argument('--fair-building-dim', action="store_true",
                                  help = "Try to build the structure using an experimental \n"
                                         "fair and slightly faster algorithm.\n "
@@ -506,8 +979,27 @@ def update_parser(parser):
 
 
 def from_args(args, stat_source, out_dir):
+    if args.fair_building and args.fair_batch_size and args.fair_early_rejection:
+        raise ValueError("--fair-batch-size and --fair-early-rejection "
+                         "cannot be used together.")
     if args.fair_building_dim:
         build_function = DimerizationBuilder(stat_source, store_failed="list", output_dir=out_dir).build
+    elif args.fair_building and args.fair_building_workers:
+        if args.fair_batch_size:
+            builder_class, builder_kwargs = BatchedFairBuilder, {"batch_size": args.fair_batch_size}
+        elif args.fair_early_rejection:
+            builder_class, builder_kwargs = EarlyRejectionFairBuilder, {}
+        else:
+            builder_class, builder_kwargs = FairBuilder, {}
+        build_function = ParallelFairBuilder(stat_source, store_failed="list", output_dir=out_dir,
+                                             num_workers=args.fair_building_workers,
+                                             builder_class=builder_class,
+                                             builder_kwargs=builder_kwargs).build
+    elif args.fair_building and args.fair_batch_size:
+        build_function = BatchedFairBuilder(stat_source, store_failed="list", output_dir=out_dir,
+                                            batch_size=args.fair_batch_size).build
+    elif args.fair_building and args.fair_early_rejection:
+        build_function = EarlyRejectionFairBuilder(stat_source, store_failed="list", output_dir=out_dir).build
     elif args.fair_building:
         build_function = FairBuilder(stat_source, store_failed="list", output_dir=out_dir).build
     else:
@@ -15,21 +15,16 @@ import random
 import itertools as it
 import logging
 
-has_warned = set()
-
 log = logging.getLogger(__name__)
 
 def stat_combinations(cg, elems, stat_source, unique = False):
     """
     Yield combinations of stats for the elements.
 
-    If the total number of combinations is large, this samples combinations
-    (with the possibility of duplicates). If the total number of
-    combinations is small, this iterates through all combinations in a
-    pseudorandom order (no duplicates).
-    If the number of combinations is large but not huge,
+    All combinations are yielded exactly once, in a pseudorandom order.
+    Neither the combinations nor the stats are created in advance.
     """
-    choices = { elem : list(stat_source.iterate_stats_for(cg, elem))
+    choices = { elem : stat_source.stat_subset_for(cg, elem)
                 for elem in elems }
     for value in _sample_unique_stat_combinations(choices):
         yield value
@@ -39,28 +34,57 @@ def index_to_sample(index, choices):
     for elem, stats in choices.items():
         c_nr = index%len(stats)
         sampled[elem]=stats[c_nr]
-        index = int(index/len(stats))
+        index = index//len(stats)
     return sampled
 
+class IndexPermutation(object):
+    """
+    A pseudorandom permutation of range(size) that uses constant memory.
+
+    This is a balanced Feistel network on the smallest range of 4**k numbers
+    containing range(size). Values outside of range(size) are mapped again
+    until they fall into range(size) (cycle walking), which keeps the mapping
+    bijective.
+    The keys are drawn from python's random module.
+    """
+    ROUNDS = 4
+    _MASK64 = (1<<64)-1
+    def __init__(self, size):
+        self.size = size
+        self._half_bits = max(1, ((size-1).bit_length()+1)//2)
+        self._half_mask = (1<<self._half_bits)-1
+        self._keys = [ random.getrandbits(64) for _ in range(self.ROUNDS) ]
+
+    def _round_function(self, value, key):
+        # The finalizer of the splitmix64 random number generator
+        value = (value ^ key) & self._MASK64
+        value = ((value ^ (value>>30)) * 0xbf58476d1ce4e5b9) & self._MASK64
+        value = ((value ^ (value>>27)) * 0x94d049bb133111eb) & self._MASK64
+        return (value ^ (value>>31)) & self._half_mask
+
+    def _encrypt(self, value):
+        left = value >> self._half_bits
+        right = value & self._half_mask
+        for key in self._keys:
+            left, right = right, left ^ self._round_function(right, key)
+        return (left << self._half_bits) | right
+
+    def __call__(self, index):
+        if not 0<=index<self.size:
+            raise IndexError("Index {} out of range({})".format(index, self.size))
+        value = self._encrypt(index)
+        while value >= self.size:
+            value = self._encrypt(value)
+        return value
+
 def _sample_unique_stat_combinations(choices):
-    from bitarray import bitarray
     product_size = 1
     for stats in choices.values():
         product_size *= len(stats)
-    if product_size>10**9:
-        if tuple(choices.keys()) not in has_warned:
-            log.warning("Too many stats-combination for unique sampling of %s: %s."
-                        "Sampling with replacement.", choices.keys(), product_size)
-            has_warned.add(tuple(choices.keys()))
-        while True:
-            i = random.randrange(product_size)
-            yield index_to_sample(i, choices)
-    else:
-        found = bitarray(product_size)
-        found.setall(False)
-        while not found.all():
-            i = random.randrange(product_size)
-            if found[i]:
-                continue
-            found[i]=True
-            yield index_to_sample(i, choices)
+    if product_size == 0:
+        return
+    permutation = IndexPermutation(product_size)
+    i = 0
+    while i < product_size: # range() can not hold python 2 longs
+        yield index_to_sample(permutation(i), choices)
+        i += 1
@@ -32,6 +32,7 @@ import scipy.stats
 import scipy.optimize
 import scipy.ndimage
 import scipy.misc
+import scipy.spatial
 import pandas as pd
 
 import Bio.KDTree as kd #KD-Trees for distance-calculations in point-cloud.
@@ -517,6 +518,43 @@ class DistanceExponentialEnergy(EnergyFunction):
 
 
 
+def _virtual_residue_positions(cg, stem):
+    '''
+    The virtual residues of the stem as an array of shape (stem length, 4, 3),
+    with the rows of cg.v3dposs[stem].
+
+    If the stem is linked to the VirtualResidueStore of a SpatialModel,
+    this is a view into the store.
+    '''
+    import fess.builder.models as fbm # models imports this module
+    store = fbm.virtual_residue_store(cg)
+    if store is not None and store.is_linked(cg, stem):
+        return store[stem]
+    return np.array([ cg.v3dposs[stem][i] for i in range(cg.stem_length(stem)) ]).reshape((-1, 4, 3))
+
+def _clash_search_points(cg, stems):
+    '''
+    The points used to find the virtual residues which may clash:
+    Two points per virtual residue, far out in the direction of
+    its left and right nucleotide.
+
+    :returns: A tuple (keys, points). keys is a list of the keys (stem, i, a)
+              of the virtual residues, points an array of shape (len(keys), 3).
+    '''
+    mult = 8
+    keys = []
+    points = []
+    for s in stems:
+        vres = _virtual_residue_positions(cg, s)
+        stem_points = np.empty((len(vres), 2, 3))
+        stem_points[:,0] = vres[:,0] + mult * vres[:,2]
+        stem_points[:,1] = vres[:,0] + mult * vres[:,3]
+        points.append(stem_points.reshape((-1, 3)))
+        keys += [ (s, i, a) for i in range(len(vres)) for a in (1, 0) ]
+    if not points:
+        return keys, np.zeros((0, 3))
+    return keys, np.vstack(points)
+
 class StemVirtualResClashEnergy(EnergyFunction):
     '''
     Determine if the virtual residues clash.
@@ -625,6 +663,39 @@ class StemVirtualResClashEnergy(EnergyFunction):
 
         return clashes
 
+    def _candidate_pairs(self, cg, nodes):
+        """
+        Pairs of virtual residues (stem, i, a) of different, unconnected stems,
+        which are close enough for their atoms to clash.
+        """
+        keys, coords = _clash_search_points(cg, [ d for d in nodes if d[0] == 's' ])
+        self.log.debug("points: %s, nodes %s, defines %s", coords, nodes, cg.defines)
+        clash_pairs = []
+        #kk = ss.KDTree(np.array(l))
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            kdt = kd.KDTree(3)
+            kdt.set_coords(coords)
+            kdt.all_search(10.)
+        #print len(kdt.all_get_indices())
+        #print len(kk.query_pairs(7.))
+        indeces = kdt.all_get_indices()
+        for (ia,ib) in indeces:
+            (s1,i1,a1) = keys[ia]
+            (s2,i2,a2) = keys[ib]
+            if s1 == s2:
+                continue
+            if cg.edges[s1]&cg.edges[s2]:
+                # the stems are connected
+                continue
+            clash_pairs += [((s1,i1,a1), (s2,i2,a2))]
+        return clash_pairs
+
+    def _vra(self, cg, key):
+        if key not in self.vras:
+            self.vras[key] = ftug.virtual_residue_atoms(cg, *key)
+        return self.vras[key]
+
     def eval_energy(self, cg, background=False, nodes = None, **kwargs):
         '''
         Count how many clashes of virtual residues there are.
@@ -641,8 +712,6 @@ class StemVirtualResClashEnergy(EnergyFunction):
         self.bases = dict()
         self.bad_bulges = []
         self.bad_atoms = defaultdict(list)
-        mult = 8
-        points = []
         energy = 0.
 
         if nodes is None:
@@ -653,58 +722,233 @@ class StemVirtualResClashEnergy(EnergyFunction):
             # Special case, if only one stem is present.
             return 0.
 
-        for d in nodes:
-            if d[0] == 's':
-                s = d
-                s_len = cg.stem_length(s)
-                #stem_inv = cg.stem_invs[s]
-                self.log.debug("s %s, slen %s", s, s_len)
-                for i in range(s_len):
-                    (p, v, v_l, v_r) = cg.v3dposs[d][i]
-
-                    points += [(p+ mult * v_l, d, i, 1)]
-                    points += [(p+ mult * v_r, d, i, 0)]
-        self.log.debug("points: %s, nodes %s, defines %s", points, nodes, cg.defines)
-        coords = np.vstack([point[0] for point in points])
-        clash_pairs = []
-        #kk = ss.KDTree(np.array(l))
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore")
-            kdt = kd.KDTree(3)
-            kdt.set_coords(coords)
-            kdt.all_search(10.)
-        #print len(kdt.all_get_indices())
-        #print len(kk.query_pairs(7.))
-        indeces = kdt.all_get_indices()
-        for (ia,ib) in indeces:
-            (s1,i1,a1) = (points[ia][1], points[ia][2], points[ia][3])
-            (s2,i2,a2) = (points[ib][1], points[ib][2], points[ib][3])
-            clash_pairs += [((s1,i1,a1), (s2,i2,a2))]
-            #print("NO NEW NODES: ", sorted(clash_pairs))
+        for key1, key2 in self._candidate_pairs(cg, nodes):
+            self._vra(cg, key1)
+            self._vra(cg, key2)
 
-        #potential_clashes = 0
-        for (s1, i1, a1), (s2,i2,a2) in clash_pairs:
-            #if new_nodes != None:
-            #    if s1 not in new_nodes and s2 not in new_nodes:
-            #        continue
+        energy += self.prefactor * self._virtual_residue_atom_clashes_kd(cg)
+        return energy
 
-            if s1 == s2:
-                continue
+    def has_violation(self, cg, nodes=None, recent=None, **kwargs):
+        '''
+        Whether any virtual residue atoms clash.
 
-            if cg.edges[s1]&cg.edges[s2]:
-                # the stems are connected
-                continue
+        Residue pairs involving the recent elements are checked first and
+        the search stops at the first clashing pair of residues.
+        If they do not clash, the atoms of all candidate residues are
+        compared once (like in eval_energy).
+        '''
+        self.vras = dict()
+        self.bases = dict()
+        self.bad_bulges = []
+        self.bad_atoms = defaultdict(list)
 
-            #potential_clashes += 1
-            #fud.pv('s1,s2')
+        if nodes is None:
+            nodes = cg.defines.keys()
+        if len([stem for stem in nodes if stem[0]=="s"])<2:
+            return False
 
-            if (s1,i1,a1) not in self.vras.keys():
-                self.vras[(s1,i1,a1)] = ftug.virtual_residue_atoms(cg, s1, i1, a1)
-            if (s2,i2,a2) not in self.vras.keys():
-                self.vras[(s2,i2,a2)] = ftug.virtual_residue_atoms(cg, s2, i2, a2)
+        pairs = self._candidate_pairs(cg, nodes)
+        if recent:
+            recent = set(recent)
+            for key1, key2 in pairs:
+                if key1[0] not in recent and key2[0] not in recent:
+                    continue
+                resn1 = cg.stem_side_vres_to_resn(key1[0], key1[2], key1[1])
+                resn2 = cg.stem_side_vres_to_resn(key2[0], key2[2], key2[1])
+                #Adjacent residues cannot clash
+                if abs(resn1 - resn2) == 1:
+                    continue
+                atoms1 = np.array(list(self._vra(cg, key1).values()))
+                atoms2 = np.array(list(self._vra(cg, key2).values()))
+                dists = np.linalg.norm(atoms1[:, np.newaxis, :] - atoms2[np.newaxis, :, :], axis=2)
+                if np.any(dists <= self.adjustment):
+                    self.log.debug("Early clash between %s and %s", key1, key2)
+                    self.bad_bulges.append(tuple(sorted([key1[0], key2[0]])))
+                    return True
+        for key1, key2 in pairs:
+            self._vra(cg, key1)
+            self._vra(cg, key2)
+        return self._virtual_residue_atom_clashes_kd(cg) > 0
+
+class ClashStack(object):
+    """
+    The clashes of a StemVirtualResClashEnergy for a structure that is
+    built segment by segment, e.g. during step-wise building with backtracking.
 
-        energy += self.prefactor * self._virtual_residue_atom_clashes_kd(cg)
-        return energy
+    `push` only compares the virtual residues of the new stems with the
+    existing ones and `truncate` discards the contributions of the
+    most recently pushed nodes, so the clash state of a common prefix
+    is never re-evaluated.
+
+    After every operation, `clashes` and the set of `bad_bulges` are the
+    same as for `energy.eval_energy(cg, nodes=self.nodes)`.
+    The stems in self.nodes must not be moved while they are on the stack.
+    """
+    def __init__(self, energy, cg):
+        self.energy = energy
+        self.cg = cg
+        #: The pushed nodes, in order
+        self.nodes = []
+        # One dict per pushed segment
+        self._segments = []
+        # Virtual residues (stem, i, a) that are in any candidate pair.
+        self._candidates = set()
+        # Whether two stems are connected (see StemVirtualResClashEnergy._candidate_pairs)
+        self._connected = {}
+
+    @classmethod
+    def for_energy(cls, energy, cg):
+        """
+        A ClashStack for the energy, or None, if the energy
+        is not a single StemVirtualResClashEnergy (or a CombinedEnergy
+        containing only one StemVirtualResClashEnergy).
+        """
+        if energy is None:
+            return None
+        if hasattr(energy, "iterate_energies"):
+            energies = list(energy.iterate_energies())
+        else:
+            energies = [energy]
+        if len(energies) == 1 and isinstance(energies[0], StemVirtualResClashEnergy):
+            return cls(energies[0], cg)
+        return None
+
+    @property
+    def clashes(self):
+        """The number of clashing pairs of atoms"""
+        return sum(segment["clashes"] for segment in self._segments)
+
+    @property
+    def bad_bulges(self):
+        """A list of pairs of clashing stems"""
+        bad_bulges = []
+        for segment in self._segments:
+            for pair in segment["bad_bulges"]:
+                if pair not in bad_bulges:
+                    bad_bulges.append(pair)
+        return bad_bulges
+
+    def _is_connected(self, s1, s2):
+        try:
+            return self._connected[s1, s2]
+        except KeyError:
+            connected = self._connected[s1, s2] = self._connected[s2, s1] = bool(self.cg.edges[s1] & self.cg.edges[s2])
+            return connected
+
+    def _points(self, stems):
+        """
+        The points used for the search of candidate pairs,
+        like in StemVirtualResClashEnergy._candidate_pairs
+        """
+        return _clash_search_points(self.cg, stems)
+
+    def _new_candidates(self, keys, points):
+        """
+        The virtual residues that become candidates
+        through pairs with the new keys and points.
+
+        :returns: A set of keys and the KD-tree of the new points (or None)
+        """
+        new_candidates = set()
+        if not keys:
+            return new_candidates, None
+        tree = scipy.spatial.cKDTree(points)
+        # Only the new points are compared to the trees of the old segments.
+        partners = [ (segment["keys"], segment["point_tree"]) for segment in self._segments
+                     if segment["point_tree"] is not None ]
+        partners.append((keys, tree))
+        for partner_keys, partner_tree in partners:
+            neighbors = tree.query_ball_tree(partner_tree, 10.)
+            for ia, ib in ((ia, ib) for ia, close in enumerate(neighbors) for ib in close):
+                key1 = keys[ia]
+                key2 = partner_keys[ib]
+                if key1[0] == key2[0] or self._is_connected(key1[0], key2[0]):
+                    continue
+                for key in (key1, key2):
+                    if key not in self._candidates:
+                        new_candidates.add(key)
+        return new_candidates, tree
+
+    def _atoms(self, keys):
+        """
+        The coordinates of all atoms of the virtual residues in keys
+        and the virtual residue (as an index into keys) for every atom.
+        """
+        coords = []
+        owners = []
+        for j, key in enumerate(keys):
+            atoms = list(ftug.virtual_residue_atoms(self.cg, *key).values())
+            coords += atoms
+            owners += [j]*len(atoms)
+        return np.array(coords).reshape((-1, 3)), np.array(owners, dtype=int)
+
+    def push(self, nodes):
+        """
+        Add nodes that were built after the nodes already on the stack.
+
+        :returns: The number of new clashing atom pairs.
+        """
+        nodes = list(nodes)
+        keys, points = self._points([ node for node in nodes if node[0] == "s" ])
+        new_candidates, point_tree = self._new_candidates(keys, points)
+        new_candidates = sorted(new_candidates)
+        atoms, owners = self._atoms(new_candidates)
+        clashes = 0
+        bad_bulges = []
+        atom_tree = None
+        if new_candidates:
+            atom_tree = scipy.spatial.cKDTree(atoms)
+            # Only the new atoms are compared to the trees of the old segments.
+            partners = [ (segment["candidates"], segment["owners"], segment["atom_tree"], False)
+                         for segment in self._segments if segment["atom_tree"] is not None ]
+            partners.append((new_candidates, owners, atom_tree, True))
+            for partner_keys, partner_owners, partner_tree, is_new in partners:
+                neighbors = atom_tree.query_ball_tree(partner_tree, self.energy.adjustment)
+                for ia, ib in ((ia, ib) for ia, close in enumerate(neighbors) for ib in close):
+                    if is_new and ib <= ia:
+                        # Pairs of two new atoms are only counted once
+                        continue
+                    key1 = new_candidates[owners[ia]]
+                    key2 = partner_keys[partner_owners[ib]]
+                    if key1[0] == key2[0] or self._is_connected(key1[0], key2[0]):
+                        continue
+                    resn1 = self.cg.stem_side_vres_to_resn(key1[0], key1[2], key1[1])
+                    resn2 = self.cg.stem_side_vres_to_resn(key2[0], key2[2], key2[1])
+                    #Adjacent residues cannot clash
+                    if abs(resn1 - resn2) == 1:
+                        continue
+                    clash_pair = tuple(sorted([key1[0], key2[0]]))
+                    if clash_pair not in bad_bulges:
+                        bad_bulges.append(clash_pair)
+                    clashes += 1
+        self._candidates.update(new_candidates)
+        self._segments.append({"nodes": nodes, "keys": keys, "point_tree": point_tree,
+                               "candidates": new_candidates, "owners": owners,
+                               "atom_tree": atom_tree,
+                               "clashes": clashes, "bad_bulges": bad_bulges})
+        self.nodes += nodes
+        return clashes
+
+    def pop(self):
+        """
+        Remove the most recently pushed segment.
+
+        :returns: The nodes of this segment
+        """
+        segment = self._segments.pop()
+        self._candidates.difference_update(segment["candidates"])
+        del self.nodes[len(self.nodes)-len(segment["nodes"]):]
+        return segment["nodes"]
+
+    def truncate(self, length):
+        """
+        Discard everything that was pushed after the first `length` nodes.
+        """
+        while len(self.nodes) > length:
+            nodes = self.pop()
+            if len(self.nodes) < length:
+                self.push(nodes[:length-len(self.nodes)])
 
 class RoughJunctionClosureEnergy(EnergyFunction):
     _shortname = "JDIST"
@@ -732,23 +976,56 @@ class RoughJunctionClosureEnergy(EnergyFunction):
         energy = 0.
 
         for bulge in all_bulges:
-            bl = cg.get_bulge_dimensions(bulge)[0]
-            log.debug("Getting junction closure dist for %s", bulge)
-            dist = ftug.junction_virtual_atom_distance(cg, bulge)
-            #
-            #cutoff_distance = (bl) * 5.9 + 13.4
-            #cutoff_distance = (bl) * 5.908 + 11.309
-            #cutoff_distance = (bl) * 6.4 + 6.4
-            cutoff_distance = (bl) * 6.22 + 14.0 #Peter's cyclic coordinate descent
-            # Note: DOI: 10.1021/jp810014s claims that a typical MeO-P bond is 1.66A long.
-            cutoff_distance*=self.adjustment
+            dist, cutoff_distance = self._distance_and_cutoff(cg, bulge)
             if (dist > cutoff_distance):
-                self.log.debug("Junction closure: dist {} > cutoff {} for bulge {} with length {}".format(dist, cutoff_distance, bulge, bl))
                 self.bad_bulges += [bulge]
                 energy += (dist - cutoff_distance) * self.prefactor
 
         return energy
 
+    def cutoff_distance(self, cg, bulge):
+        """
+        The maximal distance between the virtual atoms
+        at both ends of the ml-segment bulge.
+        """
+        bl = cg.get_bulge_dimensions(bulge)[0]
+        #
+        #cutoff_distance = (bl) * 5.9 + 13.4
+        #cutoff_distance = (bl) * 5.908 + 11.309
+        #cutoff_distance = (bl) * 6.4 + 6.4
+        cutoff_distance = (bl) * 6.22 + 14.0 #Peter's cyclic coordinate descent
+        # Note: DOI: 10.1021/jp810014s claims that a typical MeO-P bond is 1.66A long.
+        cutoff_distance*=self.adjustment
+        return cutoff_distance
+
+    def _distance_and_cutoff(self, cg, bulge):
+        bl = cg.get_bulge_dimensions(bulge)[0]
+        log.debug("Getting junction closure dist for %s", bulge)
+        dist = ftug.junction_virtual_atom_distance(cg, bulge)
+        cutoff_distance = self.cutoff_distance(cg, bulge)
+        if (dist > cutoff_distance):
+            self.log.debug("Junction closure: dist {} > cutoff {} for bulge {} with length {}".format(dist, cutoff_distance, bulge, bl))
+        return dist, cutoff_distance
+
+    def has_violation(self, cg, nodes=None, recent=None, **kwargs):
+        """
+        Whether any junction is not closed. Stops at the first open junction,
+        starting with junctions next to the recent elements.
+        """
+        if nodes == None:
+            nodes = cg.defines.keys()
+        self.bad_bulges = []
+        all_bulges = sorted(set(d for d in nodes if d[0] == 'm'))
+        if recent:
+            recent = set(recent)
+            all_bulges.sort(key=lambda bulge: bulge not in recent and not (cg.edges[bulge] & recent))
+        for bulge in all_bulges:
+            dist, cutoff_distance = self._distance_and_cutoff(cg, bulge)
+            if dist > cutoff_distance:
+                self.bad_bulges = [bulge]
+                return True
+        return False
+
 class MaxEnergyValue(EnergyFunction):
     _shortname = "MAX"
     can_constrain = "junction"
@@ -1895,6 +2172,10 @@ class CombinedEnergy(object):
             self.__dict__[name]=val
 
     def __getattr__(self, name):
+        # During copying and unpickling, attributes are looked up
+        # before self.energies exists.
+        if name == "energies" or (name.startswith("__") and name.endswith("__")):
+            raise AttributeError(name)
         #If no energies are present, do nothing (DON'T raise an error)
         if not self.energies:
             log.info("Combined Energy has no energies and returns CombinedFunction for attr %s", name)
@@ -2025,6 +2306,27 @@ class CombinedEnergy(object):
         log.debug("{} [{}] at {}: total energy is {}".format(str(self), self.shortname, id(self), total_energy))
         return total_energy
 
+    def has_violation(self, cg, nodes=None, recent=None, **kwargs):
+        """
+        Whether any of the member energies has a violation.
+
+        Stops at the first violating energy. The energy that was violated last
+        time is checked first, because it is the most likely one to fail again.
+        """
+        energies = list(self.energies)
+        last = self.__dict__.get("_last_violating")
+        if last in energies:
+            energies.remove(last)
+            energies.insert(0, last)
+        for energy in energies:
+            energy.bad_bulges = []
+        for energy in energies:
+            if energy.has_violation(cg, nodes=nodes, recent=recent, **kwargs):
+                log.debug("%s has a violation", energy.shortname)
+                super(CombinedEnergy, self).__setattr__("_last_violating", energy)
+                return True
+        return False
+
     def __str__(self):
         out_str = 'CombinedEnergy('
         for en in self.energies:
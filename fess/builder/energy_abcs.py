@@ -145,6 +145,20 @@ class EnergyFunction(with_metaclass(ABCMeta, object)):
     def eval_energy(self, cg, background=True, nodes=None, **kwargs):
         raise NotImplementedError
 
+    def has_violation(self, cg, nodes=None, recent=None, **kwargs):
+        """
+        Whether the energy is greater than zero, i.e. a constraint is violated.
+
+        Constraint energies should override this to stop at the first
+        violation, instead of computing the full energy.
+        self.bad_bulges only has to contain the violation that was found.
+
+        :param recent: A collection of elements that were moved recently.
+                       If given, checks involving these elements should be done first,
+                       because they are the most likely to fail.
+        """
+        return self.eval_energy(cg, nodes=nodes, **kwargs) > 0
+
     def dump_measures(self, base_directory, iteration=None):
         '''
         Dump all of the accepted measures collected so far
@@ -14,6 +14,7 @@ import glob
 import copy
 import logging
 import textwrap
+import weakref
 
 import Bio.PDB as bpdb
 import Bio.PDB.Chain as bpdbc
@@ -29,12 +30,20 @@ import forgi.threedee.utilities.vector as ftuv
 import forgi.utilities.debug as fud
 
 import fess.builder.config as cbc
+import fess.builder.topology as fbtopo
 import fess.builder.energy as fbe # Used for commandline-parsing
 from fess.builder._commandline_helper import replica_substring
 
 
 log = logging.getLogger(__name__)
 
+try:
+    from functools import lru_cache #python 3.2
+except ImportError:
+    try:
+        from backports.functools_lru_cache import lru_cache #pip install backports.functools_lru_cache
+    except ImportError:
+        lru_cache = lambda *args, **kwargs: lambda x: x #No-op decorator taking arguments
 
 class StemModel:
     '''
@@ -98,6 +107,159 @@ class StemModel:
         '''
         return ftuv.magnitude(self.mids[1] - self.mids[0])
 
+#: The VirtualResidueStore every BulgeGraph was last linked to.
+_virtual_residue_stores = weakref.WeakKeyDictionary()
+
+def virtual_residue_store(bg):
+    '''
+    The VirtualResidueStore bg was last linked to or None.
+
+    Use `VirtualResidueStore.is_linked` to test, whether the
+    virtual residues of a stem are still views into the store.
+    '''
+    return _virtual_residue_stores.get(bg)
+
+class VirtualResidueStore(object):
+    '''
+    The virtual residues of all stems of a BulgeGraph in contiguous arrays.
+
+    The virtual residue i of stem s is in row `index[s]+i` of all arrays.
+    Once linked, the dictionaries of the BulgeGraph (bg.v3dposs, bg.vposs,
+    bg.vvecs, bg.vbases and bg.vinvs) hold views into these arrays.
+
+    :var v3dposs: An array of shape (n, 4, 3). Like the tuples in bg.v3dposs:
+                  The position, the vector to the base and the vectors to the
+                  left and right nucleotide of every virtual residue.
+    :var vbases, vinvs: Arrays of shape (n, 3, 3) with the basis and inverse
+                        basis of every virtual residue.
+    '''
+    def __init__(self, bg):
+        self.index = {}
+        self.lengths = {}
+        n = 0
+        for stem in sorted(bg.stem_iterator()):
+            self.index[stem] = n
+            self.lengths[stem] = bg.stem_length(stem)
+            n += self.lengths[stem]
+        self.v3dposs = np.zeros((n, 4, 3))
+        self.vbases = np.zeros((n, 3, 3))
+        self.vinvs = np.zeros((n, 3, 3))
+
+    def copy(self):
+        '''
+        A copy of the store with copies of all arrays. The copy is not linked to any BulgeGraph.
+        '''
+        new_store = copy.copy(self)
+        new_store.v3dposs = np.copy(self.v3dposs)
+        new_store.vbases = np.copy(self.vbases)
+        new_store.vinvs = np.copy(self.vinvs)
+        return new_store
+
+    def rows(self, stem):
+        return slice(self.index[stem], self.index[stem]+self.lengths[stem])
+
+    def __getitem__(self, stem):
+        '''
+        A view of the virtual residues of the stem (see `v3dposs`)
+        '''
+        return self.v3dposs[self.rows(stem)]
+
+    def is_linked(self, bg, stem):
+        '''
+        Whether or not the virtual residues of the stem in bg are views into this store.
+        '''
+        try:
+            return all(bg.vbases[stem][i].base is self.vbases for i in range(self.lengths[stem]))
+        except KeyError:
+            return False
+
+    def load(self, bg, stems):
+        '''
+        Copy the virtual residues of the stems from bg to the store and link them.
+        '''
+        for stem in stems:
+            start = self.index[stem]
+            for i in range(self.lengths[stem]):
+                self.v3dposs[start+i] = bg.v3dposs[stem][i]
+                self.vbases[start+i] = bg.vbases[stem][i]
+                self.vinvs[start+i] = bg.vinvs[stem][i]
+        self.link(bg, stems)
+
+    def link(self, bg, stems):
+        '''
+        Replace the virtual residues of the stems in bg by views into the store.
+        '''
+        _virtual_residue_stores[bg] = self
+        for stem in stems:
+            start = self.index[stem]
+            for i in range(self.lengths[stem]):
+                vpos = self.v3dposs[start+i]
+                bg.v3dposs[stem][i] = (vpos[0], vpos[1], vpos[2], vpos[3])
+                bg.vposs[stem][i] = vpos[0]
+                bg.vvecs[stem][i] = vpos[1]
+                bg.vbases[stem][i] = self.vbases[start+i]
+                bg.vinvs[stem][i] = self.vinvs[start+i]
+
+    def transform(self, bg, stems, transform):
+        '''
+        Move the virtual residues of the stems (in place) by the rigid
+        transformation transform (a 4x4 homogeneous matrix) and link them to bg.
+        '''
+        if not stems:
+            return
+        rows = np.concatenate([np.arange(self.index[stem], self.index[stem]+self.lengths[stem])
+                               for stem in stems])
+        rotation = transform[:3,:3].transpose()
+        # Positions are moved, the remaining vectors and all bases are only rotated.
+        v3dposs = np.dot(self.v3dposs[rows], rotation)
+        v3dposs[:,0] += transform[:3,3]
+        self.v3dposs[rows] = v3dposs
+        self.vbases[rows] = np.dot(self.vbases[rows], rotation)
+        self.vinvs[rows] = np.dot(self.vinvs[rows], rotation)
+        for stem in stems:
+            bg.bases[stem] = np.dot(bg.bases[stem], rotation)
+            bg.stem_invs[stem] = np.dot(bg.stem_invs[stem], rotation)
+        self.link(bg, stems)
+
+class BuildPlan(object):
+    '''
+    The build order of a BulgeGraph compiled into placement steps,
+    so building does not have to query the BulgeGraph for the topology.
+
+    A BuildPlan is only valid for the build_order it was compiled from.
+    It has to be recompiled whenever the minimum spanning tree changes.
+
+    :var steps: A list of tuples (s1, loop, s2, (s1b, s1e), reverse).
+                s2 is placed on side s1e of s1, according to the stat of the loop.
+                If reverse is True, the placed stem has to be reversed.
+    :var stem_step: A dictionary {stem: index of the step that places the stem}
+    :var loop_step: A dictionary {loop: index of the step that uses the loop}
+    '''
+    def __init__(self, bg, build_order):
+        self.build_order = build_order
+        self.steps = []
+        self.stem_step = {}
+        self.loop_step = {}
+        for i, (s1, l, s2) in enumerate(build_order):
+            ang_type = bg.connection_type(l, [s1,s2])
+            connection_ends = bg.connection_ends(ang_type)
+            # get the direction of the first stem (which is used as a
+            # coordinate system)
+            if connection_ends[0] == 0:
+                s1b_s1e = (1, 0)
+            else:
+                s1b_s1e = (0, 1)
+            # check which way the newly connected stem was added
+            # if its 1-end was added, the its coordinates need to
+            # be reversed to reflect the fact it was added backwards
+            reverse = (connection_ends[1] == 1)
+            self.steps.append((s1, l, s2, s1b_s1e, reverse))
+            self.stem_step[s2] = i
+            self.loop_step[l] = i
+
+    def __len__(self):
+        return len(self.steps)
+
 class BulgeModel:
     '''
     A way of encapsulating a coarse grain 3D loop.
@@ -201,6 +363,55 @@ def extract_stem_from_chain(chain, stem_def):
 
     return c
 
+def stem_placement_transform(angle_stat):
+    '''
+    The placement of a new stem relative to the previous stem as a 4x4 homogeneous matrix.
+
+    Relative to the basis of the previous stem, the columns of the rotation part
+    are the direction of the new stem, its first twist and their cross product.
+    The translation part is the start of the new stem.
+
+    @param angle_stat: The AngleStat that specifies how the new stem will
+                       be oriented with respect to the previous stem.
+    @return: A read-only array, shared by all stats with the same parameters.
+    '''
+    return _stem_placement_transform(angle_stat.r1, angle_stat.u1, angle_stat.v1,
+                                     angle_stat.u, angle_stat.v, angle_stat.t)
+
+# Stats are not modified during sampling, so the transforms for the parameters
+# of the sampled stats are computed only once.
+# The cache is keyed by the parameters and not stored on the stat objects,
+# which are compared and deep-copied a lot.
+@lru_cache(maxsize=10000)
+def _stem_placement_transform(r1, u1, v1, u, v, t):
+    identity = np.eye(3)
+    start_location = ftug.stem2_pos_from_stem1_1(identity, (r1, u1, v1))
+    stem_orientation = ftug.stem2_orient_from_stem1_1(identity, (1., u, v))
+    twist1 = ftug.twist2_orient_from_stem1_1(identity, (u, v, t))
+    transform = np.eye(4)
+    transform[:3,:3] = ftuv.create_orthonormal_basis(stem_orientation, twist1).transpose()
+    transform[:3,3] = start_location
+    transform.flags.writeable = False
+    return transform
+
+def stem_placement_transforms(angle_stats):
+    '''
+    The stem_placement_transform for every AngleStat in a sequence.
+
+    Stats from a stats cache are not created, if the sequence
+    provides their parameters.
+
+    @return: An array of shape (K, 4, 4)
+    '''
+    try:
+        params = angle_stats.params
+    except AttributeError:
+        transforms = [stem_placement_transform(stat) for stat in angle_stats]
+    else:
+        transforms = [_stem_placement_transform(r1, u1, v1, u, v, t)
+                      for u, v, t, r1, u1, v1 in params.tolist()]
+    return np.array(transforms).reshape((-1, 4, 4))
+
 def place_new_stem(prev_stem, stem_params, bulge_params, s1b_s1e, stem_name=''):
     '''
     Place a new stem with a particular orientation with respect
@@ -215,32 +426,197 @@ def place_new_stem(prev_stem, stem_params, bulge_params, s1b_s1e, stem_name=''):
     s1b, s1e = s1b_s1e
     stem = StemModel()
 
-    transposed_stem1_basis = ftuv.create_orthonormal_basis(prev_stem.vec((s1b, s1e)), prev_stem.twists[s1e]).transpose()
-    log.debug("Place new stem: transposed_stem1_basis: %s", transposed_stem1_basis)
-    start_location = ftug.stem2_pos_from_stem1_1(transposed_stem1_basis, bulge_params.position_params())
-    log.debug("Start location: %s", start_location)
-    stem_orientation = ftug.stem2_orient_from_stem1_1(transposed_stem1_basis, [stem_params.phys_length] + list(bulge_params.orientation_params()))
-    log.debug("Stem_orientation: %s", stem_orientation)
-    twist1 = ftug.twist2_orient_from_stem1_1(transposed_stem1_basis, bulge_params.twist_params())
-    log.debug("twist1: %s", twist1)
-
-    #assert np.allclose(np.dot(stem_orientation, twist1), 0)
-
-    mid1 = prev_stem.mids[s1e] + start_location
-    mid2 = mid1 + stem_orientation
-
-
+    stem1_frame = np.eye(4)
+    stem1_frame[:3,:3] = ftuv.create_orthonormal_basis(prev_stem.vec((s1b, s1e)), prev_stem.twists[s1e]).transpose()
+    stem1_frame[:3,3] = prev_stem.mids[s1e]
+    stem2_frame = np.dot(stem1_frame, stem_placement_transform(bulge_params))
+    log.debug("Place new stem: frame of new stem: %s", stem2_frame)
 
+    mid1 = stem2_frame[:3,3]
+    mid2 = mid1 + stem2_frame[:3,0] * stem_params.phys_length
     stem.mids = (mid1, mid2)
 
     log.debug("stem_params.twist_angle: %s", stem_params.twist_angle)
-    twist2 = ftug.twist2_from_twist1(stem_orientation, twist1, stem_params.twist_angle)
-    log.debug("twist2: %s", twist2)
+    twist1 = stem2_frame[:3,1]
+    twist2 = np.dot(stem2_frame[:3,:3], [0., math.cos(stem_params.twist_angle), math.sin(stem_params.twist_angle)])
     stem.twists = (twist1, twist2)
 
-    #assert np.allclose(np.dot(stem_orientation, twist2), 0)
     return stem
 
+def _stem_stat_arrays(stem_stats):
+    lengths = np.array([stat.phys_length for stat in stem_stats], dtype=float)
+    angles = np.array([stat.twist_angle for stat in stem_stats], dtype=float)
+    frames = np.zeros((len(stem_stats), 4, 4))
+    frames[:,3,3] = 1
+    return lengths, np.cos(angles), np.sin(angles), frames
+
+def stem_side_frames(stem_stats, s1b_s1e):
+    '''
+    The frames used by place_new_stem for placing a stem on side s1e
+    of a stem, relative to the frame of that stem (see `stem_frame`).
+
+    @param stem_stats: A list of K StemStats of the stem.
+    @return: An array of shape (K, 4, 4)
+    '''
+    lengths, cos, sin, frames = _stem_stat_arrays(stem_stats)
+    if tuple(s1b_s1e) == (0, 1):
+        # Along the stem, at its end, with twists[1] as second axis.
+        frames[:,0,0] = 1
+        frames[:,1,1] = cos
+        frames[:,2,1] = sin
+        frames[:,1,2] = -sin
+        frames[:,2,2] = cos
+        frames[:,0,3] = lengths
+    else:
+        # Against the stem, at its start, with twists[0] as second axis.
+        frames[:,0,0] = -1
+        frames[:,1,1] = 1
+        frames[:,2,2] = -1
+    return frames
+
+def reversed_stem_frames(stem_stats):
+    '''
+    The frames of reversed stems (see `StemModel.reverse`),
+    relative to the frames of the stems.
+
+    @param stem_stats: A list of K StemStats of the stem.
+    @return: An array of shape (K, 4, 4)
+    '''
+    lengths, cos, sin, frames = _stem_stat_arrays(stem_stats)
+    frames[:,0,0] = -1
+    frames[:,1,1] = cos
+    frames[:,2,1] = sin
+    frames[:,1,2] = sin
+    frames[:,2,2] = -cos
+    frames[:,0,3] = lengths
+    return frames
+
+def stem_frame(stem):
+    '''
+    The coordinate system of a stem as a 4x4 homogeneous matrix.
+
+    The origin is at mids[0], the first axis points along the stem
+    and the second axis is the part of twists[0] orthogonal to the stem.
+    '''
+    frame = np.eye(4)
+    frame[:3,:3] = ftuv.create_orthonormal_basis(stem.vec(), stem.twists[0]).transpose()
+    frame[:3,3] = stem.mids[0]
+    return frame
+
+def rigid_transform_between(old_stem, new_stem):
+    '''
+    The 4x4 homogeneous matrix of the rigid transformation, that moves
+    old_stem onto new_stem. Both stems need to have the same length.
+    '''
+    old_frame = stem_frame(old_stem)
+    inverse = np.eye(4)
+    inverse[:3,:3] = old_frame[:3,:3].transpose()
+    inverse[:3,3] = -np.dot(old_frame[:3,:3].transpose(), old_frame[:3,3])
+    return np.dot(stem_frame(new_stem), inverse)
+
+def transform_stems(stems, transform):
+    '''
+    Apply a rigid transformation to several stems at once.
+
+    @param stems: A list of StemModels
+    @param transform: A 4x4 homogeneous matrix.
+    @return: A list of new StemModels
+    '''
+    coords = np.array([[stem.mids[0], stem.mids[1], stem.twists[0], stem.twists[1]]
+                       for stem in stems])
+    rotation = transform[:3,:3].transpose()
+    mids = np.dot(coords[:,:2].reshape(-1,3), rotation).reshape(-1,2,3) + transform[:3,3]
+    twists = np.dot(coords[:,2:].reshape(-1,3), rotation).reshape(-1,2,3)
+    return [StemModel(stem.name, (mids[i,0], mids[i,1]), (twists[i,0], twists[i,1]))
+            for i, stem in enumerate(stems)]
+
+#: Attributes of a CoarseGrainRNA that change while a structure is built or sampled.
+#: All other attributes (the secondary structure, sequence,...) are never modified.
+_CG_MUTABLE_ATTRIBUTES = ["coords", "twists", "sampled", "infos", "longrange",
+                          "build_order", "mst", "ang_types", "chains", "_virtual_atom_cache"]
+#: Attributes of a CoarseGrainRNA that hold (dictionaries of) dictionaries of arrays.
+_CG_ARRAY_DICT_ATTRIBUTES = ["vposs", "vbase", "vsugar", "vbackbone", "vbases", "vvecs",
+                             "v3dposs", "vinvs", "bases", "stem_invs"]
+
+def _copy_array_dict(d):
+    '''
+    Copy a (nested) dictionary of arrays or tuples of arrays,
+    without going through the generic deepcopy machinery.
+    '''
+    if isinstance(d, defaultdict):
+        new_d = defaultdict(d.default_factory)
+    else:
+        new_d = type(d)()
+    for key, value in d.items():
+        if isinstance(value, dict):
+            new_d[key] = _copy_array_dict(value)
+        elif isinstance(value, np.ndarray):
+            new_d[key] = np.copy(value)
+        elif isinstance(value, tuple):
+            new_d[key] = tuple(np.copy(v) for v in value)
+        else:
+            new_d[key] = copy.deepcopy(value)
+    return new_d
+
+def clone_cg(cg):
+    '''
+    A copy of the CoarseGrainRNA, that is much cheaper than `copy.deepcopy`.
+
+    Only the coordinates, virtual residues and the other attributes that change
+    during building and sampling (see `_CG_MUTABLE_ATTRIBUTES`) are copied.
+    The secondary structure and sequence are shared with the original.
+    '''
+    new_cg = copy.copy(cg)
+    memo = {id(cg): new_cg}
+    for attr in _CG_MUTABLE_ATTRIBUTES:
+        if attr in cg.__dict__:
+            setattr(new_cg, attr, copy.deepcopy(getattr(cg, attr), memo))
+    for attr in _CG_ARRAY_DICT_ATTRIBUTES:
+        if attr in cg.__dict__:
+            setattr(new_cg, attr, _copy_array_dict(getattr(cg, attr)))
+    # Changing the coordinates has to invalidate the virtual residues of the clone,
+    # not of the original.
+    new_cg.coords.on_change = new_cg.coords._extended_on_change(new_cg.reset_vatom_cache)
+    new_cg.twists.on_change = new_cg.reset_vatom_cache
+    return new_cg
+
+def local_virtual_atom(bg, stem, pos, atom, stem_stat):
+    """
+    The position of a virtual atom of a nucleotide in a stem, relative to the
+    frame of the stem (see `fess.builder.models.stem_frame`).
+
+    It only depends on the stats of the stem, not on the placement of the stem.
+    """
+    def compute():
+        scratch = fbtopo.cached(bg, "scratch_cg", lambda: clone_cg(bg))
+        scratch.coords[stem] = (np.zeros(3), np.array([stem_stat.phys_length, 0., 0.]))
+        scratch.twists[stem] = (np.array([0., 1., 0.]),
+                                np.array([0., math.cos(stem_stat.twist_angle),
+                                          math.sin(stem_stat.twist_angle)]))
+        ftug.add_virtual_residues(scratch, stem)
+        return np.array(ftug.virtual_atoms(scratch, sidechain=False)[pos][atom])
+    return fbtopo.cached(bg, ("local_virtual_atom", stem, pos, atom,
+                              stem_stat.phys_length, stem_stat.twist_angle), compute)
+
+def junction_atom_positions(bg, stem, bulge, frames, stem_stats):
+    """
+    The position of the virtual atom of stem at the ml-segment bulge
+    (see `ftug.junction_virtual_atom_distance`) for K frames of the stem.
+
+    :param frames: An array of shape (K, 4, 4) (see `stem_frame`)
+    :param stem_stats: A list with the K StemStats of the stem
+                       or a single StemStat used for all frames.
+    :returns: An array of shape (K, 3)
+    """
+    i, _ = bg._get_sides_plus(stem, bulge)
+    pos = bg.defines[stem][i]
+    atom = "P" if i in (0, 2) else "O3'"
+    if isinstance(stem_stats, list):
+        local = np.array([local_virtual_atom(bg, stem, pos, atom, stat) for stat in stem_stats])
+        return np.einsum("kij,kj->ki", frames[:,:3,:3], local) + frames[:,:3,3]
+    local = local_virtual_atom(bg, stem, pos, atom, stem_stats)
+    return np.dot(frames[:,:3,:3], local) + frames[:,:3,3]
+
 def create_empty_energy():
     log.debug("Creating empty Energy for junction_constraint_energy-fdefaultdict")
     return fbe.CombinedEnergy()
@@ -275,6 +651,23 @@ class SpatialModel:
         self.junction_constraint_energy = defaultdict(create_empty_energy)
 
         self.elem_defs=dict()
+        #: For every stem that was placed by new_traverse_and_build, the tuple
+        #: (previous stem, angle stat, stem stat) that was used to place it.
+        self._built_with = dict()
+        #: The elements whose coordinates changed since the last call to _finish_building,
+        #: or None, if the whole structure has to be finished.
+        self._dirty_elems = None
+        #: Stems with changed coordinates, whose virtual residues have already been
+        #: moved along with the stem.
+        self._vres_transformed = set()
+        #: The virtual residues of all stems in contiguous arrays.
+        #: Created when the structure is built for the first time.
+        self.virtual_residues = None
+        #: The BuildPlan for the current build_order. Compiled when needed.
+        self._build_plan = None
+        #: The elements that were changed by the last build, or None,
+        #: if the whole structure was built. Constraints are checked for them first.
+        self._last_changed = None
 
         self.bg = bg
         # We plan to modify the structure, so discard the cahin.
@@ -288,6 +681,38 @@ class SpatialModel:
             # The structure is probably new and doesnt have coordinates yet
             pass
 
+    def clone(self):
+        '''
+        A copy of this SpatialModel, that can be built and sampled independently.
+
+        Unlike `copy.deepcopy`, this shares the secondary structure (see `clone_cg`)
+        and the stats in elem_defs with the original. Stem and loop models are
+        replaced and never modified while building, so they are shared as well
+        until the clone is rebuilt.
+        '''
+        new_sm = copy.copy(self)
+        new_sm.bg = clone_cg(self.bg)
+        new_sm.stems = dict(self.stems)
+        new_sm.bulges = dict(self.bulges)
+        new_sm.elem_defs = dict(self.elem_defs)
+        new_sm.frozen_elements = set(self.frozen_elements)
+        new_sm.chain = copy.deepcopy(self.chain)
+        # Energies keep track of the sampling (e.g. for adjustments) and thus are copied.
+        new_sm.constraint_energy = copy.deepcopy(self.constraint_energy)
+        new_sm.junction_constraint_energy = copy.deepcopy(self.junction_constraint_energy)
+        new_sm._built_with = dict(self._built_with)
+        if self._dirty_elems is not None:
+            new_sm._dirty_elems = set(self._dirty_elems)
+        new_sm._vres_transformed = set(self._vres_transformed)
+        if self._last_changed is not None:
+            new_sm._last_changed = set(self._last_changed)
+        if self.virtual_residues is not None:
+            new_sm.virtual_residues = self.virtual_residues.copy()
+            new_sm.virtual_residues.link(new_sm.bg,
+                                         [ stem for stem in self.virtual_residues.index
+                                           if self.virtual_residues.is_linked(self.bg, stem) ])
+        return new_sm
+
     def sample_stats(self, stat_source):
 
         for d in self.bg.defines:
@@ -374,6 +799,7 @@ class SpatialModel:
         '''
         Save the information about all of the sampled elements.
         '''
+        mst = self.bg.get_mst()
         for d, ed in self.elem_defs.items():
             try:
                 self.bg.sampled[d] = [ed.pdb_name] + [len(ed.define)] + ed.define
@@ -384,7 +810,7 @@ class SpatialModel:
                         pass
                     self.bg.vposs[d]=ed.vres
                     log.debug("Set %s to %s ", d, ed.vres)
-                if d not in self.bg.get_mst():
+                if d not in mst:
                     self.bg.infos["vstat_{}".format(d)]=[str(ed)]
             except:
                 log.debug("Error setting {}".format(d))
@@ -401,6 +827,7 @@ class SpatialModel:
 
         self.bg.build_order = None #No longer valid
         self.bg.ang_types = None
+        self._build_plan = None
         self.load_sampled_elems(stat_source=None)
         #self.new_traverse_and_build(start='start', include_start = True)
 
@@ -431,6 +858,7 @@ class SpatialModel:
 
             self.bg.build_order = None #No longer valid
             self.bg.ang_types = None
+            self._build_plan = None
             if self.elem_defs and d in self.elem_defs:
                 del self.elem_defs[d]
             self.bg.traverse_graph()
@@ -482,6 +910,7 @@ class SpatialModel:
                 raise ValueError("Cannot break loop {:0}. Cannot connect RNA if {:0} is broken.".format(d))
             self.bg.build_order = None #No longer valid
             self.bg.ang_types = None
+            self._build_plan = None
             if self.elem_defs and d in self.elem_defs:
                 del self.elem_defs[d]
             self.bg.traverse_graph()
@@ -497,6 +926,7 @@ class SpatialModel:
         ..note: This is called by the Builder to avoid building the structure from scratch.
         '''
         build_order = self.bg.traverse_graph()
+        build_order_of = { bo[1]: bo for bo in build_order }
         for d in self.bg.defines.keys():
             if d[0]=="s":
                 stat=self.bg.get_stem_stats(d)
@@ -506,14 +936,13 @@ class SpatialModel:
             elif d[0] in ("m", "i"):
                 stat=ftms.AngleStat()
                 #load angle_stats in direction of build order!
-                for bo in build_order:
-                    if bo[1]==d:
-                        if self.bg.defines[bo[0]]<self.bg.defines[bo[2]]:
-                            forward=True
-                        else:
-                            forward=False
-                        stat=self.bg.get_bulge_angle_stats_core(d, forward=forward)
-                        break
+                if d in build_order_of:
+                    bo = build_order_of[d]
+                    if self.bg.defines[bo[0]]<self.bg.defines[bo[2]]:
+                        forward=True
+                    else:
+                        forward=False
+                    stat=self.bg.get_bulge_angle_stats_core(d, forward=forward)
                 else: #Not in build_order. Probably broken ml segment
                     assert d[0]=="m"
                     #If it was frozen or stored in the file, we add its stats to elem_defs.
@@ -529,11 +958,8 @@ class SpatialModel:
         if stat_source is not None:
             if self.bg.sampled:
                 log.info("Now overwriting stats by sampled stats from stat_source")
-            build_order = self.bg.traverse_graph()
-            for elem, sampled in self.bg.sampled.items():
-                pdb_name=sampled[0]
-                stat = stat_source.load_stat_by_name(self.bg, elem, pdb_name)
-                self.elem_defs[elem]=stat
+            pdb_names = { elem: sampled[0] for elem, sampled in self.bg.sampled.items() }
+            self.elem_defs.update(stat_source.load_stats_by_name(self.bg, pdb_names))
 
     def get_transform(self, edge):
         '''
@@ -592,13 +1018,18 @@ class SpatialModel:
 
         return stem
 
-    def fill_in_bulges_and_loops(self):
+    def fill_in_bulges_and_loops(self, elems=None):
+        """
+        :param elems: Optional; Only fill in these elements. Stems in elems are ignored.
+        """
         log.debug("Started fill_in_bulges_and_loops")
         loops = list(self.bg.hloop_iterator())
         fiveprime = list(self.bg.floop_iterator())
         threeprime = list(self.bg.tloop_iterator())
 
-        for d in self.bg.defines.keys():
+        if elems is None:
+            elems = self.bg.defines.keys()
+        for d in elems:
             if d[0] != 's':
                 if d in loops or d in fiveprime or d in threeprime:
                     log.debug("Adding loop {} (connected to {})".format(d, list(self.bg.edges[d])[0]))
@@ -636,15 +1067,22 @@ class SpatialModel:
         self.bg.coords[stem] = np.array([sm.mids[0], sm.mids[1]])
         self.bg.twists[stem] = np.array([sm.twists[0], sm.twists[1]])
 
-    def _loops_to_coords(self):
+    def _loops_to_coords(self, elems=None):
         '''
         Add all of the stem and bulge coordinates to the BulgeGraph data structure.
+
+        :param elems: Optional; Only update the coordinates of these (non-stem) elements.
         '''
 
         log.debug("_loops_to_coords: Adding bulge coodinates from stems")
-        self.bg.add_bulge_coords_from_stems()
+        if elems is None:
+            self.bg.add_bulge_coords_from_stems()
+        else:
+            self._bulge_coords_from_stems(elems)
 
         for d in self.bg.hloop_iterator():
+            if elems is not None and d not in elems:
+                continue
             bm = self.bulges[d]
             connected, =self.bg.edges[d]
             if not np.allclose(bm.mids[0], self.bg.coords[connected][1]):
@@ -653,6 +1091,8 @@ class SpatialModel:
                 assert False, "Bulge {}, Difference {}".format(d, bm.mids[0]-self.bg.coords[connected][1])
             self.bg.coords[d] = np.array([bm.mids[0], bm.mids[1]])
         for d in it.chain(self.bg.floop_iterator(), self.bg.tloop_iterator()):
+            if elems is not None and d not in elems:
+                continue
             if d in self.bg.defines:
                 bm = self.bulges[d]
                 connected, =self.bg.edges[d]
@@ -660,6 +1100,25 @@ class SpatialModel:
                 assert np.array_equal(bm.mids[0], self.bg.coords[connected][0]) or np.array_equal(bm.mids[0], self.bg.coords[connected][1])
                 self.bg.coords[d] = np.array([bm.mids[0], bm.mids[1]])
 
+    def _bulge_coords_from_stems(self, elems):
+        '''
+        Like `bg.add_bulge_coords_from_stems`, but only for the given elements.
+        '''
+        for d in elems:
+            if d[0] == 's':
+                continue
+            edges = list(self.bg.edges[d])
+            if len(edges) == 2:
+                (s1b, _) = self.bg.get_sides(edges[0], d)
+                (s2b, _) = self.bg.get_sides(edges[1], d)
+                mids1 = self.bg.coords[edges[0]]
+                mids2 = self.bg.coords[edges[1]]
+                # Save coordinates in direction of the strand.
+                if self.bg.get_link_direction(edges[0], edges[1], d) == 1:
+                    self.bg.coords[d] = (mids1[s1b], mids2[s2b])
+                else:
+                    self.bg.coords[d] = (mids2[s2b], mids1[s1b])
+
     def get_sampled_bulges(self):
         '''
         Do a breadth first traversal and return the bulges which are
@@ -704,16 +1163,45 @@ class SpatialModel:
         #self.prev_visit_order = prev_visited
 
     def _finish_building(self):
+        """
+        Update the loops, bulges and virtual residues after stems have been built.
+
+        If the elements that changed since the last call are known (self._dirty_elems),
+        only the loops and bulges around them and their virtual residues are updated.
+        """
         log.debug("Finish building")
+        if self._dirty_elems is None:
+            elems = None
+            stems = list(self.bg.stem_iterator())
+        else:
+            elems = set(d for d in self._dirty_elems if d[0] != "s")
+            stems = [ d for d in self._dirty_elems if d[0] == "s" ]
+            for stem in stems:
+                elems.update(d for d in self.bg.edges[stem] if d[0] != "s")
+            log.debug("Finishing only the elements %s and stems %s", elems, stems)
         log.debug("(1) vposs now %s", self.bg.vposs)
-        self.fill_in_bulges_and_loops()
+        self.fill_in_bulges_and_loops(elems)
         log.debug("(2) vposs now %s", self.bg.vposs)
-        self._loops_to_coords()
+        self._loops_to_coords(elems)
         log.debug("(3) vposs now %s", self.bg.vposs)
         self.save_sampled_elems()
         log.debug("(4) vposs now %s", self.bg.vposs)
-        self.bg.add_all_virtual_residues()
+        if self.virtual_residues is None:
+            self.virtual_residues = VirtualResidueStore(self.bg)
+        if self._dirty_elems is None:
+            self.bg.add_all_virtual_residues()
+        else:
+            stems = [ stem for stem in stems if stem not in self._vres_transformed ]
+            for stem in stems:
+                ftug.add_virtual_residues(self.bg, stem)
+        self.virtual_residues.load(self.bg, stems)
         log.debug("(5) vposs now %s", self.bg.vposs)
+        if self._dirty_elems is None:
+            self._last_changed = None
+        else:
+            self._last_changed = elems | set(self._dirty_elems)
+        self._dirty_elems = set()
+        self._vres_transformed = set()
 
     def add_to_skip(self):
         '''
@@ -746,11 +1234,14 @@ class SpatialModel:
         '''
         Build a 3D structure from the graph in self.bg and the stats from self.elem_defs.
         :param start: Optional; Start building the given element. If it is a stem, build AFTER this stem.
-                      TODO: instead of linear build_order use a tree. Only build leaves dependend on the changed node
-
+                      If neither `max_steps` nor `end` is given, only the elements that
+                      depend on `start` (i.e. its subtree in the build order) are rebuilt.
+                      Elements in independent branches keep their coordinates.
         :param max_staps: Optional; Build at most that many stems.
+                          The linear build order is used, including independent branches.
         :param end: Optional; End building once the given node is built.
                     If `end` and `max_steps` are given, the criterion that kicks in earlier counts.
+                    The linear build order is used, including independent branches.
         :param include_start: If True, build including the node given as start,
                               if False, only build AFTER it. Only has an effect is start is a stem.
         :param finish_building: Usually True. Set it to False, if self._finish_building
@@ -764,6 +1255,7 @@ class SpatialModel:
         else:
             build_order = self.bg.build_order
         log.debug("build_order: %s", build_order)
+        plan = self.build_plan(build_order)
         def buildorder_of(stemid, include = False):
             """
             Returns the buildorder of the multi-/ interior loop before the stem with stemid.
@@ -776,21 +1268,23 @@ class SpatialModel:
                 return int(include)
 
             if stemid.startswith('s'):
-                for i, stem_loop_stem in enumerate(build_order):
-                    if stemid==stem_loop_stem[2]:
-                        if include:
-                            return i
-                        else:
-                            return i+1
+                if stemid in plan.stem_step:
+                    if include:
+                        return plan.stem_step[stemid]
+                    else:
+                        return plan.stem_step[stemid]+1
             else:
                 if stemid[0] in "fth":
                     return float("inf") #Only fill in bulges and loops if loop was changed
-                for i, stem_loop_stem in enumerate(build_order):
-                    if stemid==stem_loop_stem[1]:
-                        return i
+                if stemid in plan.loop_step:
+                    return plan.loop_step[stemid]
             raise ValueError("{} not found in {}.".format(stemid,build_order))
 
         nodes = []
+        # If only the subtree depending on start is rebuilt, this holds the stems that
+        # have been (re-)built. Stems connected to any other stem keep their coordinates.
+        changed_stems = None
+        first_step = None
         if start == "start" or (start == "s0" and include_start):
             # add the first stem in relation to a non-existent stem
             first_stem = "s0"
@@ -800,16 +1294,28 @@ class SpatialModel:
             self.stem_to_coords(first_stem)
             nodes.append(first_stem)
             build_step = 0
-        elif start=="end" or start[0] in "fth":
+            if max_steps == float('inf') and end is None:
+                # Everything is rebuilt.
+                self._dirty_elems = None
+            else:
+                # Only the first steps are rebuilt. The other elements keep their
+                # coordinates until they are built.
+                self._vres_transformed.discard(first_stem)
+        elif start=="end":
+            self._dirty_elems = None
+            self._finish_building()
+            return []
+        elif start[0] in "fth":
+            self._mark_dirty([start])
             self._finish_building()
             return []
         else:
             build_step = buildorder_of(start, include_start)
-            if build_step >= len(build_order):
+            if build_step >= len(plan):
                 if finish_building:
                     self._finish_building()
                 return []
-            prev_stem = build_order[build_step][0]
+            prev_stem = plan.steps[build_step][0]
             try:
                 log.debug("new_traverse_and_build: Checking self.stems[{}] (=prev_stem)".format(prev_stem))
                 self.stems[prev_stem]
@@ -817,51 +1323,173 @@ class SpatialModel:
                 raise ValueError("Cannot build structure starting from {0}, because the parts "
                                  "of the structure before {0} have never been built. "
                                  "(The start-option is only for RE-building)".format(start))
-
-        max_build_steps = min(build_step+max_steps, len(build_order))
+            if max_steps == float('inf') and end is None:
+                if start[0] == "s" and not include_start:
+                    changed_stems = set([start])
+                else:
+                    # The first entry builds the start node itself, or the stem after it.
+                    changed_stems = set()
+                    first_step = build_step
+
+        # While only a subtree is rebuilt, stems whose stats did not change since they were
+        # built last time, move rigidly together with the stem they are attached to.
+        # rigid_moves[stem] is the index of the transform (in transforms) that moved this stem.
+        rigid_moves = {}
+        transforms = []
+        # For every transform, the stems it has to be applied to.
+        pending = defaultdict(list)
+        def apply_pending():
+            for i, stem_names in pending.items():
+                new_stems = transform_stems([self.stems[s] for s in stem_names], transforms[i])
+                # Stems whose virtual residues in the store belong to the old coordinates.
+                with_vres = []
+                if self.virtual_residues is not None and self._dirty_elems is not None:
+                    with_vres = [ s for s in stem_names
+                                  if (s not in self._dirty_elems or s in self._vres_transformed) and
+                                     self.virtual_residues.is_linked(self.bg, s) ]
+                for stem_name, stem in zip(stem_names, new_stems):
+                    self.stems[stem_name] = stem
+                    self.stem_to_coords(stem_name)
+                if with_vres:
+                    self.virtual_residues.transform(self.bg, with_vres, transforms[i])
+                    self._vres_transformed.update(with_vres)
+            pending.clear()
+
+        max_build_steps = min(build_step+max_steps, len(plan))
         while build_step < max_build_steps:
-            (s1, l, s2) = build_order[build_step]
-            nodes += [l, s2]
+            (s1, l, s2, s1b_s1e, reverse) = plan.steps[build_step]
             build_step +=1
+            if changed_stems is not None:
+                # The build_order is a traversal of the minimum spanning tree,
+                # so every stem comes after the stem it depends on.
+                if s1 not in changed_stems and build_step-1 != first_step:
+                    continue
+                changed_stems.add(s2)
+            nodes += [l, s2]
 
-            prev_stem = self.stems[s1]
             angle_params = self.elem_defs[l]
             stem_params = self.elem_defs[s2]
-            ang_type = self.bg.connection_type(l, [s1,s2])
-            connection_ends = self.bg.connection_ends(ang_type)
-
-            # get the direction of the first stem (which is used as a
-            # coordinate system)
-            if connection_ends[0] == 0:
-                (s1b, s1e) = (1, 0)
-            elif connection_ends[0] == 1:
-                (s1b, s1e) = (0, 1)
+            built_with = self._built_with.get(s2)
+            if (changed_stems is not None and not self.build_chain and s1 in rigid_moves and
+                    built_with is not None and built_with[0] == s1 and
+                    built_with[1] is angle_params and built_with[2] is stem_params):
+                rigid_moves[s2] = rigid_moves[s1]
+                pending[rigid_moves[s2]].append(s2)
+                continue
+            if pending:
+                apply_pending()
+            prev_stem = self.stems[s1]
 
             log.debug("new_traverse_and_build: Setting self.stems[{}] (connected to {} via {})".format(s2, s1, l))
-            #log.debug("angle_params {}, stem_params {}, ang_type {}, connection_ends {}".format(angle_params, stem_params, ang_type, connection_ends))
             #log.debug("prev. stem MIDS: {}, TWISTS: {}".format(prev_stem.mids, prev_stem.twists))
 
             stem = self.add_stem(s2, stem_params, prev_stem,
-                                 angle_params, (s1b, s1e))
-
-            # check which way the newly connected stem was added
-            # if its 1-end was added, the its coordinates need to
-            # be reversed to reflect the fact it was added backwards
-            if connection_ends[1] == 1:
-                self.stems[s2] = stem.reverse()
-            else:
-                self.stems[s2] = stem
+                                 angle_params, s1b_s1e)
+
+            if reverse:
+                stem = stem.reverse()
+            if (changed_stems is not None and built_with is not None and
+                    built_with[2] is stem_params and s2 in self.stems):
+                # The stem itself did not change, only its position.
+                transforms.append(rigid_transform_between(self.stems[s2], stem))
+                rigid_moves[s2] = len(transforms)-1
+            self.stems[s2] = stem
+            self._built_with[s2] = (s1, angle_params, stem_params)
+            self._vres_transformed.discard(s2)
 
             self.stem_to_coords(s2)
 
             #Optional end-criterion given as a node label.
             if end is not None and end in nodes:
                 break
+        apply_pending()
+        self._mark_dirty(nodes)
         if finish_building:
             self._finish_building()
         return nodes
 
 
+    def build_plan(self, build_order=None):
+        '''
+        The BuildPlan for the build_order of self.bg.
+
+        The plan is compiled once and reused, until the build order changes.
+        '''
+        if build_order is None:
+            if not self.bg.build_order:
+                build_order = self.bg.traverse_graph()
+            else:
+                build_order = self.bg.build_order
+        if self._build_plan is None or self._build_plan.build_order is not build_order:
+            log.debug("Compiling build plan for %s", build_order)
+            self._build_plan = BuildPlan(self.bg, build_order)
+        return self._build_plan
+
+    def batched_stem_frames(self, elem_defs_list, start=None):
+        '''
+        Place the stems for several sets of stats at once.
+
+        This is the forward kinematics of new_traverse_and_build, done with batched
+        matrix products and without creating StemModels or updating self.bg.
+
+        @param elem_defs_list: A list of K dictionaries like self.elem_defs.
+        @param start: None or a loop in the build order. If it is given, only the stems
+                      placed with or after this loop are placed. All other stems
+                      keep the frames they have in self.stems.
+        @return: A dictionary {stem: array of shape (K, 4, 4)}, holding the
+                 frames (see `stem_frame`) the stems would have,
+                 if the structure was built with the respective stats.
+        '''
+        plan = self.build_plan()
+        frames = {}
+        if start is None:
+            first_step = 0
+            frames["s0"] = np.array([stem_frame(place_new_stem(StemModel(), elem_defs["s0"],
+                                                               ftms.AngleStat(), (0,1)))
+                                     for elem_defs in elem_defs_list])
+        else:
+            first_step = plan.loop_step[start]
+            for s1, l, s2, s1b_s1e, reverse in plan.steps[:first_step]:
+                for stem in (s1, s2):
+                    if stem not in frames:
+                        frames[stem] = np.tile(stem_frame(self.stems[stem]), (len(elem_defs_list), 1, 1))
+            s1 = plan.steps[first_step][0]
+            if s1 not in frames:
+                frames[s1] = np.tile(stem_frame(self.stems[s1]), (len(elem_defs_list), 1, 1))
+        for s1, l, s2, s1b_s1e, reverse in plan.steps[first_step:]:
+            side = stem_side_frames([elem_defs[s1] for elem_defs in elem_defs_list], s1b_s1e)
+            placement = np.array([stem_placement_transform(elem_defs[l])
+                                  for elem_defs in elem_defs_list])
+            new_frames = np.matmul(np.matmul(frames[s1], side), placement)
+            if reverse:
+                new_frames = np.matmul(new_frames,
+                                       reversed_stem_frames([elem_defs[s2]
+                                                             for elem_defs in elem_defs_list]))
+            frames[s2] = new_frames
+        return frames
+
+    def batched_junction_distances(self, bulge, frames, elem_defs_list):
+        '''
+        The distances between the virtual atoms at both ends of a ml-segment
+        for several sets of stats at once.
+
+        This calculates the same distances as `ftug.junction_virtual_atom_distance`,
+        with the virtual atoms placed relative to the stem frames.
+
+        @param bulge: The ml-segment, e.g. "m0"
+        @param frames: The frames of the stems, as returned by `batched_stem_frames`
+        @param elem_defs_list: The K dictionaries of stats, the frames were computed for.
+        @return: An array of shape (K,)
+        '''
+        atom_positions = [ junction_atom_positions(self.bg, stem, bulge, frames[stem],
+                                                   [elem_defs[stem] for elem_defs in elem_defs_list])
+                           for stem in self.bg.connections(bulge) ]
+        return np.linalg.norm(atom_positions[0] - atom_positions[1], axis=1)
+
+    def _mark_dirty(self, elems):
+        if self._dirty_elems is not None:
+            self._dirty_elems.update(elems)
+
     def ml_stat_deviation(self, ml, stat):
         """
         Calculate the deviation in angstrom between the stem that would be placed using the given
@@ -881,21 +1509,33 @@ class SpatialModel:
         return diff
 
     def fulfills_constraint_energy(self):
-        return self.fulfills_clash_energy() and self.fulfills_junction_energy()
+        # Junctions are checked first, because this is much cheaper than
+        # searching for clashes.
+        return self.fulfills_junction_energy() and self.fulfills_clash_energy()
     def fulfills_junction_energy(self):
-        for mloop in self.bg.find_mlonly_multiloops():
+        mst = self.bg.get_mst()
+        mloops = fbtopo.mlonly_multiloops(self.bg)
+        if self._last_changed:
+            # Junctions around the elements that moved last are the most likely to be broken.
+            mloops = sorted(mloops, key=lambda mloop: not any(
+                                    d in self._last_changed or
+                                    self.bg.edges[d] & self._last_changed for d in mloop))
+        for mloop in mloops:
             for loop in mloop:
                 log.debug("Trying junction constraint energy for %s. Energies are %s", mloop, self.junction_constraint_energy.keys())
-                if loop not in self.bg.get_mst() and loop in self.junction_constraint_energy:
+                if loop not in mst and loop in self.junction_constraint_energy:
                     log.debug("Evaluating junction constraint energy %s", self.junction_constraint_energy[loop].shortname)
-                    if self.junction_constraint_energy[loop].eval_energy(self.bg, nodes=mloop, sampled_stats=self.elem_defs)>0:
+                    if self.junction_constraint_energy[loop].has_violation(self.bg, nodes=mloop,
+                                                                           recent=self._last_changed,
+                                                                           sampled_stats=self.elem_defs):
                         log.info("Junction {} is not closed".format(mloop))
                         return False
         return True
     def fulfills_clash_energy(self):
         if self.constraint_energy is None:
             warnings.warn("Model has no clash energy!")
-        if self.constraint_energy is not None and self.constraint_energy.eval_energy(self.bg)>0:
+        if self.constraint_energy is not None and self.constraint_energy.has_violation(self.bg,
+                                                                                      recent=self._last_changed):
             log.info("CLASHING")
             return False
         return True
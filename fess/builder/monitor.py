@@ -582,10 +582,10 @@ class LocalFragmentCoverage(StatisticsCollector):
             return
         #: A fess.builder.stat_container.StatStorage instance
         self._stat_source = stat_source
+        #: Keeps track of the pdb_names of stats that have been accepted at least once.
+        self._tracker = stat_source.coverage_tracker(cg)
         #: Keep track of the coverage for all elements, so it only has to be updated if elements changed.
         self._coverage =  defaultdict(lambda: 0.)
-        #: For each element, store the pdb_names of stats that have been accepted at least once
-        self._known_fragments = defaultdict(set)
         #: The elem_defs as {elem : pdb_name} from the previouse iteration, to avoid recalculation.
         self._prev_elem_defs = defaultdict(lambda: None)
 
@@ -593,16 +593,12 @@ class LocalFragmentCoverage(StatisticsCollector):
         if not self.silent:
             if self.history is None:
                 self.history = [[] for x in range(len(sm.bg.defines))]
-            elem_defs = {elem: stat.pdb_name for elem,
-                         stat in sm.elem_defs.items()}
-            for elem, stat_name in elem_defs.items():
+            for elem, stat in sm.elem_defs.items():
+                stat_name = stat.pdb_name
                 if stat_name != self._prev_elem_defs[elem]:
                     # We have a new stat for this elem. Update coverage
-                    self._known_fragments[elem].add(stat_name)
-                    new_cov = self._stat_source.coverage_for(
-                        self._known_fragments[elem], sm.bg, elem)
-                    assert new_cov >= self._coverage[elem]
-                    self._coverage[elem] = new_cov
+                    self._coverage[elem] = self._tracker.visit(elem, stat_name)
+                    self._prev_elem_defs[elem] = stat_name
 
             coverage = sum(self._coverage.values())/len(self._coverage)
             for i, elem in enumerate(sorted(self._coverage)):
@@ -20,6 +20,7 @@ except ImportError: #<python3.3
         pass
 
 import numpy as np
+import scipy.spatial
 
 import forgi.threedee.utilities.graph_pdb as ftug
 import forgi.threedee.utilities.vector as ftuv
@@ -27,6 +28,9 @@ import forgi.threedee.model.stats as ftms
 
 from ..utils import get_all_subclasses
 from . import create
+from . import energy as fbe
+from . import models as fbm
+from . import topology as fbtopo
 from ._commandline_helper import replica_substring
 from . import relaxation_builder as fbrel
 
@@ -170,8 +174,8 @@ class MoverNoRegularML(Mover):
         while True:
             elem = super(MoverNoRegularML, self)._get_elem(sm)
             if elem[0] == "m":
-                loop = sm.bg.shortest_mlonly_multiloop(elem)
-                if "regular_multiloop" not in sm.bg.describe_multiloop(loop):
+                loop = fbtopo.shortest_mlonly_multiloop(sm.bg, elem)
+                if "regular_multiloop" not in fbtopo.describe_multiloop(sm.bg, loop):
                     return elem
             else:
                 return elem
@@ -195,20 +199,23 @@ class EnergeticJunctionMover(Mover):
         else:
             self.max_tries = 20000
         self.original_max_tries = self.max_tries
+        #: The closure search is only used, if every half of the junction
+        #: has at most that many conformations (see `_closure_search`)
+        self.max_half_combinations = 200000
         #: The first time move is called, we enumerate all choices,
         #: so we can rule out the possibility of 0 available choices.
         #: A dictionary sm-identifier : choices.
         self.choices = {}
     @staticmethod
     def _sm_fingerprint( sm):
-        fingerprint = sm.bg.name+"\n"+sm.bg.to_dotbracket_string()+"\n"
+        fingerprint = fbtopo.fingerprint(sm.bg)
         fingerprint+=",".join(sorted(sm.frozen_elements))
         return fingerprint
     def _enumerate_choices(self, sm):
         choices = []
-        loops = sm.bg.find_mlonly_multiloops()
+        loops = fbtopo.mlonly_multiloops(sm.bg)
         regular_multiloops = [ m for m in loops
-                               if "regular_multiloop" in sm.bg.describe_multiloop(m) ]
+                               if "regular_multiloop" in fbtopo.describe_multiloop(sm.bg, m) ]
         if len(regular_multiloops)==0:
             raise UnsuitableMover("{} needs at least 1 regular multiloop. "
                                   "(Pseudoknots and external loops are "
@@ -343,6 +350,16 @@ class EnergeticJunctionMover(Mover):
         log.debug("For elems %s, loop index is %s, loop is %s", elems, i, whole_loop)
         loop = whole_loop[i:]
         log.info("Loop now %s", loop)
+        closure = self._closure_search(sm, elems, loop)
+        if closure is not None:
+            count, sampled = closure
+            if sampled is None:
+                return None
+            if self._check_junction(sm, sampled, loop, whole_loop):
+                log.info("Closing combination found by the closure search")
+                return sampled
+            log.warning("The combination found by the closure search for %s does not "
+                        "close the junction. Searching sequentially.", elems)
         for sampled in create.stat_combinations(sm.bg, elems, self.stat_source):
             counter+=1
             if self._check_junction(sm, sampled, loop, whole_loop):
@@ -366,6 +383,130 @@ class EnergeticJunctionMover(Mover):
                 return None
         return None
 
+    def _closure_search(self, sm, elems, loop):
+        """
+        Find the combinations of stats for elems that close the junction
+        with a meet-in-the-middle search, instead of building them one by one.
+
+        The loop is cut at its broken ml-segment (the last element of loop).
+        Both halves are placed for all combinations of stats of their
+        ml-segments with batched matrix products, discarding placements
+        where a rebuilt ml-segment is not closed.
+        The junction is closed, if the virtual atoms at both ends of the broken
+        ml-segment are close enough, which is tested with a KD-tree.
+
+        Like the sequential search, this returns every closing combination
+        with the same probability.
+
+        :returns: None, if this search cannot be used for the junction
+                  constraint energy or the halves have too many conformations.
+                  Else a tuple (number of closing combinations of the
+                  halves, sampled stats or None).
+        """
+        bg = sm.bg
+        broken = loop[-1]
+        try:
+            energy = sm.junction_constraint_energy[broken]
+        except KeyError:
+            return None
+        if hasattr(energy, "iterate_energies"):
+            energies = list(energy.iterate_energies())
+        else:
+            energies = [energy]
+        if not energies or not all(isinstance(e, fbe.RoughJunctionClosureEnergy) for e in energies):
+            return None
+        try:
+            choices = { elem: self.stat_source.stat_subset_for(bg, elem) for elem in elems }
+        except ValueError: # Continuouse stats
+            return None
+        if any(len(stats)==0 for stats in choices.values()):
+            return None
+        for l in loop[:-1]:
+            if l not in choices:
+                choices[l] = [sm.elem_defs[l]]
+        # The tolerance makes sure that rounding errors never reject a valid structure.
+        cutoffs = { m: min(e.cutoff_distance(bg, m) for e in energies) + 1e-6 for m in loop }
+
+        plan = sm.build_plan()
+        rebuilt = set(loop[:-1])
+        halves = []
+        for stem in bg.connections(broken):
+            steps = []
+            while stem in plan.stem_step and plan.steps[plan.stem_step[stem]][1] in rebuilt:
+                steps.append(plan.steps[plan.stem_step[stem]])
+                stem = steps[-1][0]
+            halves.append((stem, steps[::-1]))
+        half_loops = [ [step[1] for step in steps] for _, steps in halves ]
+        if sorted(half_loops[0]+half_loops[1]) != sorted(rebuilt):
+            return None
+
+        placed = []
+        for top, steps in halves:
+            frames, indices = self._place_half(sm, top, steps, choices, cutoffs)
+            if frames is None:
+                log.info("Too many conformations for the closure search of %s", elems)
+                return None
+            placed.append((frames, indices))
+        atoms = [ fbm.junction_atom_positions(bg, stem, broken, frames, sm.elem_defs[stem])
+                  for stem, (frames, _) in zip(bg.connections(broken), placed) ]
+        if len(atoms[0])==0 or len(atoms[1])==0:
+            return 0, None
+        tree = scipy.spatial.cKDTree(atoms[1])
+        counts = tree.query_ball_point(atoms[0], cutoffs[broken], return_length=True)
+        ends = np.cumsum(counts)
+        count = int(ends[-1])
+        log.info("Closure search for %s: %d of %d x %d conformations close the junction",
+                 elems, count, len(atoms[0]), len(atoms[1]))
+        if count==0:
+            return 0, None
+        # Every closing pair is chosen with the same probability.
+        r = random.randrange(count)
+        a = int(np.searchsorted(ends, r, side="right"))
+        partners = sorted(tree.query_ball_point(atoms[0][a], cutoffs[broken]))
+        b = partners[r-(ends[a]-counts[a])]
+        sampled = {}
+        for (_, steps), (_, indices), k in zip(halves, placed, [a, b]):
+            for (_, l, _, _, _), i in zip(steps, indices[k]):
+                if l in elems:
+                    sampled[l] = choices[l][i]
+        if broken in elems:
+            sampled[broken] = random.choice(choices[broken])
+        return count, sampled
+
+    def _place_half(self, sm, top, steps, choices, cutoffs):
+        """
+        Place the stems of one half of the junction for all combinations
+        of stats, starting at the current frame of the stem top.
+
+        :returns: A tuple (frames, indices) with the K frames of the last stem
+                  (see `fbm.stem_frame`) and an array of shape (K, len(steps))
+                  with the indices of the stats in choices. Placements where
+                  an ml-segment is not closed are not returned.
+                  (None, None), if there are more than self.max_half_combinations
+                  placements after any step.
+        """
+        bg = sm.bg
+        frames = fbm.stem_frame(sm.stems[top])[np.newaxis]
+        indices = np.zeros((1, 0), dtype=int)
+        for s1, l, s2, s1b_s1e, reverse in steps:
+            stats = choices[l]
+            if len(frames)*len(stats) > self.max_half_combinations:
+                return None, None
+            side = fbm.stem_side_frames([sm.elem_defs[s1]], s1b_s1e)[0]
+            placements = fbm.stem_placement_transforms(stats)
+            new_frames = np.matmul(np.matmul(frames, side)[:, np.newaxis], placements[np.newaxis])
+            new_frames = new_frames.reshape((-1, 4, 4))
+            if reverse:
+                new_frames = np.matmul(new_frames, fbm.reversed_stem_frames([sm.elem_defs[s2]])[0])
+            parents = np.repeat(np.arange(len(frames)), len(stats))
+            chosen = np.tile(np.arange(len(stats)), len(frames))
+            atom1 = fbm.junction_atom_positions(bg, s1, l, frames, sm.elem_defs[s1])[parents]
+            atom2 = fbm.junction_atom_positions(bg, s2, l, new_frames, sm.elem_defs[s2])
+            closed = np.linalg.norm(atom1-atom2, axis=1) <= cutoffs[l]
+            frames = new_frames[closed]
+            indices = np.column_stack([indices[parents[closed]], chosen[closed]])
+        return frames, indices
+
 
 class RotationMover(Mover):
     def __init__(self, stat_source, **kwargs):
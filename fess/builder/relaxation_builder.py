@@ -1,6 +1,9 @@
 import random
+from collections import deque
 import fess.builder.energy as fbe
+import fess.builder.topology as fbtopo
 import networkx as nx
+import numpy as np
 import logging
 import forgi.threedee.utilities.graph_pdb as ftug
 import forgi.threedee.utilities.vector as ftuv
@@ -44,10 +47,9 @@ def sort_elems_by_buildorder(bg, elems):
     return sorted(elems, key=loop_key)
 
 def sort_loops_buildorder(bg):
-    start = bg.build_order[0][0]
-    G = mst_to_nx(bg)
+    topology = get_relaxation_topology(bg)
     elems = list(bg.mst)
-    elems = list(sorted(elems, key=lambda x: nx.shortest_path_length(G,x, start)))
+    elems = list(sorted(elems, key=topology.depth))
     for ml in bg.defines:
         if ml not in bg.mst:
             elems.append(ml)
@@ -203,18 +205,112 @@ def count_smaller_equal_cycles(cycles, loop, length):
             count+=1
     return count
 
+class RelaxationTopology(object):
+    """
+    Paths in the minimum spanning tree of a BulgeGraph, precomputed once
+    per minimum spanning tree.
+
+    Use `get_relaxation_topology` to get the cached instance for a BulgeGraph.
+
+    :var nodes: The elements of the minimum spanning tree, sorted.
+                The arrays use indices into this list.
+    :var distances: An integer array. distances[i,j] is the number of edges
+                    between nodes i and j in the minimum spanning tree (-1 if
+                    there is no path).
+    :var predecessors: An integer array. predecessors[i,j] is the node before
+                       node j on the path from node i to node j.
+    :var cycles: A dictionary {broken ml-segment: path between its stems}
+    """
+    def __init__(self, bg):
+        if bg.build_order is None:
+            bg.traverse_graph()
+        self.mst = set(bg.mst)
+        self.nodes = sorted(self.mst)
+        self.index = { node: i for i, node in enumerate(self.nodes) }
+        n = len(self.nodes)
+        neighbors = [ [ self.index[neighbor] for neighbor in bg.edges[node] if neighbor in self.mst ]
+                      for node in self.nodes ]
+        self.distances = np.full((n, n), -1, dtype=int)
+        self.predecessors = np.full((n, n), -1, dtype=int)
+        for i in range(n):
+            # Breadth first search from node i
+            self.distances[i,i] = 0
+            self.predecessors[i,i] = i
+            queue = deque([i])
+            while queue:
+                u = queue.popleft()
+                for v in neighbors[u]:
+                    if self.distances[i,v] < 0:
+                        self.distances[i,v] = self.distances[i,u] + 1
+                        self.predecessors[i,v] = u
+                        queue.append(v)
+        self.root = bg.build_order[0][0]
+        self._paths = {}
+        self._subtree_stems = {}
+        self._stems = list(bg.stem_iterator())
+        self.cycles = {}
+        for loop in bg.mloop_iterator():
+            if loop not in self.mst:
+                v1, v2 = bg.edges[loop]
+                self.cycles[loop] = self.path(v1, v2)
+
+    def path(self, start, end):
+        """
+        The elements on the path from start to end in the minimum
+        spanning tree, including start and end. Do not modify the returned list.
+        """
+        try:
+            return self._paths[start, end]
+        except KeyError:
+            pass
+        i, j = self.index[start], self.index[end]
+        if self.distances[i,j] < 0:
+            raise nx.NetworkXNoPath("No path between {} and {}.".format(start, end))
+        path = [j]
+        while path[-1] != i:
+            path.append(self.predecessors[i, path[-1]])
+        path = self._paths[start, end] = [ self.nodes[k] for k in reversed(path) ]
+        return path
+
+    def depth(self, elem):
+        """
+        The number of edges between elem and the first stem of the build order.
+        """
+        return self.distances[self.index[self.root], self.index[elem]]
+
+    def subtree_stems(self, loop):
+        """
+        The stems after loop in the minimum spanning tree, in the order of
+        bg.stem_iterator(). Do not modify the returned list.
+        """
+        if loop not in self._subtree_stems:
+            r, l = self.index[self.root], self.index[loop]
+            # loop is on the path from the root to the node,
+            # iff it does not make the path longer.
+            after = self.distances[r,l] + self.distances[l] == self.distances[r]
+            self._subtree_stems[loop] = [ s for s in self._stems
+                                          if s != loop and after[self.index[s]] ]
+        return self._subtree_stems[loop]
+
+def get_relaxation_topology(bg):
+    """
+    The RelaxationTopology for the current minimum spanning tree of bg.
+    """
+    topology = fbtopo.cached(bg, "relaxation_topology", lambda: RelaxationTopology(bg),
+                             depends_on_mst=True)
+    if topology.mst != bg.mst:
+        # The minimum spanning tree was changed without traversing the graph.
+        bg.traverse_graph()
+        topology = fbtopo.cached(bg, "relaxation_topology", lambda: RelaxationTopology(bg),
+                                 depends_on_mst=True)
+    return topology
+
 def get_mst_cycles(bg):
-    cycles={}
-    bg.traverse_graph()
-    for loop in bg.mloop_iterator():
-        if loop not in bg.mst:
-            cycles[loop]=get_mloop_mst_cycle(bg, loop)
-    return cycles
+    return dict(get_relaxation_topology(bg).cycles)
 
 def get_mloop_mst_cycle(bg, loop):
     v1,v2 = bg.edges[loop]
-    G = mst_to_nx(bg)
-    return nx.shortest_path(G,v1,v2)
+    return list(get_relaxation_topology(bg).path(v1, v2))
 
 def mst_to_nx(bg):
     G = nx.Graph()
@@ -248,7 +344,12 @@ def do_gradient_walk(sm, brokenloops, elem, stat_source, clash_nodes=[], num_sta
     steps=count_build_steps(elem, brokenloops[0], sm.bg)
     stat_choices=list(stat_source.iterate_stats_for(sm.bg, elem))
     random.shuffle(stat_choices)
-    for stat in stat_choices[:num_stats_per_ml]:
+    stat_choices = stat_choices[:num_stats_per_ml]
+    lower_bounds = junction_energy_lower_bounds(sm, brokenloops, elem, stat_choices)
+    for i, stat in enumerate(stat_choices):
+        if lower_bounds is not None and not clash_pairs and lower_bounds[i]>=energy:
+            # Without clashes, only a lower junction energy is accepted.
+            continue
         sm.elem_defs[elem]=stat
         if elem not in brokenloops:
             sm.new_traverse_and_build(start=elem, max_steps=steps, include_start=True)
@@ -287,11 +388,24 @@ def do_clash_gradient_walk(sm, clash_pair, loop, stat_source, num_stats_per_ml=N
 
     stat_choices=list(stat_source.iterate_stats_for(sm.bg, loop))
     random.shuffle(stat_choices)
+    # The stems that do not depend on loop never move, so their clashes
+    # with each other are only evaluated once.
+    clash_stack = fbe.ClashStack.for_energy(sm.constraint_energy, sm.bg)
+    if clash_stack is not None:
+        moving = get_subtree_stems(sm.bg, loop)
+        clash_stack.push([ s for s in sm.bg.stem_iterator() if s not in moving ])
+        num_fixed = len(clash_stack.nodes)
     for stat in stat_choices[:num_stats_per_ml]:
         sm.elem_defs[loop]=stat
         sm.new_traverse_and_build(start=loop, include_start=True)
-        e2 = sm.constraint_energy.eval_energy(sm.bg)
-        new_clash_pairs = sm.constraint_energy.bad_bulges
+        if clash_stack is not None:
+            clash_stack.truncate(num_fixed)
+            clash_stack.push(moving)
+            e2 = clash_stack.energy.prefactor * clash_stack.clashes
+            new_clash_pairs = clash_stack.bad_bulges
+        else:
+            e2 = sm.constraint_energy.eval_energy(sm.bg)
+            new_clash_pairs = sm.constraint_energy.bad_bulges
         if set(new_clash_pairs)-set(all_clash_pairs):
             # Never introduce new clashes
             continue
@@ -333,6 +447,44 @@ def do_clash_gradient_walk(sm, clash_pair, loop, stat_source, num_stats_per_ml=N
         movestring=""
     return movestring
 
+def junction_energy_lower_bounds(sm, brokenloops, elem, stats):
+    """
+    Lower bounds for the junction energy of the brokenloops (as evaluated in
+    `do_gradient_walk`) after replacing the stat of elem with each of the stats.
+
+    The stems are placed for all stats at once (see `SpatialModel.batched_stem_frames`),
+    so the structure does not need to be built for every stat.
+
+    :returns: An array with one bound per stat or None, if not all junction
+              energies are RoughJunctionClosureEnergies.
+    """
+    if elem in brokenloops or elem not in sm.bg.mst or not stats:
+        return None
+    energy_function, _ = get_junction_energies(sm, brokenloops)
+    energies = list(energy_function.iterate_energies())
+    if not all(isinstance(e, fbe.RoughJunctionClosureEnergy) for e in energies):
+        return None
+    elem_defs_list = []
+    for stat in stats:
+        elem_defs = dict(sm.elem_defs)
+        elem_defs[elem] = stat
+        elem_defs_list.append(elem_defs)
+    frames = sm.batched_stem_frames(elem_defs_list, start=elem)
+    bounds = np.zeros(len(stats))
+    for bulge in set(b for b in brokenloops if b[0]=="m"):
+        distances = sm.batched_junction_distances(bulge, frames, elem_defs_list)
+        for e in energies:
+            # The tolerance makes sure that rounding errors never exclude a better stat.
+            bounds += np.maximum(0, distances - 1e-6 - e.cutoff_distance(sm.bg, bulge)) * e.prefactor
+    return bounds
+
+def get_subtree_stems(bg, loop):
+    """
+    The stems that are (re-)placed, if the stat of the loop changes,
+    i.e. the stems after loop in the minimum spanning tree.
+    """
+    return list(get_relaxation_topology(bg).subtree_stems(loop))
+
 def count_build_steps_stems(elem, stems, bg):
     found=None
     for s1, l, s2 in bg.build_order:
@@ -350,11 +502,11 @@ def count_build_steps(loop, broken_loop, bg):
 
 
 def get_clash_paths(bg, clash_pairs):
+    topology = get_relaxation_topology(bg)
     paths={}
     for s1,s2  in clash_pairs:
-        paths[(s1,s2)]=get_single_clash_path(bg, s1, s2)
+        paths[(s1,s2)]=topology.path(s1, s2)
     return paths
 
 def get_single_clash_path(bg, s1, s2):
-    G = mst_to_nx(bg)
-    return nx.shortest_path(G,s1,s2)
+    return list(get_relaxation_topology(bg).path(s1, s2))
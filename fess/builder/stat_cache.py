@@ -0,0 +1,348 @@
+#!/usr/bin/python
+"""
+A precompiled, memory-mapped binary version of stats files.
+
+Parsing the text based stats files dominates the startup time of short
+ernwin runs. A stats cache holds the stats of a stats file and all of its
+fallback files in a columnar layout: For every source file and stat type,
+the numeric parameters of all stats are stored in one array and the names
+and the original lines of the stats in string tables.
+Rows are sorted by key (preserving the order in the file within a key)
+and an index maps every key to its rows.
+
+The cache file contains a checksum of the text of all source files, which
+is used to detect outdated caches.
+It is loaded with `numpy.memmap` and Stat objects are only created
+when they are accessed.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+from builtins import (ascii, bytes, chr, dict, filter, hex, input,
+                      int, map, next, oct, open, pow, range, round,
+                      str, super, zip) #future package
+import hashlib
+import json
+import logging
+import os
+import struct
+from collections import defaultdict
+try:
+    from collections.abc import Mapping, Sequence
+except ImportError:
+    from collections import Mapping, Sequence
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+MAGIC = b"ERNWINSTATSCACHE"
+CACHE_VERSION = 1
+
+STAT_TYPES = ["stem", "angle", "loop", "3prime", "5prime"]
+#: The numeric parameters stored for every stat type, in this order.
+STAT_PARAMETERS = {
+    "stem": ["phys_length", "twist_angle"],
+    "angle": ["u", "v", "t", "r1", "u1", "v1"],
+    "loop": ["phys_length", "u", "v"],
+    "3prime": ["phys_length", "u", "v"],
+    "5prime": ["phys_length", "u", "v"]
+}
+
+def _aligned(offset, alignment=8):
+    return (offset + alignment - 1) // alignment * alignment
+
+def _key_to_json(key):
+    if isinstance(key, tuple):
+        return list(key)
+    return key
+
+def _key_from_json(key):
+    if isinstance(key, list):
+        return tuple(key)
+    return key
+
+def stats_checksum(filenames):
+    """
+    A checksum of the content of the given stats files (in this order).
+    """
+    checksum = hashlib.sha1()
+    for filename in filenames:
+        with open(filename, "rb") as f:
+            checksum.update(f.read())
+        checksum.update(b"\0")
+    return checksum.hexdigest()
+
+class _CacheWriter(object):
+    """Collects arrays and their position in the data section of a cache file."""
+    def __init__(self):
+        self.arrays = []
+        self.size = 0
+
+    def add(self, array):
+        array = np.ascontiguousarray(array)
+        offset = _aligned(self.size)
+        self.arrays.append((offset, array))
+        self.size = offset + array.nbytes
+        return [offset, array.dtype.str, list(array.shape)]
+
+    def add_strings(self, strings):
+        encoded = [s.encode("utf-8") for s in strings]
+        offsets = np.zeros(len(encoded)+1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(e) for e in encoded])
+        blob = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+        return {"offsets": self.add(offsets), "blob": self.add(blob)}
+
+def compile_stats(source_filenames, cache_filename, checksum=None):
+    """
+    Parse the stats files and write them to a binary cache file.
+
+    :param source_filenames: A list of filenames. The stats file followed by the fallback files.
+    :param cache_filename: The filename of the cache file that will be written.
+    :param checksum: The checksum of the source files, if it is already known.
+    """
+    import fess.builder.stat_container as fbstat
+    if checksum is None:
+        checksum = stats_checksum(source_filenames)
+    writer = _CacheWriter()
+    sources = []
+    for filename in source_filenames:
+        log.info("Compiling stats-file %s", filename)
+        rows = defaultdict(list)
+        with open(filename) as f:
+            for line in f:
+                parsed = fbstat.parse_stats_line(line)
+                if parsed is None:
+                    continue
+                stat_type, key, stat = parsed
+                rows[stat_type].append((key, line.split("#")[0].strip(), stat))
+        tables = {}
+        for stat_type in STAT_TYPES:
+            # A stable sort preserves the order of the file for stats with the same key.
+            entries = sorted(rows[stat_type], key=lambda entry: entry[0])
+            params = np.array([[getattr(stat, param) for param in STAT_PARAMETERS[stat_type]]
+                               for _, _, stat in entries], dtype=np.float64)
+            params = params.reshape((len(entries), len(STAT_PARAMETERS[stat_type])))
+            index = []
+            for i, (key, _, _) in enumerate(entries):
+                if index and index[-1][0] == _key_to_json(key):
+                    index[-1][2] = i+1
+                else:
+                    index.append([_key_to_json(key), i, i+1])
+            tables[stat_type] = {"index": index,
+                                 "params": writer.add(params),
+                                 "names": writer.add_strings([stat.pdb_name for _, _, stat in entries]),
+                                 "lines": writer.add_strings([line for _, line, _ in entries])}
+        sources.append({"filename": filename, "tables": tables})
+    header = {"version": CACHE_VERSION, "checksum": checksum, "sources": sources}
+    header = json.dumps(header).encode("utf-8")
+    data_start = _aligned(len(MAGIC) + 8 + len(header))
+    # Write to a temporary file first, so concurrent readers never see a half-written cache.
+    tmp_filename = "{}.{}.tmp".format(cache_filename, os.getpid())
+    with open(tmp_filename, "wb") as f:
+        f.write(MAGIC)
+        f.write(struct.pack(str("<Q"), len(header)))
+        f.write(header)
+        for offset, array in writer.arrays:
+            f.seek(data_start + offset)
+            f.write(array.tobytes())
+        f.truncate(data_start + writer.size)
+    os.rename(tmp_filename, cache_filename)
+    log.info("Stats cache written to %s", cache_filename)
+
+class StatsCache(object):
+    """
+    A memory-mapped stats cache file.
+
+    :var sources: A list of `CachedStatSource` objects, one for the stats file
+                  and one for every fallback file, in the order in which they were compiled.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError("File {} is not a stats cache.".format(filename))
+            header_length, = struct.unpack(str("<Q"), f.read(8))
+            header = json.loads(f.read(header_length).decode("utf-8"))
+        if header["version"] != CACHE_VERSION:
+            raise ValueError("Stats cache {} has version {}, expected {}".format(filename,
+                                                                                header["version"],
+                                                                                CACHE_VERSION))
+        self.checksum = header["checksum"]
+        self._data_start = _aligned(len(MAGIC) + 8 + header_length)
+        self._mmap = np.memmap(filename, dtype=np.uint8, mode="r")
+        self.sources = [CachedStatSource(self, source) for source in header["sources"]]
+
+    def array(self, description):
+        offset, dtype, shape = description
+        dtype = np.dtype(str(dtype))
+        start = self._data_start + offset
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        return self._mmap[start:start+nbytes].view(dtype).reshape(shape)
+
+def load_or_compile(cache_filename, source_filenames):
+    """
+    Load the stats cache, if it exists and matches the source files.
+    Otherwise (re-)compile it first.
+
+    :returns: A `StatsCache`
+    """
+    checksum = stats_checksum(source_filenames)
+    try:
+        cache = StatsCache(cache_filename)
+    except (IOError, OSError, ValueError) as e:
+        log.info("Could not load stats cache %s (%s). Compiling it.", cache_filename, e)
+    else:
+        if cache.checksum == checksum:
+            log.info("Using stats cache %s", cache_filename)
+            return cache
+        log.warning("Stats cache %s does not match the stats files. Recompiling it.", cache_filename)
+    compile_stats(source_filenames, cache_filename, checksum)
+    return StatsCache(cache_filename)
+
+class _StringTable(object):
+    def __init__(self, cache, description):
+        self._offsets = cache.array(description["offsets"])
+        self._blob = cache.array(description["blob"])
+
+    def __getitem__(self, i):
+        return self._blob[self._offsets[i]:self._offsets[i+1]].tobytes().decode("utf-8")
+
+class CachedStatSource(object):
+    """
+    The stats of one source file.
+
+    Like the dictionary returned by `stat_container.parse_stats_file`,
+    `source[stat_type][key]` is a sequence of stats.
+    """
+    def __init__(self, cache, description):
+        self.filename = description["filename"]
+        self._tables = {stat_type: CachedStatTable(cache, stat_type, table)
+                        for stat_type, table in description["tables"].items()}
+
+    def __getitem__(self, stat_type):
+        return self._tables[stat_type]
+
+    def __repr__(self):
+        return "<CachedStatSource for {}>".format(self.filename)
+
+class CachedStatTable(Mapping):
+    """
+    A read-only mapping from keys to `CachedStatList`s for one stat type of one source.
+    """
+    def __init__(self, cache, stat_type, description):
+        self.stat_type = stat_type
+        self.params = cache.array(description["params"])
+        self._names = _StringTable(cache, description["names"])
+        self._lines = _StringTable(cache, description["lines"])
+        self._index = {_key_from_json(key): (start, stop) for key, start, stop in description["index"]}
+        self._lists = {}
+        self._stats = {} # Row to stat object. Every stat is created at most once.
+
+    def __getitem__(self, key):
+        if key not in self._lists:
+            start, stop = self._index[key]
+            self._lists[key] = CachedStatList(self, range(start, stop))
+        return self._lists[key]
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __len__(self):
+        return len(self._index)
+
+    def name(self, row):
+        return self._names[row]
+
+    def stat(self, row):
+        if row not in self._stats:
+            import fess.builder.stat_container as fbstat
+            _, _, self._stats[row] = fbstat.parse_stats_line(self._lines[row])
+        return self._stats[row]
+
+class CachedStatList(Sequence):
+    """
+    A read-only sequence of stats, which creates the Stat objects only on access.
+
+    :var names: A list with the pdb_names of the stats.
+    :var params: An array with one row of numeric parameters
+                 (see `STAT_PARAMETERS`) per stat.
+    """
+    def __init__(self, table, rows):
+        self._table = table
+        self._rows = rows
+        self._names = None
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return CachedStatList(self._table, self._rows[i])
+        return self._table.stat(self._rows[i])
+
+    @property
+    def names(self):
+        if self._names is None:
+            self._names = [self._table.name(row) for row in self._rows]
+        return self._names
+
+    @property
+    def params(self):
+        return self._table.params[list(self._rows)]
+
+    def select(self, indices):
+        """
+        A CachedStatList with only the stats at the given positions.
+        """
+        return CachedStatList(self._table, [self._rows[i] for i in indices])
+
+class StatChain(Sequence):
+    """
+    A read-only concatenation of several sequences of stats,
+    which does not create Stat objects of `CachedStatList`s.
+    """
+    def __init__(self, parts):
+        self._parts = [part for part in parts if len(part)]
+        self._ends = np.cumsum([len(part) for part in self._parts])
+
+    def __len__(self):
+        if not self._parts:
+            return 0
+        return int(self._ends[-1])
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("StatChain index out of range")
+        part = int(np.searchsorted(self._ends, i, side="right"))
+        if part > 0:
+            i -= int(self._ends[part-1])
+        return self._parts[part][i]
+
+    def select(self, indices):
+        """
+        A StatChain with only the stats at the given (ascending) positions.
+        """
+        from fess.builder.stat_container import select_stats
+        parts = []
+        start = 0
+        for part, end in zip(self._parts, self._ends):
+            local = [ i-start for i in indices if start<=i<end ]
+            parts.append(select_stats(part, local))
+            start = end
+        return StatChain(parts)
+
+    @property
+    def names(self):
+        names = []
+        for part in self._parts:
+            try:
+                names.extend(part.names)
+            except AttributeError:
+                names.extend(stat.pdb_name for stat in part)
+        return names
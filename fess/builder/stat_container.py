@@ -6,10 +6,17 @@ from builtins import (ascii, bytes, chr, dict, filter, hex, input,
 import sys
 import random
 import math
+import bisect
 from collections import defaultdict
 import logging
 import string
 import os.path as op
+import threading
+from collections import deque
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
 
 import numpy as np
 
@@ -19,6 +26,7 @@ import forgi.threedee.model.stats as ftmstats
 
 from fess import data_file
 from fess.builder import config
+import fess.builder.topology as fbtopo
 import fess.motif.annotate as fma
 
 log = logging.getLogger(__name__)
@@ -30,6 +38,11 @@ except ImportError:
     except ImportError:
         lru_cache = lambda *args, **kwargs: lambda x: x #No-op decorator taking arguments
 
+def _cache_clear(cached_function):
+    try:
+        cached_function.cache_clear()
+    except AttributeError: # The no-op lru_cache
+        pass
 
 def patch_angtype(ang_type):
     """
@@ -41,45 +54,58 @@ def patch_angtype(ang_type):
         return -math.copysign(6, ang_type)
     return ang_type
 
+def parse_stats_line(line):
+    """
+    Parse a single line of a stats file.
+
+    :param line: A line of a stats file. Comments and whitespace are stripped.
+    :returns: A tuple `(stat_type, key, stat)` or None, if the line contains no stat
+              or the stat should be ignored.
+    """
+    line=line.strip()
+    if "#" in line:
+        line = line.split('#')[0]
+    if not line:
+        return None
+    if line.startswith("stem"):
+        stem_stat = ftmstats.StemStat(line)
+        return "stem", stem_stat.bp_length, stem_stat
+    elif line.startswith("angle") or line.startswith("open") or line.startswith("pseudo"):
+        angle_stat = ftmstats.AngleStat()
+        try:
+            angle_stat.parse_line(line)
+        except Exception as e:
+            with log_to_exception(log, e):
+                log.error("Could not parse file due to error parsing line '{}'".format(line))
+            raise
+        if len(angle_stat.define) > 0 and angle_stat.define[0] == 1: #An angle at the beginning of a structure
+            #I guess this should never happen, if the stats do not stem from faulty bulge graphs.
+            log.error("Ignoring angle stat {} because it is at the beginning of a structure."
+                      " Does the stat come from a faulty BulgeGraph?".format(angle_stat.pdb_name))
+            return None
+        angle_stat.ang_type = patch_angtype(angle_stat.ang_type)
+        log.debug("Reading angle_stat with dimensions %s and %s, and type %s. With define %s", angle_stat.dim1, angle_stat.dim2, angle_stat.ang_type, angle_stat.define)
+        # Adding the reverse (with -ang_type) does not work as intended and produces a lot of structures
+        # that do not fulfill the constraint energy.
+        # Note that CoarseGrainRNA.get_stats extracts two angle stats per angle.
+        return "angle", (angle_stat.dim1, angle_stat.dim2, angle_stat.ang_type), angle_stat
+    else:
+        key = line.split()[0]
+        if key not in ["3prime", "5prime", "loop"]:
+            raise ValueError("Illegal line in stats file: '{}'".format(line))
+        stat = ftmstats.LoopStat(line)
+        return key, stat.bp_length, stat
+
 def parse_stats_file(file_handle):
     stats = {"stem": defaultdict(list),
              "angle": defaultdict(list),
              "loop": defaultdict(list), "3prime": defaultdict(list), "5prime": defaultdict(list)}
     for line in file_handle:
-        line=line.strip()
-        if "#" in line:
-            line = line.split('#')[0]
-        if not line:
+        parsed = parse_stats_line(line)
+        if parsed is None:
             continue
-        if line.startswith("stem"):
-            stem_stat = ftmstats.StemStat(line)
-            stats["stem"][stem_stat.bp_length].append(stem_stat)
-        elif line.startswith("angle") or line.startswith("open") or line.startswith("pseudo"):
-            angle_stat = ftmstats.AngleStat()
-            try:
-                angle_stat.parse_line(line)
-            except Exception as e:
-                with log_to_exception(log, e):
-                    log.error("Could not parse file due to error parsing line '{}'".format(line))
-                raise
-            if len(angle_stat.define) > 0 and angle_stat.define[0] == 1: #An angle at the beginning of a structure
-                #I guess this should never happen, if the stats do not stem from faulty bulge graphs.
-                log.error("Ignoring angle stat {} because it is at the beginning of a structure."
-                          " Does the stat come from a faulty BulgeGraph?".format(angle_stat.pdb_name))
-                continue
-            angle_stat.ang_type = patch_angtype(angle_stat.ang_type)
-            log.debug("Reading angle_stat with dimensions %s and %s, and type %s. With define %s", angle_stat.dim1, angle_stat.dim2, angle_stat.ang_type, angle_stat.define)
-            stats["angle"][(angle_stat.dim1, angle_stat.dim2, angle_stat.ang_type)].append(angle_stat)
-            # Adding the reverse does not work as intended and produces a lot of structures
-            # that do not fulfill the constraint energy.
-            # stats["angle"][(angle_stat.dim1, angle_stat.dim2, -angle_stat.ang_type)].append(angle_stat)
-            # Note that CoarseGrainRNA.get_stats extracts two angle stats per angle.
-        else:
-            key = line.split()[0]
-            if key not in ["3prime", "5prime", "loop"]:
-                raise ValueError("Illegal line in stats file: '{}'".format(line))
-            stat = ftmstats.LoopStat(line)
-            stats[key][stat.bp_length].append(stat)
+        stat_type, key, stat = parsed
+        stats[stat_type][key].append(stat)
     return stats
 
 def read_stats_file(filename):
@@ -92,6 +118,94 @@ def read_stats_file(filename):
                 log.error("Failed to parse file %s", filename)
             raise
 
+def stats_line_key(line):
+    """
+    The stat type and key of a line of a stats file, without parsing the stat.
+
+    :param line: A line of a stats file.
+    :returns: A tuple `(stat_type, key)` (as returned by `parse_stats_line`)
+              or None, if the line contains no stat.
+              Note that `parse_stats_line` might still ignore the stat.
+    """
+    line=line.strip()
+    if "#" in line:
+        line = line.split('#')[0]
+    if not line:
+        return None
+    parts = line.split()
+    if line.startswith("stem"):
+        return "stem", int(parts[2])
+    elif line.startswith("angle") or line.startswith("open") or line.startswith("pseudo"):
+        return "angle", (int(parts[2]), int(parts[3]), patch_angtype(int(parts[10])))
+    elif parts[0] in ["3prime", "5prime", "loop"]:
+        return parts[0], int(parts[2])
+    raise ValueError("Illegal line in stats file: '{}'".format(line))
+
+class LazyStatsFile(object):
+    """
+    The stats of a stats file, parsed only for the keys that are used.
+
+    Like the dictionary returned by `read_stats_file`,
+    `stats_file[stat_type][key]` is a list of stats.
+    When the object is created, the file is only scanned for the keys
+    and the positions of the lines in the file.
+    """
+    def __init__(self, filename):
+        log.info("Indexing stats-file %s", filename)
+        self.filename = filename
+        positions = {stat_type: defaultdict(list) for stat_type in ["stem", "angle", "loop", "3prime", "5prime"]}
+        with open(filename, "rb") as f:
+            position = 0
+            for line in f:
+                try:
+                    stat_key = stats_line_key(line.decode("utf-8"))
+                except Exception as e:
+                    with log_to_exception(log, e):
+                        log.error("Failed to parse file %s", filename)
+                    raise
+                if stat_key is not None:
+                    stat_type, key = stat_key
+                    positions[stat_type][key].append(position)
+                position += len(line)
+        self._tables = {stat_type: _LazyStatTable(self, stat_positions)
+                        for stat_type, stat_positions in positions.items()}
+
+    def __getitem__(self, stat_type):
+        return self._tables[stat_type]
+
+    def read_stats(self, positions):
+        """
+        Parse the stats at the given positions of the file.
+        """
+        stats = []
+        with open(self.filename, "rb") as f:
+            for position in positions:
+                f.seek(position)
+                parsed = parse_stats_line(f.readline().decode("utf-8"))
+                if parsed is not None:
+                    stats.append(parsed[2])
+        return stats
+
+class _LazyStatTable(Mapping):
+    def __init__(self, stats_file, positions):
+        self._stats_file = stats_file
+        self._positions = positions
+        self._stats = {}
+
+    def __getitem__(self, key):
+        if key not in self._stats:
+            self._stats[key] = self._stats_file.read_stats(self._positions[key])
+        return self._stats[key]
+
+    def __contains__(self, key):
+        return key in self._positions
+
+    def __iter__(self):
+        return iter(self._positions)
+
+    def __len__(self):
+        return len(self._positions)
+
 letter_to_stat_type = {
     "s": "stem",
     "h": "loop",
@@ -128,7 +242,18 @@ def make_continuous( discrete_angle_stats):
         print("Singular matrix, dimensions:", dims, file=sys.stderr)
 
 class ContinuouseStatSampler:
-    def __init__(self, all_stats, key):
+    """
+    Sample angle stats from a continuouse distribution.
+
+    r1 is sampled from a kernel density estimate of the stats,
+    all other parameters are uniform.
+    The kernel density estimate is fitted once and samples are drawn in
+    batches of `batch_size` from a private random number generator
+    (seeded from numpy's global random state).
+    A background thread refills the buffer when it runs low.
+    """
+    def __init__(self, all_stats, key, batch_size=1000, seed=None):
+        import scipy.stats as ss
         kde = make_continuous(all_stats)
         self.kde = kde
         self.key = key
@@ -136,33 +261,106 @@ class ContinuouseStatSampler:
         for d in all_stats:
             data += [[d.u, d.v, d.t, d.r1, d.u1, d.v1]]
         self.data = np.array(data)
+        self.batch_size = batch_size
+        # Resampling a gaussian kde is choosing a data point and adding gaussian noise.
+        self._r1_bandwidth = math.sqrt(ss.gaussian_kde(self.data[:, 3]).covariance[0,0])
+        if seed is None:
+            seed = np.random.randint(2**31)
+        self._rng = np.random.RandomState(seed)
+        self._buffer = deque()
+        self._refill_thread = None
+        self._refill()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_refill_thread"] = None
+        return state
+
+    def _refill(self):
+        """
+        Draw a batch of samples and append them to the buffer.
+        """
+        n = self.batch_size
+        r1 = (self.data[self._rng.randint(len(self.data), size=n), 3]
+              + self._rng.normal(0, self._r1_bandwidth, size=n))
+        rnd = self._rng.rand(n, 5) # 5 random values from 0 to 1
+        u = rnd[:,0]*np.pi
+        v = rnd[:,1]*2*np.pi-np.pi
+        t = rnd[:,2]*2*np.pi-np.pi
+        u1 = rnd[:,3]*np.pi
+        v1 = rnd[:,4]*2*np.pi-np.pi
+        self._buffer.extend(zip(u.tolist(), v.tolist(), t.tolist(), r1.tolist(), u1.tolist(), v1.tolist()))
+
+    def _start_refill(self):
+        if self._refill_thread is None or not self._refill_thread.is_alive():
+            self._refill_thread = threading.Thread(target=self._refill)
+            self._refill_thread.daemon = True
+            self._refill_thread.start()
+
     def sample(self):
-        import scipy.stats as ss
-        log.debug("DATA %s with shape %s", self.data, self.data.shape)
-        r1 = ss.gaussian_kde(self.data[:, 3]).resample(1)[0][0]
-        log.debug("r1 is %s", r1)
-        rnd = np.random.rand(5) # 5 random values from 0 to 1
-        u = rnd[0]*np.pi
-        v = rnd[1]*2*np.pi-np.pi
-        t = rnd[2]*2*np.pi-np.pi
-        u1 = rnd[3]*np.pi
-        v1 = rnd[4]*2*np.pi-np.pi
-
-        #sample = self.kde.resample(1).T
+        if len(self._buffer) < max(1, self.batch_size//4):
+            # Batches are appended in order, so the samples do not
+            # depend on the timing of the background thread.
+            self._start_refill()
+        if not self._buffer:
+            self._refill_thread.join()
+        u,v,t,r1,u1,v1 = self._buffer.popleft()
         log.debug("continuouse stat sample %s", (u,v,t,r1,u1,v1))
-        #u,v,t,r1,u1,v1 = sample[0]
         stat = ftmstats.AngleStat(stat_type="angle", pdb_name='cont-{:.1f}_{:.1f}_{:.1f}_{:.1f}_{:.1f}_{:.1f}'.format(u,v,t,r1,u1,v1),
                                 dim1=self.key[0], dim2=self.key[1], u=u, v=v, t=t, r1=r1, u1=u1, v1=v1,
                                 ang_type=self.key[2], define=[], seq="", vres={})
         return stat
 
 
+def stat_names(stats):
+    """
+    The pdb_names of a sequence of stats.
+
+    For sequences of stats from a stats cache, this does not create any Stat objects.
+    """
+    try:
+        return stats.names
+    except AttributeError:
+        return [stat.pdb_name for stat in stats]
+
+def select_stats(stats, indices):
+    """
+    The stats at the given positions of a sequence of stats.
+
+    For sequences of stats from a stats cache, this does not create any Stat objects.
+    """
+    try:
+        return stats.select(indices)
+    except AttributeError:
+        return [ stats[i] for i in indices ]
+
+def _join_stats(parts):
+    """
+    Concatenate lists of stats. Cached stat lists are concatenated lazily.
+    """
+    if len(parts)==1:
+        return parts[0]
+    if all(isinstance(part, list) for part in parts):
+        return [stat for part in parts for stat in part]
+    from . import stat_cache
+    return stat_cache.StatChain(parts)
+
 class StatStorage(object):
-    def __init__(self, filename, fallback_filenames = None, continuouse=None, blacklist=[]):
+    def __init__(self, filename, fallback_filenames = None, continuouse=None, blacklist=[],
+                 cache_filename=None):
+        """
+        :param filename: The stats file
+        :param fallback_filenames: A list of stats files that are used if
+                                   not enough stats are found in filename.
+        :param cache_filename: If given, use a binary stats cache
+                               (see `fess.builder.stat_cache`) with this filename.
+                               It is compiled, if it does not exist or if it is outdated.
+        """
         self.filename = filename
         if fallback_filenames is None:
             fallback_filenames = []
         self.fallbacks = fallback_filenames
+        self.cache_filename = cache_filename
         self._sources = None
         self._has_reported = set() #Only emit warnings about insufficient stats once.
         if continuouse:
@@ -171,16 +369,80 @@ class StatStorage(object):
             self.continuouse = continuouse[:]
         else:
             self.continuouse = []
-        self.blacklist=blacklist
+        self._statsamplers = {}
+        self._blacklist=tuple(blacklist)
+
+    @property
+    def blacklist(self):
+        """
+        A tuple of blacklisted pdb-name patterns.
+
+        It is immutable, so it can only be changed by assignment,
+        which clears the caches.
+        """
+        return self._blacklist
+
+    @blacklist.setter
+    def blacklist(self, value):
+        self._blacklist = tuple(value)
+        self.clear_caches()
+
+    def clear_caches(self):
+        """
+        Clear the cached lists of possible stats and sampling tables.
+
+        This has to be called, if anything changes the weights of the stats.
+        Changing the blacklist calls it automatically.
+        """
+        _cache_clear(type(self)._possible_stats)
+        _cache_clear(type(self)._sampling_table)
+        _cache_clear(type(self)._stat_index)
+        self._statsamplers = {}
+
+    def reset_statsamplers(self):
+        """
+        Discard the samplers for continuouse stats.
+
+        New samplers are seeded from numpy's global random state when they are
+        used, so after reseeding numpy, the sampled continuouse stats are reproducible.
+        """
+        self._statsamplers = {}
+
+    def prepare_for(self, bg, min_entries=100):
+        """
+        Compute the sampling tables for all elements of the bulge graph in advance.
+
+        Elements without any stats are skipped here. They raise an
+        error only when a stat is sampled for them.
+        """
+        for elem in bg.defines:
+            if elem in self.continuouse:
+                continue
+            try:
+                key = self.key_for(bg, elem)
+                self._sampling_table(letter_to_stat_type[elem[0]], key, min_entries)
+            except LookupError:
+                log.info("No stats for element %s", elem)
 
     def in_blacklist(self, stat):
-        statname = stat.pdb_name
+        return self._name_in_blacklist(stat.pdb_name)
+
+    def _name_in_blacklist(self, statname):
         for pattern in self.blacklist:
             if pattern in statname:
                 return True
         return False
 
 
+    def key_for(self, bg, elem):
+        """
+        Like `key_from_bg_and_elem`, but computed only once per element
+        and minimum spanning tree of the bulge graph.
+        """
+        return fbtopo.cached(bg, (self.key_from_bg_and_elem, elem),
+                             lambda: self.key_from_bg_and_elem(bg, elem),
+                             depends_on_mst=True)
+
     @staticmethod
     def key_from_bg_and_elem(bg, elem):
         dims = bg.get_node_dimensions(elem, with_missing=(elem[0]!="s"))
@@ -192,20 +454,47 @@ class StatStorage(object):
             key = 3 #Hairpins<3 probably means missing residues. Just return the smalles possible dimension
         else:
             key = dims[0]
-        log.debug("Key for bg %s and element %s is %s (node dimensions without_missing "
-                  "%s, with missing %s)", bg.name, elem, key,
-                  bg.get_node_dimensions(elem, with_missing=False),
-                  bg.get_node_dimensions(elem, with_missing=True))
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Key for bg %s and element %s is %s (node dimensions without_missing "
+                      "%s, with missing %s)", bg.name, elem, key,
+                      bg.get_node_dimensions(elem, with_missing=False),
+                      bg.get_node_dimensions(elem, with_missing=True))
         return key
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self.cache_filename is not None:
+            # Memory-mapped sources are mapped again by the unpickling process,
+            # instead of being copied.
+            state["_sources"] = None
+        # Samplers for continuouse stats are cheap to fit again.
+        state["_statsamplers"] = {}
+        return state
+
+    def load_sources(self):
+        """
+        Load the stats file and all fallback files now, instead of on first use.
+
+        Use this together with a stats cache (see `fess.builder.stat_cache`)
+        before starting several processes with fork: all processes
+        then share the read-only memory-mapped stats.
+        """
+        for _ in self._iter_stat_sources():
+            pass
+
     def _iter_stat_sources(self):
         if self._sources is None:
-            self._sources = [read_stats_file(self.filename)]
+            if self.cache_filename is not None:
+                from . import stat_cache
+                cache = stat_cache.load_or_compile(self.cache_filename,
+                                                   [self.filename]+list(self.fallbacks))
+                self._sources = cache.sources
+            else:
+                self._sources = [LazyStatsFile(self.filename)]
         for i in range(len(self.fallbacks)+1):
             if i>=len(self._sources):
-                self._sources.append(read_stats_file(self.fallbacks[i-1]))
+                self._sources.append(LazyStatsFile(self.fallbacks[i-1]))
             yield self._sources[i]
-        raise StopIteration
 
     @lru_cache(maxsize = 128)
     def _possible_stats(self, stat_type, key, min_entries=100, strict=False, enable_logging=True):
@@ -223,6 +512,7 @@ class StatStorage(object):
                   weights is a list of floats, choose_from is a list of stats.
         """
         choose_from = []
+        num_found = 0
         weights = []
         statfiles = self._iter_stat_sources()
         while sum(weights)<min_entries:
@@ -230,16 +520,19 @@ class StatStorage(object):
                 sf = next(statfiles)
                 source = sf[stat_type]
             except StopIteration: #All stat_files exhausted
-                if enable_logging and len(choose_from)<min_entries and (stat_type, key, min_entries) not in self._has_reported:
-                    log.warning("Only {} stats found for {} with key {}".format(len(choose_from), stat_type, key))
+                if enable_logging and num_found<min_entries and (stat_type, key, min_entries) not in self._has_reported:
+                    log.warning("Only {} stats found for {} with key {}".format(num_found, stat_type, key))
                     self._has_reported.add((stat_type, key, min_entries))
                 break
             if key in source:
-                stats=[ stat for stat in source[key] if not self.in_blacklist(stat) ]
+                stats = self._filter_blacklisted(source[key])
                 num_stats = len(stats)
+                if not num_stats:
+                    continue
                 if enable_logging:
                     log.info("Appending {} stats from source {} for {}.".format(len(stats),id( sf), key))
-                choose_from.extend(stats)
+                choose_from.append(stats)
+                num_found += num_stats
                 if not weights:
                     weight = 1 #All stats from the first stat_source always has weight 1, even if there are more than min_entries stats.
                 else:
@@ -250,7 +543,7 @@ class StatStorage(object):
                 if enable_logging:
                      log.info("Appending NO stats from source {} for {}.".format(id( sf), key))
         if enable_logging and (stat_type, key, min_entries) not in self._has_reported:
-            log.info("Found {} stats for {} with key {}".format(len(choose_from), stat_type, key))
+            log.info("Found {} stats for {} with key {}".format(num_found, stat_type, key))
             self._has_reported.add((stat_type, key, min_entries))
 
         if not choose_from:
@@ -271,7 +564,31 @@ class StatStorage(object):
                     return self._possible_stats_inner(stat_type, new_key, min_entries, strict, enable_logging)
             # If everything else fails, raise an error even if strict was disabled.
             raise LookupError("No stats found for {} with key {}".format(stat_type, key))
-        return weights, choose_from
+        return weights, _join_stats(choose_from)
+
+    @lru_cache(maxsize = None)
+    def _sampling_table(self, stat_type, key, min_entries=100):
+        """
+        :returns: A tuple `cumulative_weights, choose_from`, where
+                  cumulative_weights is a list with the cumulative sum of the
+                  weights returned by `self._possible_stats`.
+        """
+        weights, stats = self._possible_stats(stat_type, key, min_entries)
+        cumulative_weights = []
+        total = 0
+        for w in weights:
+            total += w
+            cumulative_weights.append(total)
+        return cumulative_weights, stats
+
+    def _filter_blacklisted(self, stats):
+        """
+        Remove blacklisted stats from a sequence of stats.
+        """
+        if not self.blacklist:
+            return stats[:]
+        keep = [ i for i, name in enumerate(stat_names(stats)) if not self._name_in_blacklist(name) ]
+        return select_stats(stats, keep)
 
     def sample_for(self, bg, elem, min_entries = 100):
         """
@@ -295,60 +612,99 @@ class StatStorage(object):
         if elem in self.continuouse:
             return self._sample_continuouse_stat(bg, elem, min_entries)
         else:
-            key = self.key_from_bg_and_elem(bg, elem)
+            key = self.key_for(bg, elem)
             log.debug("Calling _possible_stats with %r, %r", letter_to_stat_type[elem[0]], key)
-            weights, stats = self._possible_stats(letter_to_stat_type[elem[0]], key, min_entries)
-            r = random.uniform(0, sum(weights))
-            for i, w in enumerate(weights):
-                if r<=w:
-                    # TODO: Penalize stats found with JARED, but for another loop
-                    return stats[i]
-                r-=w
-            assert False
-            return stats[0] #Fallback if asserts are disabled. Should be unreachable.
+            cumulative_weights, stats = self._sampling_table(letter_to_stat_type[elem[0]], key, min_entries)
+            # Identical to random.uniform(0, total_weight), so seeded runs do not change.
+            r = cumulative_weights[-1] * random.random()
+            # The first stat with r<=cumulative_weight.
+            # TODO: Penalize stats found with JARED, but for another loop
+            i = bisect.bisect_left(cumulative_weights, r)
+            return stats[min(i, len(stats)-1)]
 
     def _sample_continuouse_stat(self, bg, elem, min_entries=100):
-        key = self.key_from_bg_and_elem(bg, elem)
+        key = self.key_for(bg, elem)
         kde = self._get_statsampler(letter_to_stat_type[elem[0]], key, min_entries)
         return kde.sample()
 
     def _iterate_continuouse_stat(self, bg, elem, min_entries=100):
-        key = self.key_from_bg_and_elem(bg, elem)
+        key = self.key_for(bg, elem)
         kde = self._get_statsampler(letter_to_stat_type[elem[0]], key, min_entries)
         log.debug("Starting to iterate continuouse stats")
         while True:
             yield kde.sample()
 
     def _get_statsampler(self, stat_type, key, min_entries):
-        log.debug("Getting continuouse kde-based sampler for %s", key)
-        all_stats = list(self.iterate_stats(stat_type, key, min_entries, False))
-        return ContinuouseStatSampler(all_stats, key)
+        if (stat_type, key, min_entries) not in self._statsamplers:
+            log.debug("Creating continuouse kde-based sampler for %s", key)
+            all_stats = list(self.iterate_stats(stat_type, key, min_entries, False))
+            self._statsamplers[(stat_type, key, min_entries)] = ContinuouseStatSampler(all_stats, key)
+        return self._statsamplers[(stat_type, key, min_entries)]
 
-    def iterate_stats(self, stat_type, key, min_entries = 100, cycle = False):
+    def _stat_subset(self, stat_type, key, min_entries = 100):
+        """
+        Every possible stat is kept with a probability equal to its weight.
+        """
         weights, stats = self._possible_stats(stat_type, key, min_entries)
-        stat_samples = []
-        for i, w in enumerate(weights):
-            r = random.random()
-            if r<=w:
-                stat_samples.append(stats[i])
+        selected = [ i for i, w in enumerate(weights) if random.random()<=w ]
+        return select_stats(stats, selected)
+
+    def stat_subset_for(self, bg, elem, min_entries = 100):
+        """
+        A sequence of the stats that `iterate_stats_for` would yield (without cycling).
+
+        Stats from a stats cache are only created when they are accessed.
+        """
+        if elem in self.continuouse:
+            raise ValueError("The continuouse stats for {} cannot be enumerated.".format(elem))
+        key = self.key_for(bg, elem)
+        return self._stat_subset(letter_to_stat_type[elem[0]], key, min_entries)
+
+    def iterate_stats(self, stat_type, key, min_entries = 100, cycle = False):
+        stat_samples = self._stat_subset(stat_type, key, min_entries)
         while True:
             for stat in stat_samples:
                 yield stat
             if not cycle:
                 break #Exhaust the generator
 
+    @lru_cache(maxsize = None)
+    def _stat_index(self, stat_type, key):
+        """
+        :returns: A tuple `index, stats`. stats are all stats for this key
+                  (from all stat sources) and index is a dictionary from
+                  pdb_names to the position in stats.
+                  Names that occur more than once are mapped to None.
+        """
+        _, stats = self._possible_stats(stat_type, key, min_entries=float('inf'), enable_logging=False)
+        index = {}
+        for i, name in enumerate(stat_names(stats)):
+            if name in index:
+                index[name] = None
+            else:
+                index[name] = i
+        return index, stats
+
     def load_stat_by_name(self, bg, elem, name):
-        key = self.key_from_bg_and_elem(bg, elem)
-        
-        _, stats = self._possible_stats(letter_to_stat_type[elem[0]], key, min_entries=float('inf'), enable_logging=False)
-        found=None
-        for stat in stats:
-            if stat.pdb_name == name:
-                assert found is None
-                found=stat
-        if not found:
-            raise RuntimeError("Cannot load stat %s for elem %s. Maybe a different stat file or different cg was used?")
-        return found
+        return self.load_stats_by_name(bg, {elem: name})[elem]
+
+    def load_stats_by_name(self, bg, names):
+        """
+        Load the stats with the given pdb_names.
+
+        :param bg: A CoarseGrainRNA or BulgeGraph object
+        :param names: A dictionary {elem: pdb_name}
+        :returns: A dictionary {elem: stat}
+        """
+        stats = {}
+        for elem, name in names.items():
+            key = self.key_for(bg, elem)
+            index, possible_stats = self._stat_index(letter_to_stat_type[elem[0]], key)
+            if name not in index:
+                raise RuntimeError("Cannot load stat {} for elem {}. Maybe a different stat file or different cg was used?".format(name, elem))
+            assert index[name] is not None, "Stat name {} is not unique".format(name)
+            stats[elem] = possible_stats[index[name]]
+        return stats
 
 
     def iterate_stats_for(self, bg, elem, min_entries = 100, cycle = False):
@@ -363,7 +719,7 @@ class StatStorage(object):
             for stat in self._iterate_continuouse_stat(bg, elem, min_entries):
                 yield stat
         else:
-            key = self.key_from_bg_and_elem(bg, elem)
+            key = self.key_for(bg, elem)
             log.debug("Key is %s, elem is %s, elem[0] is %s", key, elem, elem[0])
             log.debug("letter_to_stat_type[elem[0]] is %s", letter_to_stat_type[elem[0]])
             for stat in self.iterate_stats(letter_to_stat_type[elem[0]], key, min_entries):
@@ -371,6 +727,12 @@ class StatStorage(object):
 
 
 
+    def coverage_tracker(self, bg, min_entries = 100):
+        """
+        A `CoverageTracker` for the elements of the bulge graph.
+        """
+        return CoverageTracker(self, bg, min_entries)
+
     def coverage_for(self, sampled_stat_names, bg, elem, min_entries = 100):
         """
         Count, what percentage of the stats have been used during sampling.
@@ -380,15 +742,63 @@ class StatStorage(object):
         For the other parameters, see `self.sample_for`
         """
 
-        key = self.key_from_bg_and_elem(bg, elem)
+        key = self.key_for(bg, elem)
         weights, stats = self._possible_stats(letter_to_stat_type[elem[0]], key, min_entries)
         total_weight = sum(weights)
         coverage = 0.
+        names = stat_names(stats)
         for i, weight in enumerate(weights):
-            if stats[i].pdb_name in sampled_stat_names:
+            if names[i] in sampled_stat_names:
                 coverage += weight/total_weight
         return coverage
 
+class CoverageTracker(object):
+    """
+    Keep track of the fraction of stats that have been used for every element.
+
+    Like `StatStorage.coverage_for`, but updated incrementally:
+    every stat is weighted by its sampling weight and the weights of all
+    stats for an element are computed only once.
+    Use `StatStorage.coverage_tracker` to create a CoverageTracker.
+    """
+    def __init__(self, stat_source, bg, min_entries=100):
+        self._stat_source = stat_source
+        self._bg = bg
+        self.min_entries = min_entries
+        #: For each element, the pdb_names of stats that have been visited
+        self._visited = defaultdict(set)
+        self._coverage = defaultdict(float)
+        #: For each element a dictionary {pdb_name: relative weight}
+        self._relative_weights = {}
+
+    def _weights_for(self, elem):
+        if elem not in self._relative_weights:
+            key = self._stat_source.key_for(self._bg, elem)
+            weights, stats = self._stat_source._possible_stats(letter_to_stat_type[elem[0]], key, self.min_entries)
+            total_weight = sum(weights)
+            relative_weights = defaultdict(float)
+            for name, weight in zip(stat_names(stats), weights):
+                relative_weights[name] += weight/total_weight
+            self._relative_weights[elem] = relative_weights
+        return self._relative_weights[elem]
+
+    def visit(self, elem, stat_name):
+        """
+        Mark the stat with the pdb_name stat_name as used for the element elem.
+
+        :returns: The new coverage for the element
+        """
+        if stat_name not in self._visited[elem]:
+            self._visited[elem].add(stat_name)
+            self._coverage[elem] += self._weights_for(elem).get(stat_name, 0.)
+        return self._coverage[elem]
+
+    def coverage(self, elem):
+        """
+        The fraction (by weight) of stats that have been visited for the element.
+        """
+        return self._coverage[elem]
+
 def identitical_bases(seq1, seq2):
     if len(seq1) != len(seq2):
         # This is an interim solution while the stats still contain adjacent nucleotides for stems.
@@ -417,10 +827,44 @@ def seq_and_pyrpur_similarity(sequences, stat):
     #log.debug("Score is %f", score)
     return score
 
+# Lookup table from ascii codes to the 2-letter alphabeth used by seq_and_pyrpur_similarity
+_PYRPUR = np.arange(256, dtype=np.uint8)
+_PYRPUR[[ord(c) for c in "AGCU"]] = [ord(t) for t in "RRYY"]
+
+def _encode_sequences(seqs, length):
+    """
+    Encode sequences of the same length as a 2D array of ascii codes.
+    """
+    return np.frombuffer("".join(seqs).encode("ascii"), dtype=np.uint8).reshape((len(seqs), length))
+
+def seq_and_pyrpur_similarities(sequences, stats):
+    """
+    Like `seq_and_pyrpur_similarity`, but for a list of stats at once.
+
+    :returns: A numpy array with one score per stat.
+    """
+    identical = np.zeros(len(stats))
+    for i, seq in enumerate(sequences):
+        query = _encode_sequences([seq], len(seq))[0]
+        stat_seqs = [ stat.seqs[i] for stat in stats ]
+        # See identitical_bases: Sequences with 2 additional (adjacent)
+        # nucleotides are trimmed. All other length mismatches score 0.
+        for length, trim in [(len(seq), 0), (len(seq)+2, 1)]:
+            indices = [ j for j, stat_seq in enumerate(stat_seqs) if len(stat_seq)==length ]
+            if not indices:
+                continue
+            encoded = _encode_sequences([stat_seqs[j] for j in indices], length)
+            encoded = encoded[:, trim:trim+len(seq)]
+            identical[indices] += (encoded==query).sum(axis=1)
+            identical[indices] += (_PYRPUR[encoded]==_PYRPUR[query]).sum(axis=1)
+    return (identical + 1) / (sum(len(x) for x in sequences) * 2 +1)
+
 class SequenceDependentStatStorage(StatStorage):
-    def __init__(self, filename, fallback_filenames = None, sequence_score = seq_and_pyrpur_similarity):
+    def __init__(self, filename, fallback_filenames = None, sequence_score = seq_and_pyrpur_similarity,
+                 cache_filename=None):
         self.sequence_score = sequence_score
-        super(SequenceDependentStatStorage, self).__init__(filename, fallback_filenames)
+        super(SequenceDependentStatStorage, self).__init__(filename, fallback_filenames,
+                                                           cache_filename=cache_filename)
 
     @staticmethod
     def key_from_bg_and_elem(bg, elem):
@@ -433,8 +877,10 @@ class SequenceDependentStatStorage(StatStorage):
             return dims[0], tuple(bg.get_define_seq_str(elem, adjacent = elem[0]!="s"))
 
 
-    @lru_cache(maxsize = 256)
-    def _possible_stats(self, stat_type, key, min_entries = 100, enable_loging=True):
+    # The weights depend on the sequence, so there is one entry per element.
+    # Cache them for the whole run.
+    @lru_cache(maxsize = None)
+    def _possible_stats(self, stat_type, key, min_entries = 100, strict=False, enable_logging=True):
         """
         :returns: Two lists, `weights` and `choose_from` of the same length.
                   weights is a list of floats, choose_from is a list of stats.
@@ -455,6 +901,8 @@ class SequenceDependentStatStorage(StatStorage):
             if key in source:
                 stats=[ stat for stat in source[key] if not self.in_blacklist(stat) ]
                 num_stats = len(stats)
+                if not num_stats:
+                    continue
                 if enable_logging:
                     log.info("Added %s stats ", num_stats)
                 choose_from.extend(stats)
@@ -463,9 +911,11 @@ class SequenceDependentStatStorage(StatStorage):
                 else:
                     remaining_total_weight = min_entries - sum(weights)
                     weight = min(1, remaining_total_weight/len(stats))
-                for stat in stats:
-                    #log.debug("Evaluating score for %s %s %s", key, sequence, stat)
-                    weights.append(weight*self.sequence_score(sequence, stat))
+                if self.sequence_score is seq_and_pyrpur_similarity:
+                    scores = seq_and_pyrpur_similarities(sequence, stats).tolist()
+                else:
+                    scores = [ self.sequence_score(sequence, stat) for stat in stats ]
+                weights.extend(weight*score for score in scores)
             else:
                 if enable_logging:
                     log.info("Nothing added from stat_source %s",id(sf))
@@ -507,6 +957,15 @@ def update_parser(parser):
                                 'or multiloops. The stats of these elements will be sampled from'
                                 ' a continuouse distribution. EXPERIMENTAL, DONT USE THIS.')
     stat_options.add_argument('--blacklist-stats', type=str, help="A comma seperate list of pdb-ids. Disallow stats from these pdb ids.")
+    stat_options.add_argument('--stats-cache', type=str,
+                              help="A filename.\n"
+                                   "Use a precompiled binary version of the stats file and the\n"
+                                   "fallback stats files, which is loaded much faster.\n"
+                                   "It is (re)compiled, if it does not exist or does not match\n"
+                                   "the stats files. See also fess/scripts/compile_stats.py\n"
+                                   "Recommended with --parallel: All processes then share\n"
+                                   "the memory-mapped stats instead of each process holding\n"
+                                   "its own copy of all parsed stats.")
 
 def from_args(args, cg):
     if args.sequence_based:
@@ -518,6 +977,8 @@ def from_args(args, cg):
         kwargs["continuouse"] = args.continuouse_stats.split(",")
     if args.blacklist_stats:
         kwargs["blacklist"] = args.blacklist_stats.split(",")
+    if args.stats_cache:
+        kwargs["cache_filename"] = args.stats_cache
     if args.jar3d:
         jared_out    = op.join(config.Configuration.sampling_output_dir, "jar3d.stats")
         jared_tmp    = op.join(config.Configuration.sampling_output_dir, "jar3d")
@@ -530,4 +991,7 @@ def from_args(args, cg):
         stat_source = StatSourceClass(jared_out, new_fallbacks, **kwargs)
     else:
         stat_source = StatSourceClass(args.stats_file, args.fallback_stats_files, **kwargs)
+    if args.sequence_based:
+        # The sequence dependent weights of all elements are computed only once.
+        stat_source.prepare_for(cg)
     return stat_source
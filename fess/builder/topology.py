@@ -0,0 +1,98 @@
+#!/usr/bin/python
+"""
+Cached information about the topology of a BulgeGraph.
+
+During sampling, the secondary structure of a BulgeGraph never changes,
+so information derived from it (e.g. the multiloops) only has to be computed once.
+Information that depends on the minimum spanning tree (e.g. angle types) is
+computed once per build order and recomputed automatically, after the minimum
+spanning tree (and thus the build order) changed.
+
+The caches are bound to the BulgeGraph object. Copies of a BulgeGraph
+have their own, empty caches.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+from builtins import (ascii, bytes, chr, dict, filter, hex, input,
+                      int, map, next, oct, open, pow, range, round,
+                      str, super, zip) #future package
+import logging
+import weakref
+
+log = logging.getLogger(__name__)
+
+class _TopologyCache(object):
+    def __init__(self):
+        #: Values that depend only on the secondary structure
+        self.values = {}
+        #: Values that depend on the minimum spanning tree
+        self.mst_values = {}
+        #: The build order self.mst_values were computed for
+        self.build_order = None
+
+_caches = weakref.WeakKeyDictionary()
+
+def _cache_for(bg):
+    try:
+        return _caches[bg]
+    except KeyError:
+        cache = _caches[bg] = _TopologyCache()
+        return cache
+
+def cached(bg, key, function, depends_on_mst=False):
+    """
+    Return function(), computed only once per BulgeGraph and key.
+
+    :param key: A hashable key, unique for the function and its arguments.
+    :param depends_on_mst: If True, the value is recomputed after the
+                           build order of the BulgeGraph changed.
+    """
+    cache = _cache_for(bg)
+    if depends_on_mst:
+        if bg.build_order is None:
+            bg.traverse_graph()
+        if cache.build_order is not bg.build_order:
+            cache.mst_values.clear()
+            cache.build_order = bg.build_order
+        values = cache.mst_values
+    else:
+        values = cache.values
+    try:
+        return values[key]
+    except KeyError:
+        value = values[key] = function()
+        return value
+
+def invalidate(bg):
+    """
+    Discard all cached values for the BulgeGraph.
+
+    Use this after the secondary structure was modified.
+    Changes of the minimum spanning tree are detected automatically.
+    """
+    _caches.pop(bg, None)
+
+def mlonly_multiloops(bg):
+    """
+    Like `bg.find_mlonly_multiloops()`. Do not modify the returned list.
+    """
+    return cached(bg, "mlonly_multiloops", bg.find_mlonly_multiloops)
+
+def describe_multiloop(bg, loop):
+    """
+    Like `bg.describe_multiloop(loop)`. Do not modify the returned set.
+    """
+    loop = tuple(loop)
+    return cached(bg, ("describe_multiloop", loop), lambda: bg.describe_multiloop(loop))
+
+def shortest_mlonly_multiloop(bg, elem):
+    """
+    Like `bg.shortest_mlonly_multiloop(elem)`
+    """
+    return cached(bg, ("shortest_mlonly_multiloop", elem),
+                  lambda: bg.shortest_mlonly_multiloop(elem))
+
+def fingerprint(bg):
+    """
+    A string identifying the name and secondary structure of the BulgeGraph.
+    """
+    return cached(bg, "fingerprint", lambda: bg.name+"\n"+bg.to_dotbracket_string()+"\n")
@@ -0,0 +1,29 @@
+#!/usr/bin/python
+from __future__ import print_function, absolute_import, division
+from builtins import (ascii, bytes, chr, dict, filter, hex, input,
+                      map, next, oct, open, pow, range, round,
+                      str, super, zip)
+import argparse
+import logging
+
+import fess.builder.stat_cache as fbsc
+from fess import data_file
+from fess.builder import config
+
+def generateParser():
+    parser=argparse.ArgumentParser( description="Compile a stats file and its fallback stats files "
+                                                "into a binary stats cache, which can be used "
+                                                "with ernwin's --stats-cache option.")
+    parser.add_argument('cache_file', type=str, help="The filename of the stats cache to write.")
+    parser.add_argument('--stats-file', type=str,
+                        default=data_file(config.Configuration.default_stats_file),
+                        help="The stats file.")
+    parser.add_argument('--fallback-stats-files', nargs = '+', type=str, default=[],
+                        help="The fallback stats files, in the order in which ernwin uses them.")
+    return parser
+
+parser=generateParser()
+if __name__=="__main__":
+    logging.basicConfig(level=logging.INFO)
+    args = parser.parse_args()
+    fbsc.compile_stats([args.stats_file]+args.fallback_stats_files, args.cache_file)
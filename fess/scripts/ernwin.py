@@ -8,7 +8,6 @@ import argparse
 import sys
 import random
 import os
-import copy
 import multiprocessing
 import traceback
 
@@ -118,6 +117,10 @@ def main():
 def run(args, cg, main_dir, reference_cg):
     setup_rng(args)
     stat_source = fbstat.from_args(args, cg) #Uses sampling_output_dir
+    if args.parallel:
+        # Map the stats before any process is started,
+        # so the memory is shared between all forked processes.
+        stat_source.load_sources()
 
     # If we perform normal sampling with parallel=True,
     # we start sampling while we are building.
@@ -165,7 +168,7 @@ def sample_one_trajectory(sampler, iterations):
 
 def build_spatial_models(args, cg, stat_source, main_dir):
     """
-    An iterator over spatial models, which contain deepcopies of cg.
+    An iterator over spatial models, which contain clones of cg.
     """
     if args.replica_exchange and args.num_builds>1:
         raise ValueError("--replica-exchange and --num-builds are mutually exclusive.")
@@ -174,9 +177,17 @@ def build_spatial_models(args, cg, stat_source, main_dir):
     else:
         build_count = args.num_builds
     build_function = fbb.from_args(args, stat_source, main_dir)
+    builder = getattr(build_function, "__self__", None)
+    if isinstance(builder, fbb.ParallelFairBuilder) and not fbmodel.some_replica_different(args):
+        # All spatial models have the same constraint energies, so they are
+        # built together, using all successes of the worker processes.
+        sm = fbmodel.from_args(args, fbmodel.clone_cg(cg), stat_source, 0)
+        for built_sm in builder.build_n(sm, build_count):
+            yield built_sm
+        return
     sm = None
     for i in range(build_count):
-        curr_cg = copy.deepcopy(cg)
+        curr_cg = fbmodel.clone_cg(cg)
         sm = fbmodel.from_args(args, curr_cg, stat_source, i)
         build_function(sm)
         yield sm
@@ -8,7 +8,6 @@ import argparse
 import sys
 import random
 import os
-import copy
 import multiprocessing
 import traceback
 from contextlib import nested
@@ -95,11 +94,11 @@ def run(args, cgs, main_dir):
 
 def build_spatial_model(args, cg, stat_source, main_dir):
     """
-    An iterator over spatial models, which contain deepcopies of cg.
+    An iterator over spatial models, which contain clones of cg.
     """
     build_function = fbb.from_args(args, stat_source, main_dir)
     sm = None
-    curr_cg = copy.deepcopy(cg)
+    curr_cg = fbmodel.clone_cg(cg)
     sm = fbmodel.from_args(args, curr_cg, stat_source)
     build_function(sm)
     return sm
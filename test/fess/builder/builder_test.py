@@ -6,6 +6,7 @@ from builtins import (ascii, bytes, chr, dict, filter, hex, input,
 import unittest
 import argparse
 import copy
+import random
 import numpy as np
 import numpy.testing as nptest
 import fess.builder.builder as fbb
@@ -32,6 +33,15 @@ class TestBuilderAccept(unittest.TestCase):
         self.build_function(self.sm)
         self.assertAlmostEqual(ftmsim.cg_rmsd(self.sm.bg, orig_cg), 0.)
 
+class TestFromArgs(unittest.TestCase):
+    def test_batch_size_and_early_rejection_exclusive(self):
+        p = argparse.ArgumentParser()
+        fbb.update_parser(p)
+        for extra in [[], ["--fair-building-workers", "2"]]:
+            args = p.parse_args(["-f", "--fair-batch-size", "5", "--fair-early-rejection"]+extra)
+            with self.assertRaises(ValueError):
+                fbb.from_args(args, None, None)
+
 class TestBuilderBaseClass(unittest.TestCase):
     def setUp(self):
         self.cg = ftmc.CoarseGrainRNA.from_bg_file('test/fess/data/1GID_A-structure1.coord')
@@ -78,3 +88,51 @@ class TestChangingMSTBuilder(TestBuilderBaseClass):
             if self.sm.bg.mst != mst:
                 return
         assert False, "The MST was never changed"
+
+class TestBatchedFairBuilder(TestBuilderBaseClass):
+    def setUp(self):
+        super(TestBatchedFairBuilder, self).setUp()
+        self.builder = fbb.BatchedFairBuilder(self.stat_source, batch_size=20)
+    def test_junction_screen_agrees_with_energy(self):
+        batch = []
+        for i in range(RAND_REPETITION):
+            self.sm.sample_stats(self.stat_source)
+            batch.append(dict(self.sm.elem_defs))
+        open_junctions = self.builder._junction_screen(self.sm, batch)
+        for elem_defs, screened in zip(batch, open_junctions):
+            self.sm.elem_defs = elem_defs
+            self.sm.new_traverse_and_build()
+            self.assertEqual(screened is None, self.sm.fulfills_junction_energy())
+
+class TestParallelFairBuilder(TestBuilderBaseClass):
+    def setUp(self):
+        super(TestParallelFairBuilder, self).setUp()
+        self.builder = fbb.ParallelFairBuilder(self.stat_source, num_workers=2, attempts_per_task=5)
+    def test_building_samples_stats(self):
+        for i in range(5):
+            self.builder.build(self.sm)
+            self.assertGreater(ftmsim.cg_rmsd(self.sm.bg, self.cg_copy), 1)
+    def test_clashfree_building(self):
+        for sm in self.builder.build_n(self.sm, 5):
+            self.assertEqual(sm.junction_constraint_energy["m0"].eval_energy(sm.bg), 0)
+            self.assertEqual(sm.constraint_energy.eval_energy(sm.bg), 0)
+    def test_result_independent_of_number_of_workers(self):
+        builds = []
+        for num_workers in [1, 3]:
+            builder = fbb.ParallelFairBuilder(self.stat_source, num_workers=num_workers,
+                                              attempts_per_task=5)
+            random.seed(1)
+            builds.append([sm.bg.to_cg_string() for sm in builder.build_n(self.sm, 3)])
+        self.assertEqual(builds[0], builds[1])
+
+class TestEarlyRejectionFairBuilder(TestBuilderBaseClass):
+    def setUp(self):
+        super(TestEarlyRejectionFairBuilder, self).setUp()
+        self.builder = fbb.EarlyRejectionFairBuilder(self.stat_source)
+    def test_same_result_as_fair_builder(self):
+        builds = []
+        for builder in [fbb.FairBuilder(self.stat_source), self.builder]:
+            random.seed(1)
+            builder.build(self.sm2)
+            builds.append(self.sm2.bg.to_cg_string())
+        self.assertEqual(builds[0], builds[1])
@@ -114,6 +114,30 @@ class TestClashEnergy(unittest.TestCase):
         print(self.energy.bad_bulges)
         self.assertEqual(self.energy.bad_bulges, [tuple(sorted(("s7", "s11")))])
 
+    def test_clash_stack_agrees_with_energy(self):
+        for cg in [self.cg, self.cg_clash]:
+            nodes = ["s0"]+[ node for s1, l, s2 in cg.traverse_graph() for node in (l, s2) ]
+            stack = fbe.ClashStack(self.energy, cg)
+            stack.push(nodes[:1])
+            for i in range(1, len(nodes), 2):
+                stack.push(nodes[i:i+2])
+            for length in [len(nodes), 8, 4, 7, len(nodes)]:
+                stack.truncate(length)
+                if len(stack.nodes)<length:
+                    stack.push(nodes[len(stack.nodes):length])
+                self.assertEqual(stack.nodes, nodes[:length])
+                energy = self.energy.eval_energy(cg, nodes=stack.nodes)
+                self.assertEqual(stack.clashes*self.energy.prefactor, energy)
+                self.assertEqual(set(stack.bad_bulges), set(self.energy.bad_bulges))
+        self.assertGreater(stack.clashes, 0)
+
+    def test_has_violation(self):
+        self.assertFalse(self.energy.has_violation(self.cg))
+        self.assertFalse(self.energy.has_violation(self.cg, nodes=["s8"]))
+        self.assertTrue(self.energy.has_violation(self.cg_clash))
+        self.assertTrue(self.energy.has_violation(self.cg_clash, recent=["s11"]))
+        self.assertEqual(self.energy.bad_bulges, [tuple(sorted(("s7", "s11")))])
+
 class TestJunctionConstraintEnergy(unittest.TestCase):
     def setUp(self):
         self.cg = ftmc.CoarseGrainRNA.from_bg_file('test/fess/data/1GID_A.cg')
@@ -139,6 +163,10 @@ class TestJunctionConstraintEnergy(unittest.TestCase):
         cg.add_all_virtual_residues()
         self.assertEqual(self.junction_energy.eval_energy(cg, nodes=["m0"]),
                          self.junction_energy.eval_energy(cg))
+    def test_has_violation(self):
+        self.assertFalse(self.junction_energy.has_violation(self.cg))
+        self.assertTrue(self.junction_energy.has_violation(self.cg_bad, recent=["s1"]))
+        self.assertEqual(self.junction_energy.bad_bulges, ["m0"])
 
 class TestSampledFragmentJunctionEnergy(unittest.TestCase):
     def setUp(self):
@@ -479,6 +507,19 @@ class TestCombinedEnergy(unittest.TestCase):
         self.assertTrue(e.hasinstance(int))
         self.assertTrue(e.hasinstance(float))
         self.assertFalse(e.hasinstance(str))
+    def test_has_violation_stops_at_first_violation(self):
+        first = Mock()
+        first.has_violation = Mock(return_value=False)
+        second = Mock()
+        second.has_violation = Mock(return_value=True)
+        third = Mock()
+        e = fbe.CombinedEnergy([first, second, third])
+        self.assertTrue(e.has_violation("cg"))
+        self.assertFalse(third.has_violation.called)
+        # The violating energy is checked first next time.
+        first.has_violation.reset_mock()
+        self.assertTrue(e.has_violation("cg"))
+        self.assertFalse(first.has_violation.called)
 
 
 
@@ -15,6 +15,7 @@ import forgi.threedee.model.coarse_grain as ftmc
 import forgi.threedee.model.similarity as ftmsim
 import forgi.threedee.model.stats as ftms
 import forgi.threedee.utilities.vector as ftuv
+import forgi.threedee.utilities.graph_pdb as ftug
 import forgi.utilities.debug as fud
 import math
 import logging
@@ -42,6 +43,26 @@ class TestAddLoop(unittest.TestCase):
         sm.add_loop("h0","s0")
         self.assertAlmostEqual(ftuv.magnitude(sm.bulges["h0"].mids[1] - sm.bulges["h0"].mids[0]), self.example_hairpin_stat.phys_length)
 
+class TestPlaceNewStem(unittest.TestCase):
+    def setUp(self):
+        self.stem_stat=ftms.StemStat("stem exampleStat 3 5.29399999969 1.19302425058 1 3 7 9")
+        self.angle_stat=ftms.AngleStat(u=1.2, v=0.4, t=-0.7, r1=12., u1=0.9, v1=-1.1)
+        self.prev_stem = fbm.StemModel(mids=(np.array([1., 2., 3.]), np.array([1., 2., 13.])),
+                                       twists=(np.array([0., 1., 0.]), np.array([1., 0., 0.])))
+    def test_place_new_stem_geometry(self):
+        stem = fbm.place_new_stem(self.prev_stem, self.stem_stat, self.angle_stat, (0,1))
+        self.assertAlmostEqual(ftuv.magnitude(stem.mids[0]-self.prev_stem.mids[1]), self.angle_stat.r1)
+        self.assertAlmostEqual(stem.length(), self.stem_stat.phys_length)
+        self.assertAlmostEqual(np.dot(stem.vec(), stem.twists[0]), 0)
+        self.assertAlmostEqual(np.dot(stem.vec(), stem.twists[1]), 0)
+        self.assertAlmostEqual(ftuv.vec_angle(stem.twists[0], stem.twists[1]), self.stem_stat.twist_angle)
+
+    def test_placement_transform_is_cached_by_parameters(self):
+        transform = fbm.stem_placement_transform(self.angle_stat)
+        self.assertIs(fbm.stem_placement_transform(self.angle_stat), transform)
+        self.angle_stat.r1 = 15.
+        self.assertAlmostEqual(ftuv.magnitude(fbm.stem_placement_transform(self.angle_stat)[:3,3]), 15.)
+
 def value_from_diff(key, obj1, obj2):
     """
     Traverse 1 step in the deepdiff putput hierarchy.
@@ -92,8 +113,8 @@ def assertModelsEqual(sm1, sm2, significant_digits=None, on_demand_keys=[], igno
     :var IGNORE_KEYS: Do not report any changes in this attribute.
     :raises: AssertionError, if the models are not equal.
     """
-    ON_DEMAND_KEYS=["build_order", "mst", "ang_types", "closed_bulges", "bulges", "newly_added_stems", "stems", "_conf_stats" ]+on_demand_keys
-    IGNORE_KEYS = ["newly_added_stems"]+ignore_keys
+    ON_DEMAND_KEYS=["build_order", "mst", "ang_types", "closed_bulges", "bulges", "newly_added_stems", "stems", "_conf_stats", "_built_with", "_dirty_elems", "_vres_transformed", "virtual_residues", "_last_changed" ]+on_demand_keys
+    IGNORE_KEYS = ["newly_added_stems", "_build_plan"]+ignore_keys
     diff = DeepDiff(sm1, sm2, significant_digits=significant_digits)
     if diff=={}:
         return
@@ -315,6 +336,7 @@ class TestModifyingMST(unittest.TestCase):
         self.sm_pseudoknot.load_sampled_elems()
         self.sm_pseudoknot.new_traverse_and_build()
         self.example_angle_stat=ftms.AngleStat("angle exampleStat 0 1000 1.69462078307 0.313515399557 0.165804917419 5.08692965666 1.04129866007 0.717061903121 3  CC")
+
     @unittest.skip("Update for deepdiff V3")
     def test_change_and_reset_mst_ML(self):
         self.change_and_reset_mst(self.sm)
@@ -442,6 +464,15 @@ class TestModifyingMSTWithoutLoadSampledElements(unittest.TestCase):
         self.use_sm_set_multiloop_break_segment_without_loading_sampled_elems(self.sm_pseudoknot)
     def test_set_multiloop_break_segment_sm_zero_hairpin(self):
         self.use_sm_set_multiloop_break_segment_without_loading_sampled_elems(self.sm_zero_hairpin)
+    def test_build_plan_recompiled_after_changing_mst(self):
+        plan = self.sm.build_plan()
+        self.assertIs(self.sm.build_plan(), plan)
+        self.assertEqual([step[:3] for step in plan.steps], self.sm.bg.build_order)
+        self.sm.set_multiloop_break_segment("m3")
+        new_plan = self.sm.build_plan()
+        self.assertIsNot(new_plan, plan)
+        self.assertNotIn("m3", new_plan.loop_step)
+        self.assertEqual([step[:3] for step in new_plan.steps], self.sm.bg.build_order)
     def use_sm_set_multiloop_break_segment_without_loading_sampled_elems(self, sm):
         sm.set_multiloop_break_segment("m3")
         assert_connected_graph(sm.bg) #The graph remains connected.
@@ -559,6 +590,100 @@ class TestNewTraverse(unittest.TestCase):
         self.sm.new_traverse_and_build(start="s2")
         self.assertGreater(ftmsim.cg_rmsd(self.sm.bg, self.cg_copy), 0)
 
+    def test_new_traverse_and_build_start_only_builds_subtree(self):
+        self.sm.load_sampled_elems(None)
+        self.sm.new_traverse_and_build()
+        s5_coords = np.copy(self.sm.bg.coords["s5"])
+        self.sm.elem_defs["m1"] = self.stat_source.sample_for(self.cg, "m1")
+        nodes = self.sm.new_traverse_and_build(start="m0", include_start=True)
+        self.assertEqual(nodes, ["m0", "s3", "i0", "s4"])
+        # s5 is not built after m0, so the changed stat for m1 is not applied.
+        nptest.assert_array_equal(self.sm.bg.coords["s5"], s5_coords)
+        nodes = self.sm.new_traverse_and_build(start="s6")
+        self.assertEqual(nodes[:2], ["m8", "s7"])
+        self.assertNotIn("s3", nodes)
+
+    def test_new_traverse_and_build_subtree_moves_rigidly(self):
+        self.sm.load_sampled_elems(None)
+        self.sm.new_traverse_and_build()
+        self.sm.elem_defs["m1"] = self.stat_source.sample_for(self.cg, "m1")
+        self.sm.new_traverse_and_build(start="m1", include_start=True)
+        rigidly_moved = {k: np.copy(v) for k, v in self.sm.bg.coords.items()}
+        self.sm.new_traverse_and_build()
+        for k in rigidly_moved:
+            nptest.assert_allclose(rigidly_moved[k], self.sm.bg.coords[k], atol=10**-6)
+
+    def test_new_traverse_and_build_updates_virtual_residues_incrementally(self):
+        self.sm.load_sampled_elems(None)
+        self.sm.new_traverse_and_build()
+        self.sm.elem_defs["i7"] = self.stat_source.sample_for(self.cg, "i7")
+        self.sm.new_traverse_and_build(start="i7", include_start=True)
+        incremental = {s: [np.copy(self.sm.bg.get_virtual_residue(self.cg.defines[s][0]+i, True))
+                           for i in range(self.cg.stem_length(s))]
+                       for s in self.cg.stem_iterator()}
+        self.sm.new_traverse_and_build()
+        for s in self.cg.stem_iterator():
+            for i in range(self.cg.stem_length(s)):
+                nptest.assert_allclose(incremental[s][i],
+                                       self.sm.bg.get_virtual_residue(self.cg.defines[s][0]+i, True),
+                                       atol=10**-6)
+
+    def test_virtual_residue_store_backs_bg(self):
+        self.sm.load_sampled_elems(None)
+        self.sm.new_traverse_and_build()
+        store = self.sm.virtual_residues
+        for s in self.cg.stem_iterator():
+            self.assertTrue(store.is_linked(self.sm.bg, s))
+            for i in range(self.cg.stem_length(s)):
+                nptest.assert_array_equal(store[s][i,0], self.sm.bg.vposs[s][i])
+        # Moving a subtree moves the virtual residues in the store.
+        self.sm.elem_defs["m1"] = self.stat_source.sample_for(self.cg, "m1")
+        self.sm.new_traverse_and_build(start="m1", include_start=True)
+        nptest.assert_array_equal(store["s9"][0,0], self.sm.bg.vposs["s9"][0])
+
+    def test_clone_is_independent(self):
+        self.sm.load_sampled_elems(None)
+        self.sm.new_traverse_and_build()
+        clone = self.sm.clone()
+        self.assertIs(clone.bg.defines, self.sm.bg.defines)
+        self.assertIsNot(clone.bg.coords, self.sm.bg.coords)
+        clone.elem_defs["m1"] = self.stat_source.sample_for(self.cg, "m1")
+        clone.new_traverse_and_build(start="m1", include_start=True)
+        self.assertAlmostEqual(ftmsim.cg_rmsd(self.sm.bg, self.cg_copy), 0, places=6)
+        self.assertGreater(ftmsim.cg_rmsd(clone.bg, self.cg_copy), 0)
+        nptest.assert_array_equal(clone.virtual_residues["s9"][0,0], clone.bg.vposs["s9"][0])
+
+    def test_batched_stem_frames_match_building(self):
+        self.sm.load_sampled_elems(None)
+        batch = [dict(self.sm.elem_defs)]
+        for i in range(3):
+            self.sm.sample_stats(self.stat_source)
+            batch.append(dict(self.sm.elem_defs))
+        frames = self.sm.batched_stem_frames(batch)
+        for i, elem_defs in enumerate(batch):
+            self.sm.elem_defs = elem_defs
+            self.sm.new_traverse_and_build()
+            for stem in self.sm.bg.stem_iterator():
+                nptest.assert_allclose(frames[stem][i], fbm.stem_frame(self.sm.stems[stem]), atol=1e-8)
+
+    def test_batched_stem_frames_from_start(self):
+        self.sm.load_sampled_elems(None)
+        self.sm.new_traverse_and_build()
+        batch = []
+        for i in range(3):
+            elem_defs = dict(self.sm.elem_defs)
+            elem_defs["i6"] = self.stat_source.sample_for(self.cg, "i6")
+            batch.append(elem_defs)
+        frames = self.sm.batched_stem_frames(batch, start="i6")
+        for i, elem_defs in enumerate(batch):
+            self.sm.elem_defs = elem_defs
+            self.sm.new_traverse_and_build()
+            for stem in self.sm.bg.stem_iterator():
+                nptest.assert_allclose(frames[stem][i], fbm.stem_frame(self.sm.stems[stem]), atol=1e-8)
+            for ml in self.sm.bg.mloop_iterator():
+                self.assertAlmostEqual(self.sm.batched_junction_distances(ml, frames, batch)[i],
+                                       ftug.junction_virtual_atom_distance(self.sm.bg, ml))
+
     def test_new_traverse_and_build_steps_doesnt_build_after(self):
         self.sm.load_sampled_elems()
         #We need to traverse_and_build at least once from the start!
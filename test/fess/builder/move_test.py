@@ -26,6 +26,7 @@ import forgi.threedee.model.stats as ftmstat
 
 from fess.builder.models import SpatialModel, place_new_stem
 from fess.builder.stat_container import StatStorage
+import fess.builder.energy as fbe
 import fess.builder.move as fbmov
 
 
@@ -140,6 +141,56 @@ class TestMoverBaseClassPublicAPI(unittest.TestCase):
             self.mover.revert(self.sm)
             self.assertEqual(self.sm.bg.coords, coords_old)
 
+class _SameStatsForAll(object):
+    """A stat source that offers the same stats for every element."""
+    def __init__(self, stats):
+        self.stats = stats
+    def stat_subset_for(self, bg, elem):
+        return self.stats
+
+class TestEnergeticJunctionMoverClosureSearch(unittest.TestCase):
+    def setUp(self):
+        cg = ftmc.CoarseGrainRNA.from_bg_file("test/fess/data/1GID_A.cg")
+        self.sm = SpatialModel(cg)
+        self.sm.load_sampled_elems(None)
+        self.sm.new_traverse_and_build()
+        energy = fbe.RoughJunctionClosureEnergy()
+        stats = []
+        for elem in cg.defines:
+            if elem[0]=="m":
+                self.sm.junction_constraint_energy[elem] = energy
+            if elem[0] in "mi":
+                stats += cg.get_bulge_angle_stats(elem)
+        self.stat_source = _SameStatsForAll(stats[:15])
+        self.mover = fbmov.EnergeticJunctionMover(2, self.stat_source)
+
+    def test_closure_search_finds_all_closing_combinations(self):
+        for elems in self.mover._enumerate_choices(self.sm):
+            whole_loop = self.mover._sort_loop(self.sm, list(self.sm.bg.shortest_mlonly_multiloop(elems[0])))
+            loop = whole_loop[min(whole_loop.index(elem) for elem in elems):]
+            elem_defs = dict(self.sm.elem_defs)
+            count, sampled = self.mover._closure_search(self.sm, elems, loop)
+            self.assertEqual(set(sampled.keys()), set(elems))
+            self.assertTrue(self.mover._check_junction(self.sm, sampled, loop, whole_loop))
+            # The stat of the broken ml-segment does not change the junction closure energy.
+            free = [ elem for elem in elems if elem != loop[-1] ]
+            expected = 0
+            for combination in it.product(self.stat_source.stats, repeat=len(free)):
+                sampled = dict(zip(free, combination))
+                if loop[-1] in elems:
+                    sampled[loop[-1]] = self.stat_source.stats[0]
+                if self.mover._check_junction(self.sm, sampled, loop, whole_loop):
+                    expected += 1
+            self.assertEqual(count, expected, msg="Elements {}".format(elems))
+            self.sm.elem_defs = elem_defs
+            self.sm.new_traverse_and_build()
+
+    def test_move_closes_junction(self):
+        for i in range(10):
+            movestring = self.mover.move(self.sm)
+            self.assertNotEqual(movestring, "no_change")
+            self.assertTrue(self.sm.fulfills_junction_energy())
+
 class TestConvenienceFunctions(unittest.TestCase):
     def setUp(self):
         self.stat_source = StatStorage("test/fess/data/test1.stats")
@@ -22,3 +22,18 @@ class TestBitarray(unittest.TestCase):
         log.error(all_sampled)
         self.assertEqual(len(all_sampled), 210)
         self.assertIn("aB2%", all_sampled)
+
+class TestIndexPermutation(unittest.TestCase):
+    def test_is_permutation(self):
+        for size in [1, 2, 3, 7, 16, 17, 210, 1000]:
+            permutation = fbc.IndexPermutation(size)
+            self.assertEqual(sorted(permutation(i) for i in range(size)), list(range(size)))
+
+    def test_huge_product(self):
+        choices = { "e{}".format(i): "abcdefghijklmnopqrstuvwxyz" for i in range(10) } # 26**10 combinations
+        sampled = set()
+        for i, choice in enumerate(fbc._sample_unique_stat_combinations(choices)):
+            sampled.add("".join(choice[elem] for elem in sorted(choice)))
+            if i>=1000:
+                break
+        self.assertEqual(len(sampled), 1001)
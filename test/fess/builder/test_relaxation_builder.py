@@ -0,0 +1,41 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+from builtins import (ascii, bytes, chr, dict, filter, hex, input,
+                      int, map, next, oct, open, pow, range, round,
+                      str, super, zip)
+import unittest
+
+import networkx as nx
+
+import forgi.threedee.model.coarse_grain as ftmc
+
+import fess.builder.relaxation_builder as fbrel
+
+class RelaxationTopologyTests(unittest.TestCase):
+    def setUp(self):
+        self.cg = ftmc.CoarseGrainRNA.from_bg_file('test/fess/data/4GXY_A.cg')
+        self.cg.traverse_graph()
+
+    def test_paths_are_shortest_paths(self):
+        G = fbrel.mst_to_nx(self.cg)
+        topology = fbrel.get_relaxation_topology(self.cg)
+        for start in self.cg.mst:
+            for end in self.cg.mst:
+                self.assertEqual(topology.path(start, end), nx.shortest_path(G, start, end))
+        for loop, cycle in fbrel.get_mst_cycles(self.cg).items():
+            v1, v2 = self.cg.edges[loop]
+            self.assertEqual(cycle, nx.shortest_path(G, v1, v2))
+
+    def test_subtree_stems(self):
+        G = fbrel.mst_to_nx(self.cg)
+        for s1, loop, s2 in self.cg.build_order:
+            G2 = G.copy()
+            G2.remove_node(loop)
+            fixed = nx.node_connected_component(G2, self.cg.build_order[0][0])
+            self.assertEqual(fbrel.get_subtree_stems(self.cg, loop),
+                             [ s for s in self.cg.stem_iterator() if s not in fixed ])
+
+    def test_cached_per_mst(self):
+        topology = fbrel.get_relaxation_topology(self.cg)
+        self.assertIs(fbrel.get_relaxation_topology(self.cg), topology)
+        self.cg.traverse_graph()
+        self.assertIsNot(fbrel.get_relaxation_topology(self.cg), topology)
@@ -0,0 +1,74 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+from builtins import (ascii, bytes, chr, dict, filter, hex, input,
+                      int, map, next, oct, open, pow, range, round,
+                      str, super, zip)
+import unittest
+import os.path
+import pickle
+import shutil
+import tempfile
+
+import fess.builder.stat_cache as fbsc
+import fess.builder.stat_container as fbstat
+
+SOURCES = ["test/fess/data/test1.stats", "test/fess/data/fallback1.stats", "test/fess/data/fallback2.stats"]
+
+class StatsCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache_file = os.path.join(self.tmpdir, "stats.cache")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_cache_equals_text_file(self):
+        fbsc.compile_stats(SOURCES, self.cache_file)
+        cache = fbsc.StatsCache(self.cache_file)
+        self.assertEqual(len(cache.sources), 3)
+        for filename, source in zip(SOURCES, cache.sources):
+            stats = fbstat.read_stats_file(filename)
+            for stat_type in fbsc.STAT_TYPES:
+                self.assertEqual(set(source[stat_type].keys()), set(stats[stat_type].keys()))
+                for key in stats[stat_type]:
+                    self.assertEqual(list(source[stat_type][key]), stats[stat_type][key])
+                    self.assertEqual(source[stat_type][key].names,
+                                     [stat.pdb_name for stat in stats[stat_type][key]])
+
+    def test_stats_are_created_lazily(self):
+        fbsc.compile_stats(SOURCES, self.cache_file)
+        cache = fbsc.StatsCache(self.cache_file)
+        stems = cache.sources[2]["stem"][5]
+        self.assertEqual(len(stems), 2)
+        self.assertEqual(stems.names, ["fallback2:s_0", "fallback2:s_2"])
+        self.assertEqual(len(cache.sources[2]["stem"]._stats), 0)
+        self.assertEqual(stems[1].pdb_name, "fallback2:s_2")
+        self.assertEqual(len(cache.sources[2]["stem"]._stats), 1)
+        self.assertAlmostEqual(stems.params[0, 0], 10.388)
+
+    def test_load_or_compile_detects_changed_source(self):
+        source = os.path.join(self.tmpdir, "a.stats")
+        shutil.copy(SOURCES[0], source)
+        cache = fbsc.load_or_compile(self.cache_file, [source])
+        self.assertEqual(set(cache.sources[0]["stem"].keys()), {5})
+        with open(source, "a") as f:
+            f.write("stem new:s_0 7 10.388 2.43294047108\n")
+        cache = fbsc.load_or_compile(self.cache_file, [source])
+        self.assertEqual(set(cache.sources[0]["stem"].keys()), {5, 7})
+
+    def test_stat_storage_with_cache(self):
+        st = fbstat.StatStorage(SOURCES[0], SOURCES[1:], cache_filename=self.cache_file)
+        weights, stats = st._possible_stats("stem", 5, 2)
+        self.assertEqual(len(stats), 3)
+        self.assertEqual(fbstat.stat_names(stats), ["test:s_0", "fallback2:s_0", "fallback2:s_2"])
+        self.assertEqual(stats[2].pdb_name, "fallback2:s_2")
+        self.assertEqual(weights, [1, 0.5, 0.5])
+        self.assertTrue(os.path.exists(self.cache_file))
+
+    def test_pickled_stat_storage_maps_cache_again(self):
+        st = fbstat.StatStorage(SOURCES[0], SOURCES[1:], cache_filename=self.cache_file)
+        st.load_sources()
+        st2 = pickle.loads(pickle.dumps(st))
+        self.assertIsNone(st2._sources)
+        _, stats = st2._possible_stats("stem", 6, 1)
+        self.assertEqual(stats[0].pdb_name, "fallback1:s_0")
+        self.assertIsInstance(st2._sources[0], fbsc.CachedStatSource)
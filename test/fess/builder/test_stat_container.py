@@ -19,6 +19,8 @@ except ImportError:
     from mock import mock_open, patch
 import logging
 
+import numpy as np
+
 log = logging.getLogger(__name__)
 class ParseFileTests(unittest.TestCase):
     def test_parse_empty_line(self):
@@ -69,6 +71,16 @@ class ReadFileTests(unittest.TestCase):
         self.assertEqual(stats["5prime"][4],
                          [ftmstats.LoopStat("5prime test:f_0 4 20.4034805163 1.47912394946 -0.0715301558972")])
 
+    def test_lazy_stats_file(self):
+        lazy_stats = fbstat.LazyStatsFile("test/fess/data/test1.stats")
+        self.assertEqual(len(lazy_stats["angle"]._stats), 0)
+        stats = fbstat.read_stats_file("test/fess/data/test1.stats")
+        for stat_type in stats:
+            self.assertEqual(set(lazy_stats[stat_type].keys()), set(stats[stat_type].keys()))
+        self.assertEqual(lazy_stats["angle"][(4, 1000, 6)], stats["angle"][(4, 1000, 6)])
+        self.assertEqual(len(lazy_stats["angle"]._stats), 1)
+        self.assertEqual(lazy_stats["loop"][5], stats["loop"][5])
+
 class StatStorageTest(unittest.TestCase):
     def test_stat_files_are_loaded_lazily(self):
         stats_open = mock_open()
@@ -156,6 +168,31 @@ class StatStoragePublicAPITests(unittest.TestCase):
         self.assertGreater(mc[2][1], 25) #Expectation value 50
         self.assertLess(mc[2][1], 75)
 
+    def test_sampling_table(self):
+        cumulative_weights, stats = self.st._sampling_table("stem", 5, 2)
+        self.assertEqual(cumulative_weights, [1, 1.5, 2.])
+        self.assertEqual(len(stats), 3)
+
+    def test_sample_for_after_blacklist_changed(self):
+        self.st.sample_for(self.cg, "s0", 2)
+        self.st.blacklist = ["test:"]
+        for i in range(20):
+            self.assertNotEqual(self.st.sample_for(self.cg, "s0", 2).pdb_name, "test:s_0")
+
+    def test_blacklist_immutable(self):
+        self.st.blacklist = ["test:"]
+        self.assertEqual(self.st.blacklist, ("test:",))
+        with self.assertRaises(AttributeError):
+            self.st.blacklist.append("fallback1:")
+
+    def test_load_stats_by_name(self):
+        stats = self.st.load_stats_by_name(self.cg2, {"s0": "fallback2:s_2", "i0": "fallback1:i_0"})
+        self.assertEqual(stats["s0"].pdb_name, "fallback2:s_2")
+        self.assertEqual(stats["i0"].pdb_name, "fallback1:i_0")
+        self.assertEqual(self.st.load_stat_by_name(self.cg2, "s0", "test:s_0").pdb_name, "test:s_0")
+        with self.assertRaises(RuntimeError):
+            self.st.load_stat_by_name(self.cg2, "s0", "fallback1:s_0") # Wrong length
+
     def test_iterate_stats(self):
         #With minimal 10 stats, the 3 stats found in the 3 files are used.
         if True: #with self.assertWarnsRegex(UserWarning, "Only .* stats found for .* with key .*"): #Only python 3.3+
@@ -186,6 +223,54 @@ class StatStoragePublicAPITests(unittest.TestCase):
         cov = self.st.coverage_for(set(["test:i_0", "fallback1:i_0"]), self.cg2, "i0", 2)
         self.assertAlmostEqual(cov, 1.) # The file fallback2 is not needed at all.
 
+class ContinuouseStatSamplerTests(unittest.TestCase):
+    def setUp(self):
+        rnd = np.random.RandomState(0).rand(10, 6)
+        self.stats = [ ftmstats.AngleStat(stat_type="angle", pdb_name="test:i_{}".format(i), dim1=5, dim2=2,
+                                          u=u, v=v, t=t, r1=10.+10*r1, u1=u1, v1=v1,
+                                          ang_type=1, define=[], seq="", vres={})
+                       for i, (u, v, t, r1, u1, v1) in enumerate(rnd) ]
+
+    def test_sample(self):
+        sampler = fbstat.ContinuouseStatSampler(self.stats, (5,2,1), batch_size=10, seed=1)
+        for i in range(25): # Exhausts the buffer more than once
+            stat = sampler.sample()
+            self.assertEqual((stat.dim1, stat.dim2, stat.ang_type), (5, 2, 1))
+            self.assertGreater(stat.r1, 0)
+            self.assertLess(stat.r1, 30)
+
+    def test_sample_is_reproducible(self):
+        sampler1 = fbstat.ContinuouseStatSampler(self.stats, (5,2,1), batch_size=10, seed=1)
+        sampler2 = fbstat.ContinuouseStatSampler(self.stats, (5,2,1), batch_size=10, seed=1)
+        for i in range(25):
+            self.assertEqual(sampler1.sample().pdb_name, sampler2.sample().pdb_name)
+
+class CoverageTrackerTests(unittest.TestCase):
+    def setUp(self):
+        self.st = fbstat.StatStorage("test/fess/data/test1.stats", ["test/fess/data/fallback1.stats", "test/fess/data/fallback2.stats"])
+        self.cg = ftmc.CoarseGrainRNA.from_dotbracket(dotbracket_str = "(((((...)))))", seq = "AUGCACCCUGCAU")
+
+    def test_visit(self):
+        tracker = self.st.coverage_tracker(self.cg, 2)
+        self.assertEqual(tracker.coverage("s0"), 0)
+        self.assertEqual(tracker.visit("s0", "test:s_0"), 0.5)
+        self.assertEqual(tracker.visit("s0", "test:s_0"), 0.5) # Visiting again does not change coverage
+        self.assertEqual(tracker.visit("s0", "some_other_stat"), 0.5)
+        self.assertEqual(tracker.visit("s0", "fallback2:s_0"), 0.75)
+        self.assertEqual(tracker.coverage("s0"),
+                         self.st.coverage_for(set(["test:s_0", "fallback2:s_0"]), self.cg, "s0", 2))
+
+class SequenceSimilarityTests(unittest.TestCase):
+    def test_vectorized_similarity_equals_scalar(self):
+        stats = [ ftmstats.StemStat("stem test:s_0 5 10.388 2.43294047108 1 5 10 15 GCAUG UGCAU"),
+                  ftmstats.StemStat("stem test:s_1 5 10.388 2.43294047108 1 5 10 15 AAAAA CCCCC"),
+                  ftmstats.StemStat("stem test:s_2 5 10.388 2.43294047108 1 5 10 15 UGCAUGC GGCAUGC"), # 2 adjacent nts
+                  ftmstats.StemStat("stem test:s_3 5 10.388 2.43294047108 1 5 10 15 GCAU UGCAU") ] # Different length
+        sequences = ["GCAUG", "AGCAU"]
+        scores = fbstat.seq_and_pyrpur_similarities(sequences, stats)
+        for i, stat in enumerate(stats):
+            self.assertAlmostEqual(scores[i], fbstat.seq_and_pyrpur_similarity(sequences, stat))
+
 class SequenceDependentStatStorageTests(unittest.TestCase):
     def setUp(self):
         self.st = fbstat.SequenceDependentStatStorage("test/fess/data/test1.stats", ["test/fess/data/fallback1.stats", "test/fess/data/fallback2.stats"])
@@ -0,0 +1,39 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+from builtins import (ascii, bytes, chr, dict, filter, hex, input,
+                      int, map, next, oct, open, pow, range, round,
+                      str, super, zip)
+import unittest
+import copy
+
+import forgi.threedee.model.coarse_grain as ftmc
+
+import fess.builder.topology as fbtopo
+
+class TopologyCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.cg = ftmc.CoarseGrainRNA.from_bg_file('test/fess/data/4GXY_A.cg')
+
+    def test_values_are_cached(self):
+        loops = fbtopo.mlonly_multiloops(self.cg)
+        self.assertEqual(loops, self.cg.find_mlonly_multiloops())
+        self.assertIs(fbtopo.mlonly_multiloops(self.cg), loops)
+        self.assertEqual(fbtopo.describe_multiloop(self.cg, loops[0]),
+                         self.cg.describe_multiloop(loops[0]))
+
+    def test_copies_have_their_own_cache(self):
+        loops = fbtopo.mlonly_multiloops(self.cg)
+        cg2 = copy.deepcopy(self.cg)
+        self.assertIsNot(fbtopo.mlonly_multiloops(cg2), loops)
+
+    def test_mst_dependent_values_are_recomputed(self):
+        calls = []
+        def function():
+            calls.append(1)
+            return len(calls)
+        self.assertEqual(fbtopo.cached(self.cg, "key", function, depends_on_mst=True), 1)
+        self.assertEqual(fbtopo.cached(self.cg, "key", function, depends_on_mst=True), 1)
+        self.cg.build_order = None
+        self.assertEqual(fbtopo.cached(self.cg, "key", function, depends_on_mst=True), 2)
+        self.assertEqual(fbtopo.cached(self.cg, "key", function), 3)
+        fbtopo.invalidate(self.cg)
+        self.assertEqual(fbtopo.cached(self.cg, "key", function), 4)